@@ -0,0 +1,296 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, replace
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parents[1]
+# Benchmark the working tree, not whatever version happens to be installed
+sys.path.insert(0, str(ROOT / "src"))
+
+from benchmarks.generate import ImageSpec, generate  # noqa: E402
+
+SCENARIOS: Dict[str, ImageSpec] = {
+    "docker-default": ImageSpec(),
+    "oci-gzip": ImageSpec(format="oci"),
+    "many-small-files": ImageSpec(
+        files_per_layer=20000,
+        depth=6,
+        fanout=6,
+        size_dist="lognormal",
+        mean_size=512,
+    ),
+    "large-files": ImageSpec(files_per_layer=100, mean_size=1 << 20),
+    "whiteout-heavy": ImageSpec(
+        overwrite_ratio=0.4,
+        whiteout_ratio=0.15,
+        opaque_ratio=0.02,
+        hardlink_ratio=0.05,
+        symlink_ratio=0.05,
+    ),
+}
+
+PHASES = ("open", "index", "preserve", "squash", "finalize", "total")
+
+
+def _peak_rss() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_worker(image: Path, from_layer: Optional[str], jobs: int) -> dict:
+    """Squash ``image`` once, timing each phase; runs in a fresh process."""
+    from oci_squash import archive
+    from oci_squash.api import compute_layers_to_squash
+    from oci_squash.detector import detect_format
+    from oci_squash.formats import (
+        copy_preserved_layers,
+        read_docker_metadata,
+        read_oci_metadata,
+        write_docker_manifest,
+    )
+    from oci_squash.layers import index_layers, locate_layers
+    from oci_squash.metadata import (
+        source_diff_ids,
+        update_config_and_history,
+        write_config_and_get_image_id,
+    )
+    from oci_squash.squash import squash_layers
+    from oci_squash.workarea import WorkArea
+
+    timings: Dict[str, float] = {}
+    work = Path(tempfile.mkdtemp(prefix="oci-squash-bench-"))
+    scratch = WorkArea(work / "scratch")
+    start = time.perf_counter()
+    try:
+        t = time.perf_counter()
+        source = archive.open_image(image, work / "old")
+        fmt = detect_format(source)
+        meta = (
+            read_oci_metadata(source) if fmt == "oci" else read_docker_metadata(source)
+        )
+        to_keep, to_squash = compute_layers_to_squash(meta.layer_ids, from_layer)
+        timings["open"] = time.perf_counter() - t
+
+        # Header scan of the layers to squash on its own, for files/s
+        t = time.perf_counter()
+        real_squash = [lid for lid in to_squash if not lid.startswith("<missing-")]
+        members = 0
+        layer_bytes = 0
+        with WorkArea(work / "index") as index_scratch:
+            for index in index_layers(
+                locate_layers(source, meta.oci, real_squash), index_scratch, jobs
+            ):
+                members += len(index.members)
+                layer_bytes += index.size
+        timings["index"] = time.perf_counter() - t
+
+        out = work / "out.tar"
+        with archive.ImageWriter(out) as writer:
+            t = time.perf_counter()
+            layers = copy_preserved_layers(source, writer, meta.oci, to_keep)
+            timings["preserve"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            squashed, _ = squash_layers(
+                to_squash,
+                to_keep,
+                source,
+                writer,
+                meta.oci,
+                scratch,
+                jobs,
+                digests=source_diff_ids(meta.config, meta.real_layer_ids),
+            )
+            timings["squash"] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            layers.extend(squashed)
+            diff_ids = [layer.diff_id for layer in layers]
+            config = update_config_and_history(
+                meta.config, to_keep, diff_ids, "bench", len(squashed)
+            )
+            _, config_name = write_config_and_get_image_id(writer, config)
+            write_docker_manifest(
+                writer,
+                config_name,
+                to_keep,
+                meta.oci,
+                squashed_layers=[layer.name for layer in squashed],
+                repo_tags=None,
+            )
+        timings["finalize"] = time.perf_counter() - t
+        timings["total"] = time.perf_counter() - start
+        source.close()
+        return {
+            "timings": timings,
+            "members": members,
+            "layer_bytes": layer_bytes,
+            "input_bytes": image.stat().st_size,
+            "output_bytes": out.stat().st_size,
+            "peak_rss": _peak_rss(),
+        }
+    finally:
+        scratch.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def _run_once(image: Path, from_layer: Optional[str], jobs: int) -> dict:
+    cmd = [sys.executable, "-m", "benchmarks.bench", "--worker", str(image)]
+    cmd += ["--jobs", str(jobs)]
+    if from_layer is not None:
+        cmd += ["--from-layer", from_layer]
+    r = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
+    if r.returncode != 0:
+        raise RuntimeError(f"Benchmark worker failed:\n{r.stderr}")
+    return json.loads(r.stdout)
+
+
+def bench_scenario(
+    name: str,
+    spec: ImageSpec,
+    images_dir: Path,
+    from_layer: Optional[str],
+    jobs: int,
+    repeat: int,
+) -> dict:
+    image = images_dir / f"{name}-{spec.key()}.tar"
+    if not image.exists():
+        print(f"[{name}] generating {image}", file=sys.stderr)
+        generate(image, spec)
+    runs = [_run_once(image, from_layer, jobs) for _ in range(repeat)]
+    timings = {
+        phase: statistics.median(r["timings"][phase] for r in runs) for phase in PHASES
+    }
+    first = runs[0]
+    mb = first["layer_bytes"] / 1024 / 1024
+    return {
+        "spec": asdict(spec),
+        "timings": timings,
+        "members": first["members"],
+        "layer_bytes": first["layer_bytes"],
+        "input_bytes": first["input_bytes"],
+        "output_bytes": first["output_bytes"],
+        "index_files_per_s": (
+            first["members"] / timings["index"] if timings["index"] else None
+        ),
+        "squash_files_per_s": (
+            first["members"] / timings["squash"] if timings["squash"] else None
+        ),
+        "squash_mb_per_s": mb / timings["squash"] if timings["squash"] else None,
+        "total_mb_per_s": mb / timings["total"] if timings["total"] else None,
+        "peak_rss": max(r["peak_rss"] or 0 for r in runs) or None,
+    }
+
+
+def _print_result(name: str, result: dict, baseline: Optional[dict]) -> None:
+    print(
+        f"{name}: {result['members']} files, "
+        f"{result['layer_bytes'] / 1024 / 1024:.1f} MB"
+    )
+    for phase in PHASES:
+        value = result["timings"][phase]
+        line = f"  {phase:<9} {value:8.3f} s"
+        if baseline and phase in baseline.get("timings", {}):
+            old = baseline["timings"][phase]
+            if value:
+                line += f"   baseline {old:8.3f} s  ({old / value:5.2f}x)"
+        print(line)
+    rss = result["peak_rss"]
+    rss_text = f"{rss / 1024 / 1024:.0f} MB" if rss else "n/a"
+    print(
+        f"  index {result['index_files_per_s'] or 0:,.0f} files/s, "
+        f"squash {result['squash_files_per_s'] or 0:,.0f} files/s, "
+        f"{result['squash_mb_per_s'] or 0:.1f} MB/s, peak RSS {rss_text}"
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    p = argparse.ArgumentParser(description="Benchmark oci-squash on synthetic images")
+    p.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run (repeatable). Default: all",
+    )
+    p.add_argument(
+        "--images-dir",
+        default=str(ROOT / ".bench-images"),
+        help="Where generated images are kept between runs",
+    )
+    p.add_argument(
+        "-f", "--from-layer", help="Layers to squash, as for oci-squash. Default: all"
+    )
+    p.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    p.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Runs per scenario (median)"
+    )
+    p.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the files per layer of every scenario",
+    )
+    p.add_argument("-o", "--output", help="Write results as JSON to this file")
+    p.add_argument(
+        "-b", "--baseline", help="JSON results of an earlier run to compare against"
+    )
+    p.add_argument("--worker", help=argparse.SUPPRESS)
+    args = p.parse_args(argv)
+
+    if args.worker:
+        result = run_worker(Path(args.worker), args.from_layer, args.jobs)
+        json.dump(result, sys.stdout)
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+
+    images_dir = Path(args.images_dir)
+    results = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        spec = SCENARIOS[name]
+        if args.scale != 1.0:
+            spec = replace(
+                spec, files_per_layer=max(1, int(spec.files_per_layer * args.scale))
+            )
+        results[name] = bench_scenario(
+            name, spec, images_dir, args.from_layer, args.jobs, args.repeat
+        )
+        _print_result(name, results[name], baseline.get(name))
+
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "jobs": args.jobs,
+                "repeat": args.repeat,
+                "from_layer": args.from_layer,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import List
+
+MTIME = 1577836800  # 2020-01-01
+
+
+@dataclass
+class ImageSpec:
+    """Shape of a synthetic image; ratios are shares of the entries of a layer."""
+
+    layers: int = 6
+    files_per_layer: int = 2000
+    depth: int = 4
+    fanout: int = 4  # subdirectories per directory level
+    size_dist: str = "exp"  # exp, lognormal or fixed
+    mean_size: int = 4096
+    overwrite_ratio: float = 0.2  # files replacing a path of an older layer
+    whiteout_ratio: float = 0.02
+    opaque_ratio: float = 0.005
+    hardlink_ratio: float = 0.02
+    symlink_ratio: float = 0.03
+    format: str = "docker"  # docker or oci
+    compress: bool = True  # gzip OCI layer blobs
+    seed: int = 0
+
+    def key(self) -> str:
+        data = json.dumps(asdict(self), sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()[:12]
+
+
+class _Payload:
+    """Cheap pseudo-random file content sliced from a fixed random block."""
+
+    def __init__(self, rng: random.Random, size: int = 1 << 20):
+        self._block = rng.getrandbits(size * 8).to_bytes(size, "little")
+        self._rng = rng
+
+    def read(self, size: int) -> bytes:
+        parts = []
+        while size > 0:
+            n = min(size, len(self._block))
+            start = self._rng.randrange(len(self._block) - n + 1)
+            parts.append(self._block[start : start + n])
+            size -= n
+        return b"".join(parts)
+
+
+def _file_size(spec: ImageSpec, rng: random.Random) -> int:
+    if spec.size_dist == "fixed":
+        return spec.mean_size
+    if spec.size_dist == "lognormal":
+        # Median of mean/4 with a long tail, like typical package trees
+        return int(rng.lognormvariate(0, 1.5) * spec.mean_size / 3.08)
+    return int(rng.expovariate(1 / spec.mean_size)) if spec.mean_size else 0
+
+
+def _random_dir(spec: ImageSpec, rng: random.Random) -> str:
+    depth = rng.randint(1, spec.depth)
+    return "/".join(f"d{rng.randrange(spec.fanout)}" for _ in range(depth))
+
+
+def _info(name: str, type_: bytes = tarfile.REGTYPE) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.type = type_
+    info.mtime = MTIME
+    info.mode = 0o755 if type_ == tarfile.DIRTYPE else 0o644
+    return info
+
+
+class _LayerWriter:
+    def __init__(self, path: Path):
+        self.tar = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+        self.dirs = set()
+        self.names = set()
+
+    def add_dir(self, path: str) -> None:
+        parts = path.split("/")
+        for i in range(1, len(parts) + 1):
+            d = "/".join(parts[:i])
+            if d not in self.dirs:
+                self.dirs.add(d)
+                self.tar.addfile(_info(d, tarfile.DIRTYPE))
+
+    def add(self, info: tarfile.TarInfo, data: bytes = b"") -> bool:
+        if info.name in self.names:
+            return False
+        self.add_dir(os.path.dirname(info.name))
+        self.names.add(info.name)
+        if info.isreg():
+            info.size = len(data)
+            self.tar.addfile(info, _BytesReader(data))
+        else:
+            self.tar.addfile(info)
+        return True
+
+    def close(self) -> None:
+        self.tar.close()
+
+
+class _BytesReader:
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = len(self._data) - self._pos
+        chunk = self._data[self._pos : self._pos + size]
+        self._pos += len(chunk)
+        return bytes(chunk)
+
+
+def _write_layer(
+    spec: ImageSpec,
+    rng: random.Random,
+    payload: _Payload,
+    index: int,
+    older: List[str],
+    path: Path,
+) -> List[str]:
+    """Write one layer tar and return the new regular file paths it adds."""
+    layer = _LayerWriter(path)
+    files: List[str] = []
+    added: List[str] = []
+    thresholds = []
+    total = 0.0
+    for kind, ratio in (
+        ("whiteout", spec.whiteout_ratio),
+        ("opaque", spec.opaque_ratio),
+        ("hardlink", spec.hardlink_ratio),
+        ("symlink", spec.symlink_ratio),
+        ("overwrite", spec.overwrite_ratio),
+    ):
+        total += ratio
+        thresholds.append((total, kind))
+
+    for n in range(spec.files_per_layer):
+        r = rng.random()
+        kind = next((k for t, k in thresholds if r < t), "file")
+        if kind == "whiteout" and older:
+            # Swap-remove so the victim is not whited out twice
+            i = rng.randrange(len(older))
+            victim = older[i]
+            if victim in layer.names:
+                continue
+            older[i] = older[-1]
+            older.pop()
+            d, base = os.path.split(victim)
+            layer.add(_info(f"{d}/.wh.{base}" if d else f".wh.{base}"))
+        elif kind == "opaque" and index > 0:
+            layer.add(_info(f"{_random_dir(spec, rng)}/.wh..wh..opq"))
+        elif kind == "hardlink" and files:
+            info = _info(f"{_random_dir(spec, rng)}/h{index}_{n}", tarfile.LNKTYPE)
+            info.linkname = rng.choice(files)
+            layer.add(info)
+        elif kind == "symlink":
+            info = _info(f"{_random_dir(spec, rng)}/l{index}_{n}", tarfile.SYMTYPE)
+            info.linkname = rng.choice(["../d0", "/usr/lib", "f0", "../../d1/f1"])
+            layer.add(info)
+        else:
+            new = not (kind == "overwrite" and older)
+            if new:
+                name = f"{_random_dir(spec, rng)}/f{index}_{n}"
+            else:
+                name = rng.choice(older)
+            if layer.add(_info(name), payload.read(_file_size(spec, rng))):
+                files.append(name)
+                if new:
+                    added.append(name)
+    layer.close()
+    return added
+
+
+def _sha256_file(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def generate(out: Path, spec: ImageSpec) -> Path:
+    """Write a synthetic image tar described by ``spec`` to ``out``."""
+    rng = random.Random(spec.seed)
+    payload = _Payload(rng)
+    work = Path(tempfile.mkdtemp(prefix="oci-squash-bench-"))
+    try:
+        layer_paths: List[Path] = []
+        older: List[str] = []
+        for i in range(spec.layers):
+            path = work / f"{i}.tar"
+            older.extend(_write_layer(spec, rng, payload, i, older, path))
+            layer_paths.append(path)
+        diff_ids = [f"sha256:{_sha256_file(p)}" for p in layer_paths]
+        config = {
+            "architecture": "amd64",
+            "os": "linux",
+            "created": "2020-01-01T00:00:00Z",
+            "config": {"Env": ["PATH=/usr/bin"], "Cmd": ["/bin/sh"]},
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+            "history": [
+                {"created": "2020-01-01T00:00:00Z", "created_by": f"RUN layer {i}"}
+                for i in range(spec.layers)
+            ],
+        }
+        config_data = json.dumps(config).encode()
+        config_digest = hashlib.sha256(config_data).hexdigest()
+
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp_out = out.with_suffix(".tmp")
+        with tarfile.open(tmp_out, "w") as tar:
+
+            def add_bytes(name: str, data: bytes) -> None:
+                info = _info(name)
+                info.size = len(data)
+                tar.addfile(info, _BytesReader(data))
+
+            def add_file(name: str, path: Path) -> None:
+                info = _info(name)
+                info.size = path.stat().st_size
+                with open(path, "rb") as f:
+                    tar.addfile(info, f)
+
+            if spec.format == "oci":
+                descriptors = []
+                for path in layer_paths:
+                    media_type = "application/vnd.oci.image.layer.v1.tar"
+                    if spec.compress:
+                        gz_path = path.with_suffix(".tar.gz")
+                        with open(path, "rb") as src, gzip.GzipFile(
+                            gz_path, "wb", compresslevel=1, mtime=0
+                        ) as dst:
+                            shutil.copyfileobj(src, dst, 1 << 20)
+                        path = gz_path
+                        media_type += "+gzip"
+                    digest = _sha256_file(path)
+                    add_file(f"blobs/sha256/{digest}", path)
+                    descriptors.append(
+                        {
+                            "mediaType": media_type,
+                            "digest": f"sha256:{digest}",
+                            "size": path.stat().st_size,
+                        }
+                    )
+                add_bytes(f"blobs/sha256/{config_digest}", config_data)
+                manifest = json.dumps(
+                    {
+                        "schemaVersion": 2,
+                        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                        "config": {
+                            "mediaType": "application/vnd.oci.image.config.v1+json",
+                            "digest": f"sha256:{config_digest}",
+                            "size": len(config_data),
+                        },
+                        "layers": descriptors,
+                    }
+                ).encode()
+                manifest_digest = hashlib.sha256(manifest).hexdigest()
+                add_bytes(f"blobs/sha256/{manifest_digest}", manifest)
+                index = {
+                    "schemaVersion": 2,
+                    "manifests": [
+                        {
+                            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                            "digest": f"sha256:{manifest_digest}",
+                            "size": len(manifest),
+                        }
+                    ],
+                }
+                add_bytes("index.json", json.dumps(index).encode())
+                add_bytes("oci-layout", b'{"imageLayoutVersion":"1.0.0"}')
+            else:
+                layers = []
+                for path, diff_id in zip(layer_paths, diff_ids):
+                    layer_dir = diff_id.split(":", 1)[1]
+                    add_bytes(f"{layer_dir}/VERSION", b"1.0")
+                    add_bytes(
+                        f"{layer_dir}/json", json.dumps({"id": layer_dir}).encode()
+                    )
+                    add_file(f"{layer_dir}/layer.tar", path)
+                    layers.append(f"{layer_dir}/layer.tar")
+                add_bytes(f"{config_digest}.json", config_data)
+                manifest = [
+                    {
+                        "Config": f"{config_digest}.json",
+                        "RepoTags": ["bench/synthetic:latest"],
+                        "Layers": layers,
+                    }
+                ]
+                add_bytes("manifest.json", json.dumps(manifest).encode())
+        os.replace(tmp_out, out)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return out
+
+
+def _str2bool(v: str) -> bool:
+    return v.strip().lower() in ("1", "true", "t", "yes", "y")
+
+
+def add_spec_arguments(p: argparse.ArgumentParser) -> None:
+    """Add one option per ``ImageSpec`` field, e.g. ``--files-per-layer``."""
+    for f in fields(ImageSpec):
+        kind = _str2bool if f.type is bool else f.type
+        p.add_argument(
+            "--" + f.name.replace("_", "-"), type=kind, help=f"Default: {f.default}"
+        )
+
+
+def spec_from_args(
+    args: argparse.Namespace, base: ImageSpec = ImageSpec()
+) -> ImageSpec:
+    values = asdict(base)
+    for f in fields(ImageSpec):
+        value = getattr(args, f.name, None)
+        if value is not None:
+            values[f.name] = value
+    return ImageSpec(**values)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Generate a synthetic Docker/OCI image tar")
+    p.add_argument("output", help="Path of the image tar to write")
+    add_spec_arguments(p)
+    args = p.parse_args()
+    spec = spec_from_args(args)
+    generate(Path(args.output), spec)
+    print(json.dumps(asdict(spec)))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,16 @@
 
 This package provides a Docker/OCI image layer squashing implementation that
 operates purely on image tar archives using only the Python standard library.
+``squash_image`` squashes an image in-process; ``cli`` wraps it.
 """
 
+from .api import SquashResult, squash_image
+from .errors import SquashError, SquashUnnecessaryError
+
 __all__ = [
+    "SquashError",
+    "SquashResult",
+    "SquashUnnecessaryError",
     "cli",
+    "squash_image",
 ]
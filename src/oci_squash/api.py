@@ -0,0 +1,620 @@
+import logging
+import os
+import secrets
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, List, Optional, Union
+
+from . import archive
+from .batch import select_images, squash_images
+from .cache import SquashCache
+from .compress import DEFAULT_LEVEL
+from .detector import detect_format
+from .errors import SquashError, SquashUnnecessaryError
+from .formats import (
+    ImageMeta,
+    LayerBlob,
+    copy_preserved_layers,
+    layer_tar_name,
+    platform_matches,
+    platform_name,
+    read_docker_images,
+    read_docker_metadata,
+    read_oci_images,
+    read_oci_metadata,
+    read_oci_platforms,
+    write_docker_manifest,
+    write_oci_layout,
+    verify_diff_ids,
+    write_repositories,
+)
+from .layers import LayerIndex
+from .metadata import (
+    config_json,
+    source_diff_ids,
+    squash_created,
+    update_config_and_history,
+    write_config_and_get_image_id,
+)
+from .platforms import ImageResult, ImageSquash, squash_platforms
+from .squash import (
+    SquashAnalysis,
+    SquashBoundary,
+    analyze_squash,
+    choose_boundary,
+    squash_layers,
+)
+from .stats import PhaseStats, Stats
+from .warmcache import WarmCache
+from .workarea import WorkArea
+
+PathOrFile = Union[str, "os.PathLike[str]", BinaryIO]
+
+log = logging.getLogger("oci_squash")
+
+
+@dataclass
+class SquashResult:
+    """Outcome of ``squash_image``."""
+
+    # Of the output image, or of its image index with all_platforms; None on
+    # dry runs
+    image_id: Optional[str]
+    output: Optional[Path]  # None if written to a file object or on dry runs
+    metas: List[ImageMeta]  # of each image or platform to squash
+    images: List[ImageResult]  # each squashed image or platform
+    analyses: List[SquashAnalysis]  # of each image, on dry runs
+    input_size: int
+    output_size: Optional[int]
+    phases: Dict[str, PhaseStats]
+    stats: dict = field(repr=False)  # the metrics of --stats-json
+
+    @property
+    def diff_ids(self) -> List[str]:
+        """diff_ids of the layers of the (first) image."""
+        return self.images[0].diff_ids if self.images else []
+
+    @property
+    def layers(self) -> List[LayerBlob]:
+        """Layers of the (first) image, with their size in the output."""
+        return self.images[0].layers if self.images else []
+
+
+def _mb(size: int) -> str:
+    return "%.2f MB" % (size / 1024 / 1024)
+
+
+def _log_boundary(boundary: SquashBoundary, all_layers) -> None:
+    log.info("Cut       Reclaimed    Rewritten          Net")
+    for number, reclaimed, rewritten in boundary.candidates:
+        log.info(
+            f"{number:>3}  {_mb(reclaimed):>12} {_mb(rewritten):>12} "
+            f"{_mb(reclaimed - rewritten):>12}"
+            + ("  <- chosen" if number == boundary.number else "")
+        )
+    log.info(
+        f"Auto boundary: squashing the last {boundary.number} layers, from "
+        f"{all_layers[-boundary.number]}; reclaims {_mb(boundary.reclaimed)} of "
+        f"shadowed or deleted files and rewrites {_mb(boundary.rewritten)}, "
+        f"keeping the {len(all_layers) - boundary.number} layers below, down to "
+        "the base layer, intact"
+    )
+
+
+def image_label(meta: ImageMeta, platform: bool) -> str:
+    if platform:
+        return f"Platform {platform_name(meta.platform)}"
+    return f"Image {', '.join(meta.repo_tags) or '<untagged>'}"
+
+
+def compute_layers_to_squash(all_layers, from_layer):
+    total = len(all_layers)
+    if from_layer is None:
+        number = total
+    else:
+        try:
+            number = int(from_layer)
+        except (TypeError, ValueError):
+            if from_layer in all_layers:
+                number = total - all_layers.index(from_layer) - 1
+            else:
+                raise SquashError(f"Layer not found: {from_layer}")
+    if number <= 0 or number > total:
+        raise SquashError(f"Invalid number of layers to squash: {number}")
+    marker = total - number
+    to_keep = all_layers[:marker]
+    to_squash = all_layers[marker:]
+    if len(to_squash) < 1:
+        raise SquashError("Invalid number of layers to squash: 0")
+    if len(to_squash) == 1:
+        raise SquashUnnecessaryError(
+            "Single layer marked to squash, no squashing is required"
+        )
+    return to_keep, to_squash
+
+
+def _layer_digests(meta: ImageMeta, warm: Optional[WarmCache]) -> Dict[str, str]:
+    if warm is not None:
+        return warm.layer_digests(meta)
+    return source_diff_ids(meta.config, meta.real_layer_ids)
+
+
+def _squash_single(
+    image: ImageSquash,
+    source,
+    writer,
+    work: WorkArea,
+    jobs: int,
+    cache: Optional[SquashCache],
+    gzip_level: Optional[int],
+    message: str,
+    repo_tags: Optional[List[str]],
+    parts: int,
+    max_layer_size: Optional[int],
+    reproducible: bool,
+    epoch: Optional[int],
+    warm: Optional[WarmCache],
+    indexed: Dict[str, LayerIndex],
+) -> ImageResult:
+    meta, to_keep, to_squash = image
+    digests = _layer_digests(meta, warm)
+    # Stream preserved layers into the output image, hashing on the way
+    written: Dict[str, LayerBlob] = {}
+    layers = copy_preserved_layers(
+        source,
+        writer,
+        meta.oci,
+        to_keep,
+        gzip_level=gzip_level,
+        jobs=jobs,
+        diff_ids=digests,
+        written=written,
+    )
+    if warm is not None:
+        warm.remember(meta, digests, written)
+
+    squashed, kept_real = squash_layers(
+        to_squash,
+        to_keep,
+        source,
+        writer,
+        meta.oci,
+        work,
+        jobs,
+        cache=cache,
+        digests=digests,
+        gzip_level=gzip_level,
+        parts=parts,
+        max_layer_size=max_layer_size,
+        reproducible=reproducible,
+        clamp_mtime=epoch,
+        indexed=indexed,
+        warm=warm,
+    )
+    layers.extend(squashed)
+
+    with writer.stats.phase("config"):
+        # Update config and history
+        new_config = update_config_and_history(
+            meta.config,
+            to_keep,
+            [layer.diff_id for layer in layers],
+            message,
+            len(squashed),
+            created=squash_created(meta.config, reproducible, epoch),
+        )
+        oci_output = gzip_level is not None
+        image_id, config_name = write_config_and_get_image_id(
+            writer, new_config, oci=oci_output
+        )
+        config_size = len(config_json(new_config))
+
+        # Manifest + repositories
+        if oci_output:
+            write_oci_layout(
+                writer, config_name, config_size, layers, repo_tags=repo_tags
+            )
+        else:
+            write_docker_manifest(
+                writer,
+                config_name,
+                to_keep,
+                meta.oci,
+                squashed_layers=[layer.name for layer in squashed],
+                repo_tags=repo_tags,
+            )
+        if repo_tags:
+            write_repositories(writer, image_id, repo_tags)
+    return ImageResult(meta, image_id, config_name, config_size, layers, len(squashed))
+
+
+def _create_partial(directory: Path) -> Path:
+    """Create an empty file for the output image in ``directory``.
+
+    Unlike ``mkstemp``, which creates it with mode 0600, this gives it the
+    mode of any new file (0666 less the umask), as it is renamed into place.
+    """
+    while True:
+        path = directory / f".oci-squash-{secrets.token_hex(8)}.tar"
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            return path
+        except FileExistsError:
+            continue
+
+
+def squash_image(
+    image: PathOrFile,
+    output: Optional[PathOrFile] = None,
+    *,
+    from_layer: Union[int, str, None] = None,
+    min_reclaim: int = 0,
+    tag: Optional[str] = None,
+    message: str = "",
+    output_format: Optional[str] = None,
+    platform: Optional[str] = None,
+    all_platforms: bool = False,
+    all_images: bool = False,
+    select: Optional[List[str]] = None,
+    compression_level: int = DEFAULT_LEVEL,
+    split: int = 1,
+    max_layer_size: Optional[int] = None,
+    jobs: Optional[int] = None,
+    memory_budget: int = 256 * 1024**2,
+    tmp_dir: Union[str, "os.PathLike[str]", None] = None,
+    cleanup: bool = True,
+    cache_dir: Union[str, "os.PathLike[str]", None] = None,
+    cache_size: int = 10 * 1024**3,
+    verify: bool = False,
+    reproducible: bool = False,
+    source_date_epoch: Optional[int] = None,
+    dry_run: bool = False,
+    on_phase: Optional[Callable[[str, PhaseStats], None]] = None,
+    on_event: Optional[Callable[[str], None]] = None,
+    measure_disk: bool = False,
+    stats: Optional[Stats] = None,
+    warm: Optional[WarmCache] = None,
+) -> SquashResult:
+    """Squash the image tar ``image`` into ``output`` and describe the result.
+
+    ``image`` and ``output`` are paths or binary file objects; an input
+    file object is spooled once, like a pipe. Without ``output`` the image
+    is written next to the input as ``squashed-<image id>.tar``. The other
+    options are those of the command line, with sizes in bytes;
+    ``from_layer`` is a number of layers, a layer id or ``"auto"``, all
+    layers by default. ``source_date_epoch`` is the creation time of a
+    ``reproducible`` squash.
+
+    ``on_phase`` is called with the name and metrics of each phase as it
+    ends and ``on_event`` with each progress message. ``measure_disk``
+    samples the peak disk usage of the work directory. A given ``stats``
+    collects the metrics instead, with its own callbacks; ``warm`` keeps
+    layer indexes and diff_ids for later squashes in the same process.
+
+    Raises ``SquashError``, or ``SquashUnnecessaryError`` if there is only
+    one layer to squash.
+    """
+    from_file = not isinstance(image, (str, os.PathLike))
+    to_file = output is not None and not isinstance(output, (str, os.PathLike))
+    image_tar = Path("-") if from_file else Path(image)  # type: ignore[arg-type]
+    if not from_file and not image_tar.exists():
+        raise SquashError(f"Input tar not found: {image_tar}")
+    epoch = source_date_epoch if reproducible else None
+    if all_platforms and platform:
+        raise SquashError("--platform and --all-platforms are mutually exclusive")
+    if all_platforms and output_format == "docker":
+        raise SquashError("--all-platforms requires OCI output")
+    if output_format not in (None, "docker", "oci"):
+        raise SquashError(f"Invalid output format: {output_format}")
+    output_format = output_format or ("oci" if all_platforms else "docker")
+    batch = all_images or bool(select)
+    if batch and all_platforms:
+        raise SquashError("--all-images and --all-platforms are mutually exclusive")
+    if batch and tag:
+        raise SquashError("--tag cannot be used with --all-images")
+    multi = batch or all_platforms
+    if split < 1:
+        raise SquashError(f"Invalid number of squashed layers: {split}")
+    if max_layer_size is not None and max_layer_size <= 0:
+        raise SquashError(f"Invalid maximum layer size: {max_layer_size}")
+    jobs = jobs or os.cpu_count() or 1
+
+    # Scratch files stay in memory within the budget; the work directory is
+    # only created if something spills
+    work = WorkArea(Path(tmp_dir) if tmp_dir else None, memory_budget)
+    log.debug(f"Work root: {work.root}")
+
+    # The image is written in one pass; its default name depends on the new
+    # image id, so write to a temporary file next to the destination first.
+    partial_path = None
+    if not to_file and not dry_run:
+        out_dir = Path(output).parent if output else image_tar.parent  # type: ignore
+        out_dir.mkdir(parents=True, exist_ok=True)
+        partial_path = _create_partial(out_dir)
+
+    if stats is None:
+        stats = Stats(on_phase=on_phase, on_event=on_event)
+    stats.info.update(image=str(image_tar), jobs=jobs, status="failed")
+    if measure_disk:
+        stats.watch_work_dir(work.root)
+
+    source = None
+    cache = None
+    metas: List[ImageMeta] = []
+    results: List[ImageResult] = []
+    analyses: List[SquashAnalysis] = []
+    image_id = None
+    input_size = 0
+    output_path = None
+    output_size = None
+    try:
+        log.info(f"Reading tar: {'<stdin>' if from_file else image_tar}")
+        # Members are read in place; only compressed tars get extracted to old/.
+        # A piped image is spooled once, since layers precede its manifest.
+        input_tar = image_tar
+        with stats.phase("open") as phase:
+            if from_file:
+                source = archive.open_stream(image, work)  # type: ignore[arg-type]
+                input_tar = source.path
+                phase.bytes_read += input_tar.stat().st_size
+            else:
+                source = archive.open_image(image_tar, work.root / "old")
+        input_size = input_tar.stat().st_size
+        with stats.phase("detect"):
+            fmt = detect_format(source)
+        log.info(f"Detected format: {fmt}")
+        with stats.phase("metadata"):
+            if batch:
+                if fmt == "oci":
+                    metas = read_oci_images(source, platform)
+                else:
+                    metas = read_docker_images(source)
+                    if platform:
+                        metas = [
+                            m for m in metas if platform_matches(m.platform, platform)
+                        ]
+                if select:
+                    metas = select_images(metas, select)
+                if not metas:
+                    raise SquashError("No images to squash")
+            elif all_platforms and fmt == "oci":
+                metas = read_oci_platforms(source)
+            elif fmt == "oci":
+                metas = [read_oci_metadata(source, platform)]
+            else:
+                metas = [read_docker_metadata(source)]
+                if platform and not platform_matches(metas[0].platform, platform):
+                    raise SquashError(f"Platform not found in image: {platform}")
+
+        # Layers indexed by analyze_squash, reused by the squash that follows
+        indexed: Dict[str, LayerIndex] = {}
+        images = []
+        for meta in metas:
+            if multi:
+                log.info(image_label(meta, all_platforms))
+            cut = from_layer
+            if cut == "auto":
+                # Header-level accounting of the whole image gives every cut's cost
+                with stats.phase("boundary"):
+                    analysis = analyze_squash(
+                        meta.layer_ids,
+                        [],
+                        source,
+                        meta.oci,
+                        work,
+                        jobs,
+                        stats,
+                        digests=_layer_digests(meta, warm),
+                        warm=warm,
+                        indexed=indexed,
+                    )
+                    boundary = choose_boundary(meta.layer_ids, analysis, min_reclaim)
+                _log_boundary(boundary, meta.layer_ids)
+                if not multi:
+                    stats.info.update(boundary=asdict(boundary))
+                cut = boundary.number
+            to_keep, to_squash = compute_layers_to_squash(meta.layer_ids, cut)
+            log.info(f"Attempting to squash last {len(to_squash)} layers")
+            images.append(ImageSquash(meta, to_keep, to_squash))
+        stats.info.update(
+            format=fmt, output_format=output_format, reproducible=reproducible
+        )
+        if not multi:
+            stats.info.update(
+                layers_squashed=len(images[0].to_squash),
+                layers_kept=len(images[0].to_keep),
+            )
+
+        if cache_dir:
+            cache = SquashCache(Path(cache_dir), cache_size)
+            log.debug(f"Using squash cache: {cache_dir}")
+
+        gzip_level = compression_level if output_format == "oci" else None
+        if dry_run:
+            for meta, to_keep, to_squash in images:
+                analyses.append(
+                    analyze_squash(
+                        to_squash,
+                        to_keep,
+                        source,
+                        meta.oci,
+                        work,
+                        jobs,
+                        stats,
+                        cache=cache,
+                        digests=_layer_digests(meta, warm),
+                        warm=warm,
+                        indexed=indexed,
+                    )
+                )
+            stats.info.update(status="ok", analysis=asdict(analyses[0]))
+            if multi:
+                stats.info.update(analysis=[asdict(a) for a in analyses])
+        else:
+            if verify:
+                with stats.phase("verify") as phase:
+                    for meta, to_keep, _ in images:
+                        digests = _layer_digests(meta, warm)
+                        kept = {lid: digests[lid] for lid in to_keep if lid in digests}
+                        verify_diff_ids(source, meta.oci, kept, jobs)
+                        phase.entries += len(kept)
+                        phase.bytes_read += sum(
+                            source.size(layer_tar_name(meta.oci, lid)) for lid in kept
+                        )
+            mtime = (epoch or 0) if reproducible else None
+            if to_file:
+                writer = archive.StreamWriter(output, work, stats, mtime=mtime)
+            else:
+                writer = archive.ImageWriter(partial_path, stats, mtime=mtime)
+            repo_tags = [tag] if tag else None
+            with writer:
+                if all_platforms:
+                    # One manifest per platform under a multi-platform image index
+                    image_id, results = squash_platforms(
+                        images,
+                        source,
+                        writer,
+                        work,
+                        jobs,
+                        cache=cache,
+                        gzip_level=compression_level,
+                        message=message,
+                        repo_tags=repo_tags,
+                        parts=split,
+                        max_layer_size=max_layer_size,
+                        reproducible=reproducible,
+                        clamp_mtime=epoch,
+                        warm=warm,
+                        indexed=indexed,
+                    )
+                elif batch:
+                    # One manifest.json entry per image, sharing the layers they have
+                    # in common
+                    results = squash_images(
+                        images,
+                        source,
+                        writer,
+                        work,
+                        jobs,
+                        cache=cache,
+                        gzip_level=gzip_level,
+                        message=message,
+                        parts=split,
+                        max_layer_size=max_layer_size,
+                        reproducible=reproducible,
+                        clamp_mtime=epoch,
+                        warm=warm,
+                        indexed=indexed,
+                    )
+                    image_id = results[0].image_id
+                else:
+                    results = [
+                        _squash_single(
+                            images[0],
+                            source,
+                            writer,
+                            work,
+                            jobs,
+                            cache,
+                            gzip_level,
+                            message,
+                            repo_tags,
+                            split,
+                            max_layer_size,
+                            reproducible,
+                            epoch,
+                            warm,
+                            indexed,
+                        )
+                    ]
+                    image_id = results[0].image_id
+
+                # Export
+                with stats.phase("pack"):
+                    writer.close()
+                    if not to_file:
+                        output_path = (
+                            Path(output)  # type: ignore[arg-type]
+                            if output
+                            else image_tar.parent
+                            / f"squashed-{image_id.split(':', 1)[1][:12]}.tar"
+                        )
+                        log.info(f"Exporting to: {output_path}")
+                        os.replace(partial_path, output_path)
+            if batch:
+                for r in results:
+                    log.info(f"Done. {image_label(r.meta, False)}: {r.image_id}")
+            else:
+                log.info(f"Done. New image id: {image_id}")
+            stats.info.update(
+                status="ok", output=str(output_path or "-"), image_id=image_id
+            )
+            if all_platforms:
+                stats.info["platforms"] = [
+                    {
+                        "platform": platform_name(r.meta.platform),
+                        "image_id": r.image_id,
+                        "diff_ids": r.diff_ids,
+                        "squashed_layers": r.squashed_layers,
+                    }
+                    for r in results
+                ]
+            elif batch:
+                stats.info["images"] = [
+                    {
+                        "repo_tags": r.meta.repo_tags,
+                        "image_id": r.image_id,
+                        "diff_ids": r.diff_ids,
+                        "squashed_layers": r.squashed_layers,
+                    }
+                    for r in results
+                ]
+            else:
+                stats.info.update(
+                    diff_ids=results[0].diff_ids,
+                    squashed_layers=results[0].squashed_layers,
+                )
+            # Size comparison (compressed tar sizes)
+            output_size = writer.tell()
+            stats.info.update(input_bytes=input_size, output_bytes=output_size)
+            try:
+                in_mb = input_size / 1024 / 1024
+                out_mb = output_size / 1024 / 1024
+                log.info("Original tar size: %.2f MB" % in_mb)
+                log.info("Squashed tar size: %.2f MB" % out_mb)
+                if output_size <= input_size and input_size > 0:
+                    saved_pct = ((in_mb - out_mb) / in_mb) * 100.0
+                    log.info("Tar size decreased by %.2f %%" % saved_pct)
+                elif output_size > input_size and input_size > 0:
+                    inc_pct = ((out_mb - in_mb) / in_mb) * 100.0
+                    log.info("Tar size increased by %.2f %%" % inc_pct)
+            except Exception:
+                # Best-effort; do not fail the run if size check fails
+                pass
+    except Exception as e:
+        stats.info["error"] = str(e)
+        raise
+    finally:
+        stats.close()
+        stats.info.update(peak_work_memory_bytes=work.peak)
+        if cache is not None:
+            cache.close()
+        if source is not None:
+            source.close()
+        if partial_path is not None and partial_path.exists():
+            partial_path.unlink()
+        work.close(remove=cleanup)
+        if cleanup:
+            log.debug(f"Removed work root: {work.root}")
+        log.info("Squashed image Done.")
+    return SquashResult(
+        image_id,
+        output_path,
+        metas,
+        results,
+        analyses,
+        input_size,
+        output_size,
+        stats.phases,
+        stats.as_dict(),
+    )
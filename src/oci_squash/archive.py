@@ -1,9 +1,24 @@
+import bz2
+import contextlib
+import errno
+import io
+import lzma
 import os
+import shutil
 import tarfile
+import time
+import zlib
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Callable, Dict, Iterator, Optional, Tuple, Union
 
 from .errors import SquashError
+from .pipeline import Hasher
+from .stats import Stats
+from .workarea import WorkArea, WorkFile
+
+_CHUNK = 1048576
+# Ranges are copied in steps of this size, each queued for hashing once copied
+_STEP = 64 * _CHUNK
 
 
 def extract(tar_path: Path, dest_dir: Path) -> None:
@@ -17,11 +32,657 @@ def extract(tar_path: Path, dest_dir: Path) -> None:
         raise SquashError(f"Failed to extract tar file: {e}")
 
 
-def pack(src_dir: Path, out_tar: Path) -> None:
-    out_tar.parent.mkdir(parents=True, exist_ok=True)
-    with tarfile.open(out_tar, "w", format=tarfile.PAX_FORMAT) as tar:
-        for root, _, files in os.walk(src_dir):
-            for name in files:
-                path = Path(root) / name
-                arcname = path.relative_to(src_dir)
-                tar.add(path, arcname=str(arcname))
+def _member_name(name: str) -> str:
+    return os.path.normpath(name).lstrip("/")
+
+
+class _RangeReader(io.RawIOBase):
+    """Seekable read-only view of ``size`` bytes at ``offset`` in ``fd``.
+
+    Reads use ``os.pread`` so any number of views can share one descriptor.
+    """
+
+    def __init__(
+        self, fd: int, offset: int, size: int, name: str, closefd: bool = False
+    ):
+        self._fd = fd
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+        self._closefd = closefd
+        self.name = name
+
+    def close(self) -> None:
+        if not self.closed and self._closefd:
+            os.close(self._fd)
+        super().close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            new_pos = pos
+        elif whence == io.SEEK_CUR:
+            new_pos = self._pos + pos
+        elif whence == io.SEEK_END:
+            new_pos = self._size + pos
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if new_pos < 0:
+            raise ValueError(f"Negative seek position: {new_pos}")
+        self._pos = new_pos
+        return new_pos
+
+    def readinto(self, b) -> int:
+        remaining = self._size - self._pos
+        if remaining <= 0:
+            return 0
+        n = min(len(b), remaining)
+        data = os.pread(self._fd, n, self._offset + self._pos)
+        b[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def open_range(path: str, offset: int, size: int) -> BinaryIO:
+    """Open ``size`` bytes at ``offset`` of ``path`` as a buffered, seekable file."""
+    fd = os.open(path, os.O_RDONLY)
+    return io.BufferedReader(
+        _RangeReader(fd, offset, size, path, closefd=True), buffer_size=_CHUNK
+    )
+
+
+class DirSource:
+    """Image contents extracted to a directory."""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def exists(self, name: str) -> bool:
+        return (self.root / name).is_file()
+
+    def size(self, name: str) -> int:
+        return (self.root / name).stat().st_size
+
+    def locate(self, name: str) -> Tuple[str, int, int]:
+        """Return the file path, offset and size holding the member's bytes."""
+        return str(self.root / name), 0, self.size(name)
+
+    def open(self, name: str) -> BinaryIO:
+        path = self.root / name
+        if not path.is_file():
+            raise SquashError(f"File not found in image: {name}")
+        return open(path, "rb")
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+
+class TarSource:
+    """Image contents read in place from an uncompressed image tar.
+
+    The tar headers are scanned once; members are then served as seekable
+    byte-range views into the original file, so nothing is extracted.
+    """
+
+    def __init__(self, tar_path: Path):
+        self.path = tar_path
+        self._members: Dict[str, Tuple[int, int]] = {}
+        self._fd = os.open(tar_path, os.O_RDONLY)
+        try:
+            self._scan()
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _scan(self) -> None:
+        links: Dict[str, str] = {}
+        with open(self._fd, "rb", closefd=False) as f:
+            with tarfile.open(fileobj=f, mode="r:") as tar:
+                for member in tar:
+                    name = _member_name(member.name)
+                    if member.isreg():
+                        self._members[name] = (member.offset_data, member.size)
+                    elif member.islnk():
+                        links[name] = _member_name(member.linkname)
+                    elif member.issym():
+                        target = os.path.join(os.path.dirname(name), member.linkname)
+                        links[name] = _member_name(target)
+        for name, target in links.items():
+            seen = set()
+            while target in links and target not in seen:
+                seen.add(target)
+                target = links[target]
+            if target in self._members:
+                self._members[name] = self._members[target]
+
+    def exists(self, name: str) -> bool:
+        return _member_name(name) in self._members
+
+    def size(self, name: str) -> int:
+        entry = self._members.get(_member_name(name))
+        if entry is None:
+            raise SquashError(f"File not found in image: {name}")
+        return entry[1]
+
+    def locate(self, name: str) -> Tuple[str, int, int]:
+        """Return the file path, offset and size holding the member's bytes."""
+        entry = self._members.get(_member_name(name))
+        if entry is None:
+            raise SquashError(f"File not found in image: {name}")
+        return str(self.path), entry[0], entry[1]
+
+    def open(self, name: str) -> BinaryIO:
+        entry = self._members.get(_member_name(name))
+        if entry is None:
+            raise SquashError(f"File not found in image: {name}")
+        offset, size = entry
+        return io.BufferedReader(
+            _RangeReader(self._fd, offset, size, name), buffer_size=_CHUNK
+        )
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+
+def open_image(tar_path: Path, work_dir: Optional[Path] = None):
+    """Open an image tar for reading without extracting it when possible.
+
+    Compressed image tars cannot be read by offset; they are extracted into
+    ``work_dir`` instead.
+    """
+    if not tar_path.exists():
+        raise SquashError(f"Tar file not found: {tar_path}")
+    try:
+        return TarSource(tar_path)
+    except tarfile.ReadError:
+        if work_dir is None:
+            raise SquashError(f"Unable to read tar file in place: {tar_path}")
+    extract(tar_path, work_dir)
+    return DirSource(work_dir)
+
+
+def open_stream(src: BinaryIO, work: WorkArea) -> TarSource:
+    """Open an image tar read from a stream such as stdin.
+
+    A pipe cannot be read by offset, so the stream is spooled to a file of
+    ``work`` once, decompressing it on the way if needed.
+    """
+    if not hasattr(src, "peek"):
+        src = io.BufferedReader(src, buffer_size=_CHUNK)
+    factory = detect_compression(src.peek(8)[:8])
+    out = work.create("input.tar")
+    if factory is None:
+        shutil.copyfileobj(src, out, _CHUNK)
+    else:
+        for chunk in iter_decompressed(src, factory):
+            out.write(chunk)
+    try:
+        return TarSource(Path(out.path))
+    except tarfile.ReadError as e:
+        raise SquashError(f"Unable to read image tar from stream: {e}")
+
+
+# Magic bytes of the layer compressions tarfile's "r:*" mode understands
+_DECOMPRESSORS = (
+    (b"\x1f\x8b", lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    (b"BZh", bz2.BZ2Decompressor),
+    (b"\xfd7zXZ\x00", lzma.LZMADecompressor),
+)
+
+
+def detect_compression(head: bytes) -> Optional[Callable]:
+    """Return a decompressor factory for the stream starting with ``head``."""
+    for magic, factory in _DECOMPRESSORS:
+        if head.startswith(magic):
+            return factory
+    return None
+
+
+def iter_decompressed(src: BinaryIO, factory: Callable) -> Iterator[bytes]:
+    """Decompress ``src`` as a stream, including concatenated members."""
+    d = factory()
+    limited = isinstance(d, type(zlib.decompressobj()))
+    data = b""
+    while True:
+        if not data:
+            data = src.read(_CHUNK)
+            if not data:
+                break
+        if d.eof:
+            # Ignore zero padding after the last member, like GzipFile does
+            if not data.strip(tarfile.NUL):
+                data = b""
+                continue
+            d = factory()
+        if limited:
+            out = d.decompress(data, _CHUNK)
+            data = d.unused_data if d.eof else d.unconsumed_tail
+        else:
+            out = d.decompress(data)
+            data = d.unused_data if d.eof else b""
+        if out:
+            yield out
+    if limited:
+        out = d.flush()
+        if out:
+            yield out
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, dst_offset: int, count: int):
+    """Copy ``count`` bytes between descriptors without passing them through Python.
+
+    Uses ``copy_file_range`` (which can share extents on reflink-capable
+    filesystems), then ``sendfile``, then plain ``pread``/``pwrite``.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    while count > 0:
+        if copy_file_range is not None:
+            try:
+                n = copy_file_range(src_fd, dst_fd, count, offset, dst_offset)
+            except OSError as e:
+                if e.errno not in (
+                    errno.EXDEV,
+                    errno.ENOSYS,
+                    errno.EINVAL,
+                    errno.EOPNOTSUPP,
+                    errno.EBADF,
+                ):
+                    raise
+                copy_file_range = None
+                continue
+        elif sendfile is not None:
+            try:
+                os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+                n = sendfile(dst_fd, src_fd, offset, min(count, 0x7FFFF000))
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                sendfile = None
+                continue
+        else:
+            data = os.pread(src_fd, min(count, _CHUNK), offset)
+            n = os.pwrite(dst_fd, data, dst_offset) if data else 0
+        if n == 0:
+            raise SquashError("Unexpected end of data while copying")
+        offset += n
+        dst_offset += n
+        count -= n
+
+
+def _send_range(src_fd: int, out: BinaryIO, offset: int, count: int) -> None:
+    """Append ``count`` bytes at ``offset`` of ``src_fd`` to the stream ``out``.
+
+    Uses ``sendfile``, which also works for pipes, when ``out`` has a
+    descriptor; otherwise the bytes are read and written in chunks.
+    """
+    out.flush()
+    try:
+        out_fd = out.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        out_fd = -1
+    sendfile = getattr(os, "sendfile", None) if out_fd >= 0 else None
+    while count > 0:
+        if sendfile is not None:
+            try:
+                n = sendfile(out_fd, src_fd, offset, min(count, 0x7FFFF000))
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                sendfile = None
+                continue
+        else:
+            data = os.pread(src_fd, min(count, _CHUNK), offset)
+            if data:
+                out.write(data)
+            n = len(data)
+        if n == 0:
+            raise SquashError("Unexpected end of data while copying")
+        offset += n
+        count -= n
+
+
+class _EntryWriter:
+    """File-like sink for one output tar member that hashes data as it passes.
+
+    Hashing runs on a background thread, overlapping the writes. ``reserve``
+    is called with the end offset of in-kernel copies before they are made.
+    """
+
+    def __init__(self, f: BinaryIO, reserve: Optional[Callable[[int], None]] = None):
+        self._f = f
+        self._reserve = reserve
+        self._hasher = Hasher()
+        self.offset = f.tell()
+        self.size = 0
+        self.digest: Optional[str] = None
+
+    def write(self, data) -> int:
+        self._f.write(data)
+        self._hasher.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def copy_range(self, src_fd: int, offset: int, size: int) -> None:
+        """Append ``size`` bytes of ``src_fd`` at ``offset``, copied in-kernel.
+
+        Copied bytes never pass through Python; the hashing thread reads
+        them back from the output file while the next ones are written.
+        """
+        self._f.flush()
+        pos = self._f.tell()
+        if self._reserve is not None:
+            self._reserve(pos + size)
+        _copy_range(src_fd, self._f.fileno(), offset, pos, size)
+        self._f.seek(pos + size)
+        self._hasher.update_range(self._f.fileno(), pos, size)
+        self.size += size
+
+    def tell(self) -> int:
+        return self.size
+
+    def finish(self, stats: Stats) -> str:
+        """Wait for the hashing thread and set ``digest``."""
+        self._f.flush()
+        if self._hasher.bytes_read:
+            with stats.phase("hash") as phase:
+                self.digest = self._hasher.hexdigest()
+                phase.bytes_read += self._hasher.bytes_read
+        else:
+            self.digest = self._hasher.hexdigest()
+        return self.digest
+
+    def abort(self) -> None:
+        self._hasher.close()
+
+
+class ImageWriter:
+    """Writes the output image tar in a single pass.
+
+    Members are streamed straight into the tar and SHA-256 hashed on the way,
+    so layer diff_ids are known as soon as each layer has been written.
+    Member headers carry ``mtime``, the current time by default.
+    """
+
+    def __init__(
+        self, out_tar: Path, stats: Optional[Stats] = None, mtime: Optional[int] = None
+    ):
+        out_tar.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(out_tar, "w+b")
+        self._mtime = int(time.time()) if mtime is None else mtime
+        self._size = 0  # final size, once closed
+        self._blobs: Dict[str, int] = {}  # content-addressed name -> data offset
+        self.stats = stats if stats is not None else Stats()
+        self.stats.track_output(self.tell)
+
+    def tell(self) -> int:
+        if self._f.closed:
+            return self._size
+        return self._f.tell()
+
+    def _header(self, name: str, size: int) -> bytes:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = self._mtime
+        # Sizes that do not fit the ustar field are stored base-256 (GNU) so the
+        # header stays a single block and can be rewritten in place.
+        fmt = tarfile.PAX_FORMAT if size < 8**11 else tarfile.GNU_FORMAT
+        buf = info.tobuf(fmt, "utf-8", "surrogateescape")
+        if len(buf) != tarfile.BLOCKSIZE:
+            raise SquashError(f"Unsupported output member name: {name}")
+        return buf
+
+    def _pad(self, size: int) -> None:
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self._f.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add_file(
+        self, name: str, data: Union[bytes, BinaryIO], size: Optional[int] = None
+    ) -> str:
+        """Add a member of known size and return the SHA-256 of its content."""
+        if isinstance(data, bytes):
+            size = len(data)
+            data = io.BytesIO(data)
+        if size is None:
+            raise ValueError("size is required for file objects")
+        self._f.write(self._header(name, size))
+        entry = _EntryWriter(self._f)
+        try:
+            shutil.copyfileobj(data, entry, _CHUNK)
+        except BaseException:
+            entry.abort()
+            raise
+        digest = entry.finish(self.stats)
+        if entry.size != size:
+            raise SquashError(f"Unexpected size for {name}: {entry.size} != {size}")
+        self._pad(size)
+        return digest
+
+    def add_range(
+        self,
+        name: str,
+        path: str,
+        offset: int,
+        size: int,
+        digest: Optional[str] = None,
+    ) -> str:
+        """Add ``size`` bytes at ``offset`` of ``path`` as a member, copied in-kernel.
+
+        Returns the SHA-256 of the copied content; it is only computed when
+        ``digest`` is not already known, on a thread that hashes each step
+        of the copy while the next one is in flight.
+        """
+        self._f.write(self._header(name, size))
+        src_fd = os.open(path, os.O_RDONLY)
+        hasher = Hasher() if digest is None else None
+        try:
+            done = 0
+            while done < size:
+                n = min(size - done, _STEP)
+                self._put_range(src_fd, offset + done, n)
+                if hasher is not None:
+                    hasher.update_range(src_fd, offset + done, n)
+                done += n
+            if hasher is not None:
+                with self.stats.phase("hash") as phase:
+                    digest = hasher.hexdigest()
+                    phase.bytes_read += size
+        finally:
+            if hasher is not None:
+                hasher.close()
+            os.close(src_fd)
+        self._pad(size)
+        return digest
+
+    def _put_range(self, src_fd: int, offset: int, size: int) -> None:
+        self._f.flush()
+        pos = self._f.tell()
+        _copy_range(src_fd, self._f.fileno(), offset, pos, size)
+        self._f.seek(pos + size)
+
+    @contextlib.contextmanager
+    def add_stream(self, name: str) -> Iterator[_EntryWriter]:
+        """Add a member whose size is only known once it has been written.
+
+        A placeholder header is written first and rewritten once the
+        content is complete; the entry's ``digest`` is set on exit. A
+        ``{digest}`` placeholder in ``name`` is replaced by that digest, for
+        content-addressed names; content that was already written under its
+        name is dropped again, and ``offset`` points at the first copy.
+        """
+        header_pos = self._f.tell()
+        self._f.write(tarfile.NUL * tarfile.BLOCKSIZE)
+        entry = _EntryWriter(self._f)
+        try:
+            yield entry
+        except BaseException:
+            entry.abort()
+            raise
+        entry.finish(self.stats)
+        if self._written(name, entry):
+            self._f.seek(header_pos)
+            self._f.truncate()
+            return
+        self._pad(entry.size)
+        end_pos = self._f.tell()
+        self._f.seek(header_pos)
+        self._f.write(self._header(name.replace("{digest}", entry.digest), entry.size))
+        self._f.seek(end_pos)
+
+    def _written(self, name: str, entry: _EntryWriter) -> bool:
+        """Tell if the content-addressed ``name`` of ``entry`` was written before,
+        pointing the entry at that copy if so."""
+        if "{digest}" not in name:
+            return False
+        name = name.replace("{digest}", entry.digest)
+        if name in self._blobs:
+            entry.offset = self._blobs[name]
+            return True
+        self._blobs[name] = entry.offset
+        return False
+
+    def export(self, offset: int, size: int, dest: Path) -> None:
+        """Copy ``size`` bytes already written at ``offset`` into the file ``dest``."""
+        self._f.flush()
+        with open(dest, "wb") as out:
+            _copy_range(self._f.fileno(), out.fileno(), offset, 0, size)
+
+    def close(self) -> None:
+        if self._f.closed:
+            return
+        # End-of-archive marker, padded to a full record like tarfile does
+        self._f.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self._f.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self._f.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        self._size = self._f.tell()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+
+class _StreamOutput:
+    """Non-seekable output stream that keeps count of the bytes written."""
+
+    def __init__(self, out: BinaryIO):
+        self._out = out
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._out.write(data)
+        self._pos += len(data)
+        return len(data)
+
+    def send(self, src_fd: int, offset: int, size: int) -> None:
+        _send_range(src_fd, self._out, offset, size)
+        self._pos += size
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        self._out.flush()
+
+    def close(self) -> None:
+        # The underlying stream (e.g. stdout) belongs to the caller
+        if not self.closed:
+            self._out.flush()
+            self.closed = True
+
+
+class StreamWriter(ImageWriter):
+    """Writes the output image tar to a non-seekable stream such as stdout.
+
+    Members of known size are written straight through as they are added.
+    Members added with ``add_stream`` need their size in the header, so they
+    are spooled to a file of ``work`` and sent once complete; only the last
+    one is kept, for ``export``.
+    """
+
+    def __init__(
+        self,
+        out: BinaryIO,
+        work: WorkArea,
+        stats: Optional[Stats] = None,
+        mtime: Optional[int] = None,
+    ):
+        self._f = _StreamOutput(out)  # type: ignore[assignment]
+        self._mtime = int(time.time()) if mtime is None else mtime
+        self._size = 0
+        self._work = work
+        self._spool: Optional[Tuple[WorkFile, int]] = None  # file, output offset
+        self._blobs: Dict[str, int] = {}
+        self.stats = stats if stats is not None else Stats()
+        self.stats.track_output(self.tell)
+
+    def _put_range(self, src_fd: int, offset: int, size: int) -> None:
+        self._f.send(src_fd, offset, size)
+
+    @contextlib.contextmanager
+    def add_stream(self, name: str) -> Iterator[_EntryWriter]:
+        self._drop_spool()
+        raw = self._work.create("spool")
+        try:
+            spool = io.BufferedRandom(raw, _CHUNK)
+            entry = _EntryWriter(spool, reserve=raw.reserve)
+            try:
+                yield entry
+            except BaseException:
+                entry.abort()
+                raise
+            entry.finish(self.stats)
+            spool.detach()
+            entry.offset = self._f.tell() + tarfile.BLOCKSIZE
+            if not self._written(name, entry):
+                name = name.replace("{digest}", entry.digest)
+                self._f.write(self._header(name, entry.size))
+                self._f.send(raw.fileno(), 0, entry.size)
+                self._pad(entry.size)
+        except BaseException:
+            raw.close()
+            raise
+        self._spool = (raw, entry.offset)
+
+    def _drop_spool(self) -> None:
+        if self._spool is not None:
+            self._spool[0].close()
+            self._spool = None
+
+    def export(self, offset: int, size: int, dest: Path) -> None:
+        if self._spool is None or self._spool[1] != offset:
+            raise SquashError("Only the last streamed member can be exported")
+        with open(dest, "wb") as out:
+            _copy_range(self._spool[0].fileno(), out.fileno(), 0, 0, size)
+
+    def close(self) -> None:
+        super().close()
+        self._drop_spool()
@@ -0,0 +1,118 @@
+from typing import Dict, List, Optional
+
+from .cache import SquashCache
+from .errors import SquashError
+from .formats import (
+    ImageMeta,
+    full_tag,
+    write_all_repositories,
+    write_docker_manifests,
+    write_index_json,
+    write_oci_manifest,
+)
+from .layers import LayerIndex
+from .platforms import ImageResult, ImageSquash, squash_each
+from .warmcache import WarmCache
+from .workarea import WorkArea
+
+
+def _source_image_id(meta: ImageMeta) -> str:
+    if meta.oci:
+        return meta.manifest["config"]["digest"].split(":", 1)[1]
+    return meta.manifest["Config"].rsplit("/", 1)[-1].split(".", 1)[0]
+
+
+def select_images(metas: List[ImageMeta], refs: List[str]) -> List[ImageMeta]:
+    """Return the images of ``metas`` named by ``refs``, in image order.
+
+    A ref is a tag of the image (``repo`` meaning ``repo:latest``) or a
+    prefix of its image id, with or without ``sha256:``.
+    """
+    selected = set()
+    for ref in refs:
+        image_id = ref.split(":", 1)[1] if ref.startswith("sha256:") else ref
+        matches = [
+            i
+            for i, meta in enumerate(metas)
+            if full_tag(ref) in map(full_tag, meta.repo_tags)
+            or (len(image_id) >= 4 and _source_image_id(meta).startswith(image_id))
+        ]
+        if not matches:
+            raise SquashError(f"Image not found: {ref}")
+        selected.update(matches)
+    return [meta for i, meta in enumerate(metas) if i in selected]
+
+
+def squash_images(
+    images: List[ImageSquash],
+    source,
+    writer,
+    work: WorkArea,
+    jobs: int = 1,
+    cache: Optional[SquashCache] = None,
+    gzip_level: Optional[int] = None,
+    message: str = "",
+    parts: int = 1,
+    max_layer_size: Optional[int] = None,
+    reproducible: bool = False,
+    clamp_mtime: Optional[int] = None,
+    warm: Optional[WarmCache] = None,
+    indexed: Optional[Dict[str, LayerIndex]] = None,
+) -> List[ImageResult]:
+    """Squash several images of one tar, e.g. a ``docker save`` of many images,
+    into one output image tar.
+
+    Images share their layer work as described for ``squash_each`` and keep
+    their own tags. Squashed layers of a Docker tar get content-addressed
+    names, ``<diff_id>/layer.tar``, so that the layers of each image stay
+    apart while identical ones are stored once. With ``gzip_level``, an OCI
+    image layout is written, with a ``manifest.json`` for ``docker load``.
+
+    Returns the result of each image.
+    """
+    stats = writer.stats
+    results = []
+    for result in squash_each(
+        images,
+        source,
+        writer,
+        work,
+        jobs,
+        cache,
+        gzip_level,
+        message,
+        parts,
+        max_layer_size,
+        reproducible,
+        clamp_mtime,
+        squashed_name="{digest}/layer.tar",
+        warm=warm,
+        indexed=indexed,
+    ):
+        stats.event(f"squashed {', '.join(result.meta.repo_tags) or result.image_id}")
+        if gzip_level is not None:
+            with stats.phase("config"):
+                result = result._replace(
+                    manifest=write_oci_manifest(
+                        writer, result.config_name, result.config_size, result.layers
+                    )
+                )
+        results.append(result)
+    with stats.phase("config"):
+        if gzip_level is not None:
+            write_index_json(writer, [(r.manifest, r.meta.repo_tags) for r in results])
+        write_docker_manifests(
+            writer,
+            [
+                {
+                    "Config": r.config_name,
+                    "RepoTags": r.meta.repo_tags,
+                    "Layers": [layer.name for layer in r.layers],
+                }
+                for r in results
+            ],
+        )
+        write_all_repositories(
+            writer, [(r.image_id, r.meta.repo_tags) for r in results]
+        )
+    return results
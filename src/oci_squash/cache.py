@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from .pathset import PathSet, write_path_set
+from .utils import ensure_dir
+
+_HEX_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+@dataclass
+class CacheEntry:
+    path: Path  # squashed layer.tar, or its gzip blob
+    size: int
+    diff_id: str
+    digest: str  # of the file as stored; the diff_id unless compressed
+
+
+def _chain_key(
+    keep: List[str], squash: List[str], compressed: bool = False, variant: str = ""
+) -> str:
+    key: Dict[str, object] = {"keep": keep, "squash": squash}
+    if compressed:
+        key["gzip"] = True
+    if variant:
+        key["variant"] = variant
+    data = json.dumps(key, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class SquashCache:
+    """On-disk cache of squashed layers keyed by the layer chain they were built from.
+
+    The squashed layer depends on the layers being squashed and, through
+    whiteout reinjection, on the preserved layers below them; both ordered
+    digest lists make up the key. Squashed layers written as gzip blobs are
+    cached separately from uncompressed ones. Entries are evicted least recently used
+    first once the cache grows beyond ``max_size`` bytes.
+
+    The cache also keeps the path set of each preserved layer, keyed by its
+    content digest, for whiteout reinjection; these are shared by all the
+    layer chains that layer is part of.
+    """
+
+    def __init__(self, root: Path, max_size: int):
+        self.root = root / "squash"
+        self.paths_root = root / "paths"
+        self.max_size = max_size
+        # Layer tars of the entries looked up, open until ``close``
+        self._held: List[Tuple[Path, BinaryIO]] = []
+        ensure_dir(self.root)
+        ensure_dir(self.paths_root)
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        return self.root / f"{key}.tar", self.root / f"{key}.json"
+
+    def _get(self, key: str, prefix: bool = False) -> Optional[CacheEntry]:
+        tar_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            # Entries stored before this was recorded may not be extendable
+            if prefix and not meta.get("extendable", False):
+                return None
+            held = open(tar_path, "rb")
+        except (OSError, ValueError):
+            return None
+        size = os.fstat(held.fileno()).st_size
+        if size != meta.get("size"):
+            held.close()
+            return None
+        # Bump the access time used for LRU eviction
+        os.utime(meta_path)
+        self._held.append((tar_path, held))
+        # Read it through the open file where /proc allows, so that it stays
+        # readable if another process evicts it meanwhile
+        path = Path(f"/proc/{os.getpid()}/fd/{held.fileno()}")
+        if not path.exists():
+            path = tar_path
+        return CacheEntry(
+            path, size, meta["diff_id"], meta.get("digest", meta["diff_id"])
+        )
+
+    def lookup(
+        self,
+        keep: List[str],
+        squash: List[str],
+        compressed: bool = False,
+        variant: str = "",
+    ) -> Tuple[Optional[CacheEntry], int]:
+        """Find the entry for the longest cached prefix of ``squash``.
+
+        Entries written with another ``variant`` of the output are ignored,
+        and so are entries that are not ``extendable`` (see ``store``) unless
+        they cover all of ``squash``.
+        Returns the entry and the number of layers of ``squash`` it covers,
+        or ``(None, 0)`` when nothing usable is cached.
+        """
+        for n in range(len(squash), 0, -1):
+            entry = self._get(
+                _chain_key(keep, squash[:n], compressed, variant), n < len(squash)
+            )
+            if entry is not None:
+                return entry, n
+        return None, 0
+
+    def store(
+        self,
+        keep: List[str],
+        squash: List[str],
+        writer,
+        entry,
+        compressed: bool = False,
+        diff_id: Optional[str] = None,
+        variant: str = "",
+        extendable: bool = False,
+    ) -> None:
+        """Store the squashed layer ``entry`` just written by ``writer``.
+
+        A ``compressed`` entry needs the ``diff_id`` of the uncompressed layer.
+        Only an ``extendable`` entry is used as the bottom layer of a squash
+        of more layers; others stand for their whole layer chain alone.
+        """
+        key = _chain_key(keep, squash, compressed, variant)
+        tar_path, meta_path = self._paths(key)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=self.root)
+        os.close(fd)
+        try:
+            writer.export(entry.offset, entry.size, Path(tmp))
+            os.replace(tmp, tar_path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        meta = {
+            "keep": keep,
+            "squash": squash,
+            "size": entry.size,
+            "diff_id": diff_id or entry.digest,
+            "digest": entry.digest,
+            "extendable": extendable,
+        }
+        fd, tmp_meta = tempfile.mkstemp(prefix=".tmp-", dir=self.root)
+        try:
+            with open(fd, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_meta, meta_path)
+        finally:
+            if os.path.exists(tmp_meta):
+                os.unlink(tmp_meta)
+        self.evict()
+
+    def _path_set_path(self, digest: str) -> Optional[Path]:
+        hex_digest = digest.split(":", 1)[-1]
+        if not _HEX_DIGEST.fullmatch(hex_digest):
+            return None
+        return self.paths_root / f"{hex_digest}.paths"
+
+    def path_set(self, digest: str) -> Optional[PathSet]:
+        """Open the cached path set of the layer with content ``digest``, if any."""
+        path = self._path_set_path(digest)
+        if path is None:
+            return None
+        paths = PathSet.open(path)
+        if paths is not None:
+            os.utime(path)
+        return paths
+
+    def store_path_set(self, digest: str, paths: Iterable[str]) -> Optional[PathSet]:
+        """Store the paths of the layer with content ``digest`` and open them."""
+        path = self._path_set_path(digest)
+        if path is None:
+            return None
+        write_path_set(path, paths)
+        self.evict()
+        return PathSet.open(path)
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits ``max_size``.
+
+        Entries looked up since the last ``close`` are kept, as the squash
+        may still read them.
+        """
+        in_use = {tar_path for tar_path, _ in self._held}
+        entries = []
+        total = 0
+        for meta_path in self.root.glob("*.json"):
+            tar_path = meta_path.with_suffix(".tar")
+            try:
+                size = tar_path.stat().st_size
+                used = meta_path.stat().st_mtime
+            except OSError:
+                continue
+            total += size
+            if tar_path not in in_use:
+                entries.append((used, size, (meta_path, tar_path)))
+        for path in self.paths_root.glob("*.paths"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, (path,)))
+            total += st.st_size
+        for _, size, paths in sorted(entries):
+            if total <= self.max_size:
+                break
+            for p in paths:
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            total -= size
+
+    def close(self) -> None:
+        """Release the entries looked up, once the squash no longer reads them."""
+        for _, held in self._held:
+            held.close()
+        self._held.clear()
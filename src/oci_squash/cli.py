@@ -1,27 +1,17 @@
 import argparse
 import logging
-import shutil
-import tempfile
+import os
+import sys
 from pathlib import Path
+from typing import List, Mapping, Optional, TextIO
 
-from . import archive
-from .detector import detect_format
-from .errors import SquashError, SquashUnnecessaryError
-from .formats import (
-    copy_preserved_layers,
-    layer_tar_path as fmt_layer_tar_path,
-    read_docker_metadata,
-    read_oci_metadata,
-    write_docker_manifest,
-    write_repositories,
-)
-from .metadata import (
-    compute_diff_ids,
-    update_config_and_history,
-    write_config_and_get_image_id,
-)
-from .squash import squash_layers
+from .api import SquashResult, image_label, squash_image
+from .compress import DEFAULT_LEVEL
+from .errors import SquashError
+from .squash import SquashAnalysis
+from .stats import Stats
 from .utils import setup_logger
+from .warmcache import WarmCache
 
 
 def _str2bool(v: str) -> bool:
@@ -35,10 +25,34 @@ def _str2bool(v: str) -> bool:
     raise argparse.ArgumentTypeError("Boolean value expected (true/false)")
 
 
-def parse_args():
+def _parse_size(v: str) -> int:
+    s = str(v).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    try:
+        if s and s[-1] in units:
+            return int(float(s[:-1]) * units[s[-1]])
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size: {v}")
+
+
+def build_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(description="OCI/Docker image tar layer squashing tool")
-    p.add_argument("image", help="Path to image tar file")
-    p.add_argument("-f", "--from-layer", help="Number of layers to squash or layer id")
+    p.add_argument("image", help="Path to image tar file, or - to read it from stdin")
+    p.add_argument(
+        "-f",
+        "--from-layer",
+        help="Number of layers to squash, layer id, or auto to pick the cut "
+        "above the base layer that reclaims the most bytes for the least "
+        "rewritten ones",
+    )
+    p.add_argument(
+        "--min-reclaim",
+        type=_parse_size,
+        default="0",
+        help="With --from-layer auto, only squash if at least this much is "
+        "reclaimed, e.g. 10M. Default: 0",
+    )
     p.add_argument("-t", "--tag", help="Tag for squashed image, e.g. repo/name:tag")
     p.add_argument(
         "-c",
@@ -53,137 +67,249 @@ def parse_args():
         "-m", "--message", default="", help="Commit message for the new image"
     )
     p.add_argument("--tmp-dir", help="Work directory to use (kept if provided)")
-    p.add_argument("-o", "--output-path", help="Output tar path for the squashed image")
+    p.add_argument(
+        "--memory-budget",
+        type=_parse_size,
+        default="256M",
+        help="Keep scratch files in memory up to this total size and spill them "
+        "to the work directory beyond it, e.g. 1G; 0 keeps them on disk. "
+        "Default: 256M",
+    )
+    p.add_argument(
+        "-o",
+        "--output-path",
+        help="Output tar path for the squashed image, or - to write it to stdout",
+    )
+    p.add_argument(
+        "--output-format",
+        choices=("docker", "oci"),
+        help="Write a Docker image tar with uncompressed layers, or an OCI image "
+        "layout with gzip-compressed layers. Default: docker, or oci with "
+        "--all-platforms",
+    )
+    p.add_argument(
+        "--platform",
+        metavar="OS/ARCH[/VARIANT]",
+        help="Squash this platform of a multi-platform image, e.g. linux/arm64. "
+        "Default: the first platform",
+    )
+    p.add_argument(
+        "--all-platforms",
+        action="store_true",
+        help="Squash every platform of a multi-platform OCI image into one "
+        "multi-platform OCI image",
+    )
+    p.add_argument(
+        "--all-images",
+        action="store_true",
+        help="Squash every image of a tar holding several, such as a docker save "
+        "of many images, into one tar; each image keeps its own tags",
+    )
+    p.add_argument(
+        "--select",
+        action="append",
+        metavar="REF",
+        help="Squash only the image with this tag or image id of a tar holding "
+        "several; repeat for more images. Implies --all-images",
+    )
+    p.add_argument(
+        "--compression-level",
+        type=int,
+        choices=range(0, 10),
+        default=DEFAULT_LEVEL,
+        metavar="{0-9}",
+        help=f"Gzip level of the layers of OCI output. Default: {DEFAULT_LEVEL}",
+    )
+    p.add_argument(
+        "--split",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Split the squashed result into N layers of about the same size, "
+        "which runtimes pull and unpack in parallel. Default: 1",
+    )
+    p.add_argument(
+        "--max-layer-size",
+        type=_parse_size,
+        help="Split the squashed result into as many layers as needed to keep "
+        "each under this size where possible, e.g. 1G",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes used to scan and decompress layers, "
+        "and of threads used to compress them. Default: number of CPUs",
+    )
+    p.add_argument(
+        "--cache-dir",
+        help="Directory of the squashed layer cache, keyed by layer chain (disabled if not set)",
+    )
+    p.add_argument(
+        "--cache-size",
+        type=_parse_size,
+        default="10G",
+        help="Maximum size of the squashed layer cache, e.g. 500M or 20G. Default: 10G",
+    )
+    p.add_argument(
+        "--verify",
+        action="store_true",
+        help="Re-hash preserved layers in parallel and check them against the "
+        "diff_ids of the source config, instead of trusting those",
+    )
+    p.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only analyze the squash from the layer tar headers: print the "
+        "bytes each layer loses or keeps, the whiteouts that would be "
+        "reinjected and the projected sizes, without writing an image",
+    )
+    p.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Write byte-identical output for identical input: sorted entries, "
+        "normalized headers, and timestamps from SOURCE_DATE_EPOCH (mtimes "
+        "clamped to it) or else from the source image",
+    )
+    p.add_argument(
+        "--stats-json",
+        help="Write per-phase timings, throughput, peak memory and work dir "
+        "disk usage to this JSON file",
+    )
+    p.add_argument(
+        "--progress",
+        action="store_true",
+        help="Report phase and layer progress with timings on stderr",
+    )
     p.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
-    return p.parse_args()
-
-
-def compute_layers_to_squash(all_layers, from_layer):
-    total = len(all_layers)
-    if from_layer is None:
-        number = total
-    else:
-        try:
-            number = int(from_layer)
-        except (TypeError, ValueError):
-            if from_layer in all_layers:
-                number = total - all_layers.index(from_layer) - 1
-            else:
-                raise SquashError(f"Layer not found: {from_layer}")
-    if number <= 0 or number > total:
-        raise SquashError(f"Invalid number of layers to squash: {number}")
-    marker = total - number
-    to_keep = all_layers[:marker]
-    to_squash = all_layers[marker:]
-    if len(to_squash) < 1:
-        raise SquashError("Invalid number of layers to squash: 0")
-    if len(to_squash) == 1:
-        raise SquashUnnecessaryError(
-            "Single layer marked to squash, no squashing is required"
-        )
-    return to_keep, to_squash
+    return p
 
 
-def run():
-    args = parse_args()
-    log = setup_logger(args.verbose)
-    image_tar = Path(args.image)
-    if not image_tar.exists():
-        raise SquashError(f"Input tar not found: {image_tar}")
+def parse_args(argv: Optional[List[str]] = None):
+    return build_parser().parse_args(argv)
 
-    work_root = Path(args.tmp_dir) if args.tmp_dir else None
 
-    if work_root is None:
-        work_root = Path(tempfile.mkdtemp(prefix="oci-squash-"))
+def _mb(size: int) -> str:
+    return "%.2f MB" % (size / 1024 / 1024)
 
-    log.debug(f"Work root: {work_root}")
-    old_dir = work_root / "old"
-    new_dir = work_root / "new"
-    old_dir.mkdir(parents=True, exist_ok=True)
-    new_dir.mkdir(parents=True, exist_ok=True)
 
-    try:
-        log.info(f"Extracting tar: {image_tar}")
-        archive.extract(image_tar, old_dir)
-        fmt = detect_format(old_dir)
-        log.info(f"Detected format: {fmt}")
-        if fmt == "oci":
-            meta = read_oci_metadata(old_dir)
-        else:
-            meta = read_docker_metadata(old_dir)
-
-        to_keep, to_squash = compute_layers_to_squash(meta.layer_ids, args.from_layer)
-        log.info(f"Attempting to squash last {len(to_squash)} layers")
-
-        squashed_tar, kept_real = squash_layers(
-            to_squash, to_keep, old_dir, new_dir, meta.oci
+def _print_analysis(
+    analysis: SquashAnalysis, input_size: int, out: Optional[TextIO] = None
+) -> None:
+    out = out or sys.stdout
+    print(
+        f"{'Layer':<19}  {'Entries':>8}  {'Size':>11}  {'Surviving':>11}  "
+        f"{'Shadowed':>11}  {'Deleted':>11}",
+        file=out,
+    )
+    for layer in analysis.layers:
+        print(
+            f"{layer.layer_id.split(':')[-1][:19]:<19}  {layer.entries:>8}  "
+            f"{_mb(layer.size):>11}  {_mb(layer.surviving):>11}  "
+            f"{_mb(layer.shadowed):>11}  {_mb(layer.deleted):>11}",
+            file=out,
         )
+    print(
+        f"Squashed layer: {analysis.entries} entries, "
+        f"{_mb(analysis.squashed_size)}",
+        file=out,
+    )
+    print(f"Whiteouts reinjected: {len(analysis.whiteouts)}", file=out)
+    for name in analysis.whiteouts:
+        print(f"  {name}", file=out)
+    print(f"Preserved layers: {_mb(analysis.preserved_size)}", file=out)
+    print(
+        f"Projected output size: {_mb(analysis.output_size)} plus metadata "
+        f"(input {_mb(input_size)})",
+        file=out,
+    )
+
 
-        # Copy preserved layers into new image directory
-        copy_preserved_layers(old_dir, new_dir, meta.oci, to_keep)
+def _source_date_epoch(environ: Optional[Mapping[str, str]] = None) -> Optional[int]:
+    value = (os.environ if environ is None else environ).get("SOURCE_DATE_EPOCH", "")
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise SquashError(f"Invalid SOURCE_DATE_EPOCH: {value}")
 
-        # Build list of moved layer tar paths in new_root (real only)
-        moved_paths = []
-        for lid in to_keep:
-            if lid.startswith("<missing-"):
-                continue
-            # We always write Docker-style layers (<digest>/layer.tar) in the output
-            p = fmt_layer_tar_path(new_dir, False, lid)
-            if p and p.exists():
-                moved_paths.append(p)
 
-        diff_ids = compute_diff_ids(moved_paths, squashed_tar)
+def run(argv: Optional[List[str]] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        from .server import serve_main
 
-        # Update config and history
-        new_config = update_config_and_history(
-            meta.config, to_keep, diff_ids, args.message
-        )
-        image_id, config_name = write_config_and_get_image_id(new_dir, new_config)
-
-        # Manifest + repositories
-        repo_tags = [args.tag] if args.tag else None
-        write_docker_manifest(
-            new_dir,
-            config_name,
-            to_keep,
-            meta.oci,
-            add_squashed_layer=bool(squashed_tar),
-            repo_tags=repo_tags,
-        )
-        if repo_tags:
-            write_repositories(new_dir, image_id, repo_tags)
-
-        # Export
-        output_path = (
-            Path(args.output_path)
-            if args.output_path
-            else image_tar.parent / f"squashed-{image_id.split(':', 1)[1][:12]}.tar"
+        serve_main(argv[1:])
+        return
+    args = parse_args(argv)
+    setup_logger(args.verbose)
+    execute(args)
+
+
+def execute(
+    args: argparse.Namespace,
+    stats: Optional[Stats] = None,
+    warm: Optional[WarmCache] = None,
+    environ: Optional[Mapping[str, str]] = None,
+    out: Optional[TextIO] = None,
+) -> SquashResult:
+    """Squash an image as described by the command line ``args``.
+
+    ``stats`` collects the metrics of the run; by default it reports on
+    stderr with ``--progress``. ``warm`` keeps layer indexes and diff_ids
+    for later runs of the same process. ``SOURCE_DATE_EPOCH`` is read from
+    ``environ`` (``os.environ`` by default), and the dry-run report is
+    written to ``out`` (stdout by default).
+    """
+    to_stdout = args.output_path == "-"
+    if to_stdout and sys.stdout.isatty() and not args.dry_run:
+        raise SquashError("Refusing to write the image tar to a terminal")
+    if stats is None:
+        stats = Stats(progress=sys.stderr if args.progress else None)
+    try:
+        result = squash_image(
+            sys.stdin.buffer if args.image == "-" else args.image,
+            sys.stdout.buffer if to_stdout else args.output_path,
+            from_layer=args.from_layer,
+            min_reclaim=args.min_reclaim,
+            tag=args.tag,
+            message=args.message,
+            output_format=args.output_format,
+            platform=args.platform,
+            all_platforms=args.all_platforms,
+            all_images=args.all_images,
+            select=args.select,
+            compression_level=args.compression_level,
+            split=args.split,
+            max_layer_size=args.max_layer_size,
+            jobs=args.jobs,
+            memory_budget=args.memory_budget,
+            tmp_dir=args.tmp_dir,
+            cleanup=args.cleanup,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            verify=args.verify,
+            reproducible=args.reproducible,
+            source_date_epoch=(
+                _source_date_epoch(environ) if args.reproducible else None
+            ),
+            dry_run=args.dry_run,
+            measure_disk=bool(args.stats_json or args.progress),
+            stats=stats,
+            warm=warm,
         )
-        log.info(f"Exporting to: {output_path}")
-        archive.pack(new_dir, output_path)
-        log.info(f"Done. New image id: {image_id}")
-        # Size comparison (compressed tar sizes)
-        try:
-            in_sz = image_tar.stat().st_size
-            out_sz = Path(output_path).stat().st_size
-            in_mb = in_sz / 1024 / 1024
-            out_mb = out_sz / 1024 / 1024
-            log.info("Original tar size: %.2f MB" % in_mb)
-            log.info("Squashed tar size: %.2f MB" % out_mb)
-            if out_sz <= in_sz and in_sz > 0:
-                saved_pct = ((in_mb - out_mb) / in_mb) * 100.0
-                log.info("Tar size decreased by %.2f %%" % saved_pct)
-            elif out_sz > in_sz and in_sz > 0:
-                inc_pct = ((out_mb - in_mb) / in_mb) * 100.0
-                log.info("Tar size increased by %.2f %%" % inc_pct)
-        except Exception:
-            # Best-effort; do not fail the run if size check fails
-            pass
     finally:
-        if args.cleanup:
-            shutil.rmtree(work_root, ignore_errors=True)
-            log.debug(f"Removed work root: {work_root}")
-        log.info("Squashed image Done.")
+        if args.stats_json:
+            stats.write_json(Path(args.stats_json))
+    multi = args.all_platforms or args.all_images or bool(args.select)
+    for meta, analysis in zip(result.metas, result.analyses):
+        if multi:
+            print(f"{image_label(meta, args.all_platforms)}:", file=out)
+        _print_analysis(analysis, result.input_size, out)
+    return result
 
 
 if __name__ == "__main__":
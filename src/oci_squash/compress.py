@@ -0,0 +1,119 @@
+import collections
+import struct
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Optional
+
+from .pipeline import Hasher, read_ahead
+
+_BLOCK = 1048576
+_WINDOW = 32768
+# Fixed header: no name, mtime 0, unknown OS, so output only depends on input
+_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+DEFAULT_LEVEL = 6
+
+
+def _deflate(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    if dictionary:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class GzipWriter:
+    """Writes a gzip stream to ``out``, compressing blocks on ``jobs`` threads.
+
+    Like pigz, the input is cut into fixed-size blocks that are deflated
+    independently, each primed with the last 32 KiB of the previous block,
+    and the raw deflate streams are joined in order. zlib releases the GIL,
+    so blocks compress in parallel; the output does not depend on ``jobs``.
+
+    The uncompressed bytes are hashed on the way, on a thread of their own:
+    ``diff_id`` holds their SHA-256 once the writer is closed.
+    """
+
+    def __init__(
+        self,
+        out: BinaryIO,
+        level: int = DEFAULT_LEVEL,
+        jobs: int = 1,
+        block_size: int = _BLOCK,
+    ):
+        self._out = out
+        self._level = level
+        self._block_size = block_size
+        self._jobs = max(1, jobs)
+        self._pool = ThreadPoolExecutor(self._jobs) if self._jobs > 1 else None
+        self._pending: Deque[Future] = collections.deque()
+        self._buf = bytearray()
+        self._dictionary = b""
+        self._hasher = Hasher(crc=True)
+        self._size = 0
+        self.diff_id: Optional[str] = None
+        self.closed = False
+        out.write(_HEADER)
+
+    def write(self, data) -> int:
+        self._hasher.update(data)
+        self._size += len(data)
+        self._buf += data
+        while len(self._buf) >= self._block_size:
+            block = bytes(self._buf[: self._block_size])
+            del self._buf[: self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def copy_range(self, src_fd: int, offset: int, size: int) -> None:
+        """Append ``size`` bytes of ``src_fd`` at ``offset``, read ahead on a thread."""
+        for data in read_ahead(src_fd, offset, size, self._block_size):
+            self.write(data)
+
+    def tell(self) -> int:
+        """Uncompressed bytes written so far."""
+        return self._size
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        args = (block, self._dictionary, self._level, last)
+        self._dictionary = block[-_WINDOW:]
+        if self._pool is None:
+            self._out.write(_deflate(*args))
+            return
+        self._pending.append(self._pool.submit(_deflate, *args))
+        # Bound the compressed blocks held in memory
+        while len(self._pending) > 2 * self._jobs:
+            self._out.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self._buf), last=True)
+            self._buf = bytearray()
+            while self._pending:
+                self._out.write(self._pending.popleft().result())
+        finally:
+            self._shutdown()
+        crc = self._hasher.crc32()
+        self._out.write(struct.pack("<II", crc, self._size & 0xFFFFFFFF))
+        self.diff_id = self._hasher.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        if etype is None:
+            self.close()
+        else:
+            self._shutdown()
+            self._hasher.close()
+
+    def _shutdown(self) -> None:
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -1,14 +1,11 @@
-from pathlib import Path
 from typing import Literal
 
 from .errors import SquashError
 
 
-def detect_format(root: Path) -> Literal["docker", "oci"]:
-    index = root / "index.json"
-    manifest = root / "manifest.json"
-    if index.exists():
+def detect_format(source) -> Literal["docker", "oci"]:
+    if source.exists("index.json"):
         return "oci"
-    if manifest.exists():
+    if source.exists("manifest.json"):
         return "docker"
     raise SquashError("Unable to detect image format - missing manifest files")
@@ -1,10 +1,24 @@
+import hashlib
 import json
-from dataclasses import dataclass
-from pathlib import Path
-from typing import List, Optional
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
 
+from .archive import detect_compression, iter_decompressed
+from .compress import GzipWriter
 from .errors import SquashError
 
+DOCKER_LAYER = "application/vnd.docker.image.rootfs.diff.tar"
+OCI_LAYER_GZIP = "application/vnd.oci.image.layer.v1.tar+gzip"
+OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+_GZIP_MAGIC = b"\x1f\x8b"
+# buildx stores build attestations as manifests of the index next to the images
+_REFERENCE_TYPE = "vnd.docker.reference.type"
+
 
 @dataclass
 class ImageMeta:
@@ -13,22 +27,62 @@ class ImageMeta:
     layer_ids: List[str]  # includes placeholders for empty layers
     real_layer_ids: List[str]  # excludes placeholders
     oci: bool
+    platform: Dict[str, str] = field(default_factory=dict)  # os, architecture...
+    repo_tags: List[str] = field(default_factory=list)
+
+
+@dataclass
+class LayerBlob:
+    """A layer as written to the output image."""
+
+    name: str  # member name in the output tar
+    diff_id: str  # sha256:<hex> of the uncompressed layer tar
+    digest: str  # sha256:<hex> of the blob as stored
+    size: int
+    media_type: str = DOCKER_LAYER
 
 
-def _read_json(path: Path) -> dict:
-    with open(path, "r") as f:
+def _read_json(source, name: str) -> dict:
+    with source.open(name) as f:
         return json.load(f)
 
 
-def read_docker_metadata(root: Path) -> ImageMeta:
-    manifest_path = root / "manifest.json"
-    manifests = _read_json(manifest_path)
+def _config_platform(config: dict) -> Dict[str, str]:
+    return {k: config[k] for k in ("os", "architecture", "variant") if config.get(k)}
+
+
+def platform_name(platform: Dict[str, str]) -> str:
+    """Return ``platform`` as ``os/architecture[/variant]``."""
+    name = f"{platform.get('os', 'unknown')}/{platform.get('architecture', 'unknown')}"
+    return f"{name}/{platform['variant']}" if platform.get("variant") else name
+
+
+def platform_matches(platform: Dict[str, str], spec: str) -> bool:
+    """Tell if ``platform`` is ``spec``, e.g. ``linux/arm64`` or ``linux/arm/v7``.
+
+    Without a variant in ``spec``, any variant matches.
+    """
+    wanted = spec.split("/")
+    if len(wanted) not in (2, 3) or not all(wanted):
+        raise SquashError(f"Invalid platform: {spec} (expected os/arch[/variant])")
+    keys = ("os", "architecture", "variant")
+    return all(platform.get(k, "") == w for k, w in zip(keys, wanted))
+
+
+def read_docker_metadata(source) -> ImageMeta:
+    return read_docker_images(source)[0]
+
+
+def read_docker_images(source) -> List[ImageMeta]:
+    """Read the metadata of every image of ``manifest.json``, in order."""
+    manifests = _read_json(source, "manifest.json")
     if not manifests:
         raise SquashError("Empty manifest.json")
-    manifest = manifests[0]
+    return [_docker_meta(source, manifest) for manifest in manifests]
 
-    config_path = root / manifest["Config"]
-    config = _read_json(config_path)
+
+def _docker_meta(source, manifest: dict) -> ImageMeta:
+    config = _read_json(source, manifest["Config"])
 
     # Build layer ids from manifest layers (real only)
     real_layer_ids: List[str] = []
@@ -55,30 +109,97 @@ def read_docker_metadata(root: Path) -> ImageMeta:
         layer_ids=layer_ids,
         real_layer_ids=real_layer_ids,
         oci=False,
+        platform=_config_platform(config),
+        repo_tags=manifest.get("RepoTags") or [],
     )
 
 
-def read_oci_metadata(root: Path) -> ImageMeta:
-    index = _read_json(root / "index.json")
+def _image_manifests(source, descriptors: List[dict]) -> Iterator[Tuple[dict, dict]]:
+    """Yield the descriptor and content of each image manifest under
+    ``descriptors``, expanding nested indexes and skipping attestations."""
+    for descriptor in descriptors:
+        if descriptor.get("annotations", {}).get(_REFERENCE_TYPE):
+            continue
+        digest = descriptor["digest"].split(":", 1)[1]
+        manifest = _read_json(source, f"blobs/sha256/{digest}")
+        if manifest.get("mediaType") == OCI_INDEX or "manifests" in manifest:
+            if not manifest.get("manifests"):
+                raise SquashError("No manifests in nested index")
+            yield from _image_manifests(source, manifest["manifests"])
+        else:
+            yield descriptor, manifest
+
+
+def read_oci_platforms(source) -> List[ImageMeta]:
+    """Read the metadata of every image manifest of ``index.json``, in order."""
+    index = _read_json(source, "index.json")
+    if not index.get("manifests"):
+        raise SquashError("No manifests found in index.json")
+    metas = []
+    seen = set()  # tags of one image each get a descriptor
+    for descriptor, manifest in _image_manifests(source, index["manifests"]):
+        if descriptor["digest"] not in seen:
+            seen.add(descriptor["digest"])
+            metas.append(_oci_meta(source, manifest, descriptor.get("platform")))
+    if not metas:
+        raise SquashError("No image manifests found in index.json")
+    return metas
+
+
+def read_oci_metadata(source, platform: Optional[str] = None) -> ImageMeta:
+    """Read the metadata of the first image manifest of ``index.json``, or of
+    the first one for ``platform`` (see ``platform_matches``)."""
+    if platform is not None:
+        for meta in read_oci_platforms(source):
+            if platform_matches(meta.platform, platform):
+                return meta
+        raise SquashError(f"Platform not found in image: {platform}")
+    index = _read_json(source, "index.json")
     if not index.get("manifests"):
         raise SquashError("No manifests found in index.json")
-    manifest_desc = index["manifests"][0]
-    manifest_digest = manifest_desc["digest"].split(":", 1)[1]
-    manifest_path = root / "blobs" / "sha256" / manifest_digest
-    manifest = _read_json(manifest_path)
-
-    # Nested index support
-    if manifest.get("mediaType") == "application/vnd.oci.image.index.v1+json":
-        if not manifest.get("manifests"):
-            raise SquashError("No manifests in nested index")
-        nested_desc = manifest["manifests"][0]
-        nested_digest = nested_desc["digest"].split(":", 1)[1]
-        manifest = _read_json(root / "blobs" / "sha256" / nested_digest)
+    for descriptor, manifest in _image_manifests(source, index["manifests"]):
+        return _oci_meta(source, manifest, descriptor.get("platform"))
+    raise SquashError("No image manifests found in index.json")
+
 
+def read_oci_images(source, platform: Optional[str] = None) -> List[ImageMeta]:
+    """Read the metadata of every image of ``index.json``, in order.
+
+    Each descriptor of ``index.json`` is an image, named by its
+    ``io.containerd.image.name`` annotation; descriptors of the same image
+    are merged. Of a multi-platform image, the first platform is read, or
+    the first one for ``platform``; images without it are left out.
+    """
+    index = _read_json(source, "index.json")
+    if not index.get("manifests"):
+        raise SquashError("No manifests found in index.json")
+    images: Dict[str, ImageMeta] = {}
+    for top in index["manifests"]:
+        name = top.get("annotations", {}).get("io.containerd.image.name")
+        if top["digest"] in images:
+            meta = images[top["digest"]]
+        else:
+            meta = None
+            for descriptor, manifest in _image_manifests(source, [top]):
+                meta = _oci_meta(source, manifest, descriptor.get("platform"))
+                if platform is None or platform_matches(meta.platform, platform):
+                    break
+                meta = None
+            if meta is None:
+                continue
+            images[top["digest"]] = meta
+        if name and name not in meta.repo_tags:
+            meta.repo_tags.append(name)
+    if not images:
+        raise SquashError("No image manifests found in index.json")
+    return list(images.values())
+
+
+def _oci_meta(source, manifest: dict, platform: Optional[dict]) -> ImageMeta:
     if "config" not in manifest:
         raise SquashError("No config found in manifest")
     config_digest = manifest["config"]["digest"].split(":", 1)[1]
-    config = _read_json(root / "blobs" / "sha256" / config_digest)
+    config = _read_json(source, f"blobs/sha256/{config_digest}")
 
     # Real layers from manifest
     real_layer_ids: List[str] = [l["digest"] for l in manifest.get("layers", [])]
@@ -102,26 +223,26 @@ def read_oci_metadata(root: Path) -> ImageMeta:
         layer_ids=layer_ids,
         real_layer_ids=real_layer_ids,
         oci=True,
+        platform=dict(platform) if platform else _config_platform(config),
     )
 
 
-def layer_tar_path(root: Path, oci: bool, layer_id: str) -> Optional[Path]:
+def layer_tar_name(oci: bool, layer_id: str) -> Optional[str]:
     if layer_id.startswith("<missing-"):
         return None
+    digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
     if oci:
-        digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
-        return root / "blobs" / "sha256" / digest
+        return f"blobs/sha256/{digest}"
     else:
-        digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
-        return root / digest / "layer.tar"
+        return f"{digest}/layer.tar"
 
 
 def write_docker_manifest(
-    root: Path,
+    writer,
     config_json_name: str,
     moved_layers: List[str],
     oci_input: bool,
-    add_squashed_layer: bool,
+    squashed_layers: List[str],
     repo_tags: Optional[List[str]] = None,
 ) -> None:
     manifest = {
@@ -136,71 +257,309 @@ def write_docker_manifest(
         # Always write Docker-style layer paths in the output tar
         # so that `docker load` can consume it reliably.
         manifest["Layers"].append(f"{digest}/layer.tar")
-    if add_squashed_layer:
-        manifest["Layers"].append("squashed/layer.tar")
-    with open(root / "manifest.json", "w") as f:
-        json.dump([manifest], f, indent=2)
-
-
-def write_repositories(root: Path, image_id: str, repo_tags: List[str]) -> None:
-    repositories = {}
-    short_id = image_id.split(":", 1)[1] if ":" in image_id else image_id
-    for tag in repo_tags:
-        if ":" in tag:
-            repo, t = tag.rsplit(":", 1)
-        else:
-            repo, t = tag, "latest"
-        repositories.setdefault(repo, {})[t] = short_id
+    manifest["Layers"].extend(squashed_layers)
+    write_docker_manifests(writer, [manifest])
+
+
+def write_docker_manifests(writer, manifests: List[dict]) -> None:
+    """Write ``manifest.json``, listing one entry per image like ``docker save``."""
+    writer.add_file("manifest.json", json.dumps(manifests, indent=2).encode())
+
+
+def write_oci_manifest(
+    writer,
+    config_name: str,
+    config_size: int,
+    layers: List[LayerBlob],
+    platform: Optional[Dict[str, str]] = None,
+) -> dict:
+    """Write an OCI image manifest blob and return its descriptor."""
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": OCI_MANIFEST,
+        "config": {
+            "mediaType": OCI_CONFIG,
+            "digest": "sha256:" + config_name.rsplit("/", 1)[1],
+            "size": config_size,
+        },
+        "layers": [
+            {"mediaType": l.media_type, "digest": l.digest, "size": l.size}
+            for l in layers
+        ],
+    }
+    data = json.dumps(manifest, indent=2).encode()
+    manifest_digest = hashlib.sha256(data).hexdigest()
+    writer.add_file(f"blobs/sha256/{manifest_digest}", data)
+    descriptor = {
+        "mediaType": OCI_MANIFEST,
+        "digest": f"sha256:{manifest_digest}",
+        "size": len(data),
+    }
+    if platform:
+        descriptor["platform"] = platform
+    return descriptor
+
+
+def full_tag(tag: str) -> str:
+    """Return ``tag`` with ``:latest`` added if it names no tag."""
+    return tag if ":" in tag.rsplit("/", 1)[-1] else f"{tag}:latest"
+
+
+def write_index_json(writer, images: List[Tuple[dict, Optional[List[str]]]]) -> None:
+    """Write ``index.json`` and ``oci-layout``.
+
+    ``images`` are pairs of a manifest or index descriptor and the tags of
+    that image; the index lists the descriptor once per tag.
+    """
+    descriptors = []
+    for target, repo_tags in images:
+        for tag in repo_tags or [None]:
+            descriptor = dict(target)
+            if tag is not None:
+                tag = full_tag(tag)
+                descriptor["annotations"] = {
+                    "io.containerd.image.name": tag,
+                    "org.opencontainers.image.ref.name": tag.rsplit(":", 1)[1],
+                }
+            descriptors.append(descriptor)
+    index = {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": descriptors}
+    writer.add_file("index.json", json.dumps(index, indent=2).encode())
+    writer.add_file("oci-layout", b'{"imageLayoutVersion":"1.0.0"}')
+
+
+def write_oci_layout(
+    writer,
+    config_name: str,
+    config_size: int,
+    layers: List[LayerBlob],
+    repo_tags: Optional[List[str]] = None,
+) -> None:
+    """Write the manifest, ``index.json`` and ``oci-layout`` of an OCI image layout.
+
+    A Docker ``manifest.json`` pointing at the same blobs is added as well,
+    like ``docker save`` does, so that older ``docker load`` versions can
+    still load the image.
+    """
+    descriptor = write_oci_manifest(writer, config_name, config_size, layers)
+    write_index_json(writer, [(descriptor, repo_tags)])
+    docker_manifest = {
+        "Config": config_name,
+        "RepoTags": repo_tags or [],
+        "Layers": [l.name for l in layers],
+    }
+    write_docker_manifests(writer, [docker_manifest])
+
+
+def write_oci_index(
+    writer, manifests: List[dict], repo_tags: Optional[List[str]] = None
+) -> str:
+    """Write a multi-platform OCI image layout and return the digest of its index.
+
+    ``manifests`` are the descriptors of the platform manifests, listed by an
+    image index blob that ``index.json`` points at, like ``docker save`` does
+    for multi-platform images. There is no Docker ``manifest.json``: loading
+    several platforms needs a containerd-backed image store anyway.
+    """
+    index = {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": manifests}
+    data = json.dumps(index, indent=2).encode()
+    index_digest = hashlib.sha256(data).hexdigest()
+    writer.add_file(f"blobs/sha256/{index_digest}", data)
+    target = {
+        "mediaType": OCI_INDEX,
+        "digest": f"sha256:{index_digest}",
+        "size": len(data),
+    }
+    write_index_json(writer, [(target, repo_tags)])
+    return f"sha256:{index_digest}"
+
+
+def write_repositories(writer, image_id: str, repo_tags: List[str]) -> None:
+    write_all_repositories(writer, [(image_id, repo_tags)])
+
+
+def write_all_repositories(writer, images: List[Tuple[str, List[str]]]) -> None:
+    """Write ``repositories`` for ``images``, pairs of an image id and its tags."""
+    repositories: Dict[str, Dict[str, str]] = {}
+    for image_id, repo_tags in images:
+        short_id = image_id.split(":", 1)[1] if ":" in image_id else image_id
+        for tag in repo_tags:
+            repo, t = full_tag(tag).rsplit(":", 1)
+            repositories.setdefault(repo, {})[t] = short_id
     if repositories:
-        with open(root / "repositories", "w") as f:
-            json.dump(repositories, f, indent=2)
+        writer.add_file("repositories", json.dumps(repositories, indent=2).encode())
+
+
+def _gzip_blob(
+    source, writer, name: str, level: int, jobs: int, diff_id: Optional[str]
+) -> LayerBlob:
+    """Write the layer ``name`` of ``source`` as a gzip blob of an OCI layout."""
+    with source.open(name) as blob:
+        head = blob.peek(8)[:8]
+        factory = detect_compression(head)
+        if head.startswith(_GZIP_MAGIC):
+            # Already in the target compression: copy it as it is
+            if diff_id is None:
+                sha = hashlib.sha256()
+                for chunk in iter_decompressed(blob, factory):
+                    sha.update(chunk)
+                diff_id = f"sha256:{sha.hexdigest()}"
+            path, offset, size = source.locate(name)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                with writer.add_stream("blobs/sha256/{digest}") as dest:
+                    dest.copy_range(fd, offset, size)
+            finally:
+                os.close(fd)
+            if name.startswith("blobs/sha256/") and not name.endswith(dest.digest):
+                raise SquashError(f"Digest mismatch for layer blob: {name}")
+            return LayerBlob(
+                f"blobs/sha256/{dest.digest}",
+                diff_id,
+                f"sha256:{dest.digest}",
+                dest.size,
+                OCI_LAYER_GZIP,
+            )
+        with writer.add_stream("blobs/sha256/{digest}") as dest:
+            with GzipWriter(dest, level, jobs) as gz:
+                if factory is not None:
+                    for chunk in iter_decompressed(blob, factory):
+                        gz.write(chunk)
+                else:
+                    shutil.copyfileobj(blob, gz, 1048576)
+    return LayerBlob(
+        f"blobs/sha256/{dest.digest}",
+        f"sha256:{gz.diff_id}",
+        f"sha256:{dest.digest}",
+        dest.size,
+        OCI_LAYER_GZIP,
+    )
 
 
 def copy_preserved_layers(
-    old_root: Path, new_root: Path, oci_input: bool, layer_ids_to_keep: List[str]
-) -> None:
-    new_root.mkdir(parents=True, exist_ok=True)
+    source,
+    writer,
+    oci_input: bool,
+    layer_ids_to_keep: List[str],
+    gzip_level: Optional[int] = None,
+    jobs: int = 1,
+    diff_ids: Optional[Dict[str, str]] = None,
+    written: Optional[Dict[str, LayerBlob]] = None,
+) -> List[LayerBlob]:
+    """Stream preserved layers into the output image and return them.
+
+    Layer bytes are copied in-kernel where possible; compressed OCI blobs are
+    decompressed in a single pass straight into the output.
+
+    Known diff_ids, mapped by layer id in ``diff_ids``, are used instead of
+    hashing layers that are copied unchanged; see ``verify_diff_ids``.
+
+    With ``gzip_level``, layers are written as gzip blobs of an OCI layout
+    instead: gzip blobs are reused as they are (their digest is checked on
+    the way) and other layers are compressed on ``jobs`` threads.
+
+    ``written`` maps the ids of layers already in the output to their blobs;
+    those are not copied again, and the layers copied here are added to it.
+    """
+    blobs: List[LayerBlob] = []
     for layer_id in layer_ids_to_keep:
         if layer_id.startswith("<missing-"):
             continue
-        if oci_input:
-            # Convert OCI blob (possibly compressed) into Docker-style <digest>/layer.tar (uncompressed)
-            import tarfile
+        if written is not None and layer_id in written:
+            blobs.append(written[layer_id])
+            continue
+        with writer.stats.phase("preserve") as phase:
+            blob = _preserve_layer(
+                source,
+                writer,
+                oci_input,
+                layer_id,
+                gzip_level,
+                jobs,
+                (diff_ids or {}).get(layer_id),
+                phase,
+            )
+        if blob is not None:
+            blobs.append(blob)
+            if written is not None:
+                written[layer_id] = blob
+    return blobs
 
-            digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
-            src_blob = old_root / "blobs" / "sha256" / digest
-            if not src_blob.exists():
-                continue
-            dest_dir = new_root / digest
-            dest_dir.mkdir(parents=True, exist_ok=True)
-            dest_tar = dest_dir / "layer.tar"
-            # Read input tar (auto-detect compression) and re-pack uncompressed
-            with tarfile.open(src_blob, mode="r:*") as in_tar:
-                with tarfile.open(
-                    dest_tar, mode="w", format=tarfile.PAX_FORMAT
-                ) as out_tar:
-                    for member in in_tar.getmembers():
-                        # Extract fileobj if regular file, otherwise add member as-is
-                        if member.isfile():
-                            fobj = in_tar.extractfile(member)
-                            out_tar.addfile(member, fobj)
-                        else:
-                            out_tar.addfile(member)
+
+def _preserve_layer(
+    source,
+    writer,
+    oci_input: bool,
+    layer_id: str,
+    gzip_level: Optional[int],
+    jobs: int,
+    known: Optional[str],
+    phase,
+) -> Optional[LayerBlob]:
+    digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
+    src_name = layer_tar_name(oci_input, layer_id)
+    if not source.exists(src_name):
+        return None
+    phase.bytes_read += source.size(src_name)
+    phase.entries += 1
+    if gzip_level is not None:
+        return _gzip_blob(source, writer, src_name, gzip_level, jobs, known)
+    name = f"{digest}/layer.tar"
+    if oci_input:
+        # Convert OCI blob (possibly compressed) into Docker-style <digest>/layer.tar (uncompressed)
+        with source.open(src_name) as blob:
+            factory = detect_compression(blob.peek(8)[:8])
+            if factory is not None:
+                with writer.add_stream(name) as dest:
+                    for chunk in iter_decompressed(blob, factory):
+                        dest.write(chunk)
+                diff_id = f"sha256:{dest.digest}"
+                return LayerBlob(name, diff_id, diff_id, dest.size)
+    # Uncompressed layers are unchanged, so a diff_id recorded in the
+    # source config spares hashing them again
+    path, offset, size = source.locate(src_name)
+    digest_hex = writer.add_range(
+        name, path, offset, size, digest=known and known.split(":", 1)[-1]
+    )
+    diff_id = f"sha256:{digest_hex}"
+    if not oci_input:
+        # copy json and VERSION if they exist
+        for meta_name in ("json", "VERSION"):
+            src_meta = f"{digest}/{meta_name}"
+            if source.exists(src_meta):
+                with source.open(src_meta) as src:
+                    writer.add_file(src_meta, src, source.size(src_meta))
+    return LayerBlob(name, diff_id, diff_id, size)
+
+
+def _layer_diff_id(source, name: str) -> str:
+    sha = hashlib.sha256()
+    with source.open(name) as blob:
+        factory = detect_compression(blob.peek(8)[:8])
+        if factory is not None:
+            for chunk in iter_decompressed(blob, factory):
+                sha.update(chunk)
         else:
-            digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
-            src_dir = old_root / digest
-            src_tar = src_dir / "layer.tar"
-            if not src_tar.exists():
-                continue
-            dest_dir = new_root / digest
-            dest_dir.mkdir(parents=True, exist_ok=True)
-            import shutil
-
-            shutil.copy2(src_tar, dest_dir / "layer.tar")
-            # copy json if exists
-            src_json = src_dir / "json"
-            if src_json.exists():
-                shutil.copy2(src_json, dest_dir / "json")
-            src_ver = src_dir / "VERSION"
-            if src_ver.exists():
-                shutil.copy2(src_ver, dest_dir / "VERSION")
+            for chunk in iter(lambda: blob.read(1048576), b""):
+                sha.update(chunk)
+    return f"sha256:{sha.hexdigest()}"
+
+
+def verify_diff_ids(
+    source, oci_input: bool, diff_ids: Dict[str, str], jobs: int = 1
+) -> None:
+    """Re-hash layers of ``source`` on ``jobs`` threads and check their diff_ids.
+
+    ``diff_ids`` maps layer ids to the diff_ids expected for them.
+    """
+
+    def check(layer_id: str, expected: str) -> None:
+        actual = _layer_diff_id(source, layer_tar_name(oci_input, layer_id))
+        if actual != expected:
+            raise SquashError(
+                f"diff_id mismatch for layer {layer_id}: "
+                f"config has {expected}, content hashes to {actual}"
+            )
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        for future in [pool.submit(check, *item) for item in diff_ids.items()]:
+            future.result()
@@ -0,0 +1,199 @@
+import contextlib
+import mmap
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+from . import archive, tarscan
+from .errors import SquashError
+from .formats import layer_tar_name
+from .utils import normalize_abs
+from .workarea import Spool, WorkArea, write_spool
+
+
+class LayerMember(NamedTuple):
+    """Compact header record of one layer tar member."""
+
+    name: str
+    path: str  # normalized absolute path
+    type: bytes
+    linkname: str
+    offset: int  # offset of the member's first header block in the layer tar
+    end: int  # offset just past the member's padded data
+    size: int
+    mode: int
+
+    def isfile(self) -> bool:
+        return self.type in tarfile.REGULAR_TYPES
+
+    def isdir(self) -> bool:
+        return self.type == tarfile.DIRTYPE
+
+    def issym(self) -> bool:
+        return self.type == tarfile.SYMTYPE
+
+    def islnk(self) -> bool:
+        return self.type == tarfile.LNKTYPE
+
+
+@dataclass
+class LayerIndex:
+    """Member records of a layer, and where its uncompressed tar bytes live."""
+
+    layer_id: str
+    path: str
+    offset: int
+    size: int
+    members: List[LayerMember]
+    pax_headers: Dict[str, str] = field(default_factory=dict)
+
+
+def _scan_headers(path: str, offset: int, size: int) -> Optional[List[tarscan.Header]]:
+    """Scan an uncompressed layer tar's headers over an mmap.
+
+    Returns ``None`` when ``tarfile`` has to be used instead.
+    """
+    if size < tarfile.BLOCKSIZE:
+        return None
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), offset + size - start, access=mmap.ACCESS_READ, offset=start
+    ) as m:
+        return tarscan.scan(m, offset - start, size)
+
+
+def index_layer(
+    layer_id: str, path: str, offset: int, size: int, spool: Spool
+) -> LayerIndex:
+    """Scan the headers of a layer tar, decompressing it to ``spool`` if needed.
+
+    Runs in worker processes, so it only takes and returns picklable values.
+    """
+    with archive.open_range(path, offset, size) as f:
+        factory = archive.detect_compression(f.peek(8)[:8])
+        if factory is not None:
+            path = write_spool(spool, archive.iter_decompressed(f, factory))
+            offset, size = 0, os.path.getsize(path)
+    headers = _scan_headers(path, offset, size)
+    if headers is not None:
+        members = [LayerMember(h[0], normalize_abs(h[0]), *h[1:]) for h in headers]
+        return LayerIndex(layer_id, path, offset, size, members)
+    with archive.open_range(path, offset, size) as f, tarfile.open(
+        fileobj=f, mode="r:"
+    ) as tar:
+        members = []
+        for m in tar:
+            members.append(
+                LayerMember(
+                    m.name,
+                    normalize_abs(m.name),
+                    m.type,
+                    m.linkname,
+                    m.offset,
+                    tar.offset,
+                    m.size,
+                    m.mode,
+                )
+            )
+        pax_headers = dict(tar.pax_headers)
+    return LayerIndex(layer_id, path, offset, size, members, pax_headers)
+
+
+def layer_paths(path: str, offset: int, size: int) -> List[str]:
+    """Return the normalized paths of all members of a (possibly compressed) layer tar."""
+    with archive.open_range(path, offset, size) as f:
+        if archive.detect_compression(f.peek(8)[:8]) is not None:
+            mode = "r|*"
+        else:
+            headers = _scan_headers(path, offset, size)
+            if headers is not None:
+                return [normalize_abs(h[0]) for h in headers]
+            mode = "r:"
+        with tarfile.open(fileobj=f, mode=mode) as tar:
+            return [normalize_abs(m.name) for m in tar]
+
+
+def map_layers(fn: Callable, tasks: Sequence[tuple], jobs: int) -> Iterator:
+    """Run ``fn`` over ``tasks`` in a process pool of ``jobs`` workers.
+
+    Results are yielded in task order. At most ``jobs`` tasks run ahead of
+    the consumer, so finished results do not pile up in memory.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield fn(*task)
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+        pending: Deque[Future] = deque()
+        try:
+            for task in tasks:
+                pending.append(pool.submit(fn, *task))
+                if len(pending) > jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def locate_layers(source, oci: bool, layer_ids: List[str]) -> List[tuple]:
+    """Return ``(layer_id, path, offset, size)`` of each layer tar in ``source``."""
+    locations = []
+    for layer_id in layer_ids:
+        name = layer_tar_name(oci, layer_id)
+        if not source.exists(name):
+            raise SquashError(f"Layer tar not found: {name}")
+        locations.append((layer_id, *source.locate(name)))
+    return locations
+
+
+def index_layers(
+    locations: List[tuple], work: WorkArea, jobs: int = 1
+) -> Iterator[LayerIndex]:
+    """Index the layers at the given locations in parallel, yielding them in order.
+
+    Compressed layers are decompressed into files of ``work`` so their members
+    can be read by offset afterwards; each layer may keep an equal share of
+    the memory budget left.
+    """
+    share = work.available() // max(1, len(locations))
+    spools = [work.spool(f"layers/{i}.tar", share) for i in range(len(locations))]
+    tasks = [(*location, spool) for location, spool in zip(locations, spools)]
+    with contextlib.closing(map_layers(index_layer, tasks, jobs)) as indexes:
+        for index, spool in zip(indexes, spools):
+            work.settle(spool, index.path)
+            yield index
+
+
+class LayerReader:
+    """Reads full tar headers and file content of indexed layer members."""
+
+    def __init__(self, index: LayerIndex):
+        self._f: BinaryIO = archive.open_range(index.path, index.offset, index.size)
+        self._tar = tarfile.open(fileobj=self._f, mode="r:")
+        self._tar.pax_headers = dict(index.pax_headers)
+
+    def tarinfo(self, member: LayerMember) -> tarfile.TarInfo:
+        self._f.seek(member.offset)
+        return tarfile.TarInfo.fromtarfile(self._tar)
+
+    def extractfile(self, info: tarfile.TarInfo) -> Optional[BinaryIO]:
+        return self._tar.extractfile(info)
+
+    def close(self) -> None:
+        self._tar.close()
+        self._f.close()
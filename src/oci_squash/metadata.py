@@ -1,31 +1,16 @@
 import hashlib
 import json
-from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from .utils import utc_now_rfc3339_trimmed
+from .utils import rfc3339_from_epoch, utc_now_rfc3339_trimmed
 
 
-def compute_diff_ids(
-    moved_layer_paths: List[Path], squashed_layer_path: Optional[Path]
-) -> List[str]:
-    diff_ids: List[str] = []
-    for p in moved_layer_paths:
-        diff_ids.append(_sha256_of_file(p))
-    if squashed_layer_path is not None and squashed_layer_path.exists():
-        diff_ids.append(_sha256_of_file(squashed_layer_path))
-    return diff_ids
-
-
-def _sha256_of_file(path: Path) -> str:
-    sha = hashlib.sha256()
-    with open(path, "rb") as f:
-        while True:
-            data = f.read(10485760)
-            if not data:
-                break
-            sha.update(data)
-    return sha.hexdigest()
+def source_diff_ids(config: dict, real_layer_ids: List[str]) -> Dict[str, str]:
+    """Map real layer ids to the diff_ids recorded in the source config, by position."""
+    diff_ids = config.get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(real_layer_ids):
+        return {}
+    return dict(zip(real_layer_ids, diff_ids))
 
 
 def compute_chain_ids(diff_ids: List[str]) -> List[str]:
@@ -49,14 +34,31 @@ def _generate_chain_id(
     return _generate_chain_id(chain_ids, diff_ids[1:], digest)
 
 
+def squash_created(
+    config: dict, reproducible: bool = False, epoch: Optional[int] = None
+) -> Optional[str]:
+    """Return the creation time of the squashed image, or ``None`` for now.
+
+    ``epoch`` (SOURCE_DATE_EPOCH) wins; reproducible output otherwise keeps
+    the creation time of the source image.
+    """
+    if epoch is not None:
+        return rfc3339_from_epoch(epoch)
+    if reproducible:
+        return config.get("created") or rfc3339_from_epoch(0)
+    return None
+
+
 def update_config_and_history(
     old_config: dict,
     kept_layers: List[str],
     new_diff_ids: List[str],
     comment: str,
+    squashed_layers: int = 1,
+    created: Optional[str] = None,
 ) -> dict:
     metadata = json.loads(json.dumps(old_config))
-    created = utc_now_rfc3339_trimmed()
+    created = created or utc_now_rfc3339_trimmed()
     metadata["created"] = created
     # Trim history to kept layers length (history includes empty layers)
     metadata["history"] = metadata.get("history", [])[: len(kept_layers)]
@@ -68,19 +70,28 @@ def update_config_and_history(
         f"sha256:{d}" if not str(d).startswith("sha256:") else str(d)
         for d in new_diff_ids
     ]
-    # Append history entry for squashed operation
-    history = {"comment": comment or "Squashed layers", "created": created}
-    if not new_diff_ids:
-        # No real squashed tar created; mark as empty layer to keep history consistent
-        history["empty_layer"] = True
-    metadata.setdefault("history", []).append(history)
+    # Append a history entry per squashed layer
+    comment = comment or "Squashed layers"
+    for part in range(max(squashed_layers, 1)):
+        history = {"comment": comment, "created": created}
+        if squashed_layers > 1:
+            history["comment"] = f"{comment} ({part + 1}/{squashed_layers})"
+        if not new_diff_ids or not squashed_layers:
+            # No real squashed tar created; mark as empty layer to keep history consistent
+            history["empty_layer"] = True
+        metadata.setdefault("history", []).append(history)
     return metadata
 
 
-def write_config_and_get_image_id(new_root: Path, config: dict) -> tuple[str, str]:
-    json_metadata = json.dumps(config, sort_keys=True, separators=(",", ":")) + "\n"
-    image_id_hex = hashlib.sha256(json_metadata.encode()).hexdigest()
-    file_name = f"{image_id_hex}.json"
-    with open(new_root / file_name, "w") as f:
-        f.write(json_metadata)
+def config_json(config: dict) -> bytes:
+    return (json.dumps(config, sort_keys=True, separators=(",", ":")) + "\n").encode()
+
+
+def write_config_and_get_image_id(
+    writer, config: dict, oci: bool = False
+) -> Tuple[str, str]:
+    json_metadata = config_json(config)
+    image_id_hex = hashlib.sha256(json_metadata).hexdigest()
+    file_name = f"blobs/sha256/{image_id_hex}" if oci else f"{image_id_hex}.json"
+    writer.add_file(file_name, json_metadata)
     return f"sha256:{image_id_hex}", file_name
@@ -0,0 +1,55 @@
+from typing import Dict, Iterator
+
+
+def _prefixes(path: str) -> Iterator[str]:
+    """Yield ``path`` followed by every prefix of it that ends before a ``/``."""
+    yield path
+    i = path.rfind("/")
+    while i >= 0:
+        yield path[:i]
+        i = path.rfind("/", 0, i)
+
+
+class PathIndex:
+    """Hashed set of paths with parent-directory lookups.
+
+    Every path is stored together with the (1-based) layer number it was first
+    added for, so a single index can replace a list of per-layer path lists.
+    Lookups walk the parents of the queried path, which keeps them
+    proportional to the path depth instead of the number of stored paths.
+    """
+
+    __slots__ = ("_paths",)
+
+    def __init__(self) -> None:
+        self._paths: Dict[str, int] = {}
+
+    def add(self, path: str, layer: int = 1) -> None:
+        self._paths.setdefault(path, layer)
+
+    def __contains__(self, path: object) -> bool:
+        return path in self._paths
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._paths)
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def covering(self, path: str, strict: bool = False) -> int:
+        """Return the lowest layer number of an entry equal to or containing ``path``.
+
+        An entry ``p`` contains ``path`` when ``path`` starts with ``p + "/"``.
+        With ``strict`` the path itself is not considered. Returns 0 when no
+        entry matches.
+        """
+        paths = self._paths
+        found = 0
+        it = _prefixes(path)
+        if strict:
+            next(it)
+        for p in it:
+            layer = paths.get(p)
+            if layer is not None and (not found or layer < found):
+                found = layer
+        return found
@@ -0,0 +1,153 @@
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+_MAGIC = b"OSQPATH1"
+_HEAD = struct.Struct("<8sII")  # magic, path count, block count
+_OFFSET = struct.Struct("<Q")
+_BLOCK = 32  # paths per block; only the first one is stored in full
+
+
+def _encode(path: str) -> bytes:
+    return path.encode("utf-8", "surrogateescape")
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(buf, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def write_path_set(dest: Path, paths: Iterable[str]) -> None:
+    """Write ``paths`` to ``dest`` as a sorted, prefix-compressed path set.
+
+    Paths are grouped in blocks whose first path is stored in full and the
+    others as the length of the prefix shared with their predecessor plus
+    the remaining suffix. The file is replaced atomically.
+    """
+    keys = sorted({_encode(p) for p in paths})
+    blocks: List[bytes] = []
+    for start in range(0, len(keys), _BLOCK):
+        out = bytearray()
+        prev = b""
+        for i, key in enumerate(keys[start : start + _BLOCK]):
+            shared = 0
+            if i:
+                limit = min(len(prev), len(key))
+                while shared < limit and prev[shared] == key[shared]:
+                    shared += 1
+                out += _varint(shared)
+            out += _varint(len(key) - shared)
+            out += key[shared:]
+            prev = key
+        blocks.append(bytes(out))
+    offset = _HEAD.size + _OFFSET.size * len(blocks)
+    table = bytearray()
+    for block in blocks:
+        table += _OFFSET.pack(offset)
+        offset += len(block)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dest.parent)
+    try:
+        with open(fd, "wb") as f:
+            f.write(_HEAD.pack(_MAGIC, len(keys), len(blocks)))
+            f.write(table)
+            for block in blocks:
+                f.write(block)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+class PathSet:
+    """Read-only path set written by ``write_path_set``, memory-mapped.
+
+    Membership tests binary search the blocks by their first path and decode
+    at most one block, so they take microseconds and load nothing up front.
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEAD.size:
+                raise ValueError(f"Truncated path set: {path}")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._blocks = _HEAD.unpack_from(self._map)
+        if magic != _MAGIC or size < _HEAD.size + _OFFSET.size * self._blocks:
+            self._map.close()
+            raise ValueError(f"Invalid path set: {path}")
+
+    @classmethod
+    def open(cls, path: Path) -> Optional["PathSet"]:
+        """Open ``path``, or return ``None`` if it is missing or unreadable."""
+        try:
+            return cls(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def _block_offset(self, block: int) -> int:
+        return _OFFSET.unpack_from(self._map, _HEAD.size + _OFFSET.size * block)[0]
+
+    def _first(self, block: int) -> bytes:
+        pos = self._block_offset(block)
+        n, pos = _read_varint(self._map, pos)
+        return self._map[pos : pos + n]
+
+    def __contains__(self, path: object) -> bool:
+        if not isinstance(path, str) or not self._blocks:
+            return False
+        key = _encode(path)
+        # Last block whose first path is <= key
+        lo, hi = 0, self._blocks
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._first(mid) <= key:
+                lo = mid
+            else:
+                hi = mid
+        pos = self._block_offset(lo)
+        remaining = min(_BLOCK, self._count - lo * _BLOCK)
+        m = self._map
+        prev = b""
+        for i in range(remaining):
+            shared = 0
+            if i:
+                shared, pos = _read_varint(m, pos)
+            n, pos = _read_varint(m, pos)
+            current = prev[:shared] + m[pos : pos + n]
+            pos += n
+            if current == key:
+                return True
+            if current > key:
+                return False
+            prev = current
+        return False
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
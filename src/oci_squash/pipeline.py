@@ -0,0 +1,186 @@
+import hashlib
+import os
+import queue
+import threading
+import zlib
+from typing import Iterator, Optional
+
+from .errors import SquashError
+
+_CHUNK = 1048576
+# File ranges are queued in pieces of this size, so the queue bounds how far
+# hashing may lag behind the writer, and the bytes it reads stay cached.
+_PIECE = 8 * _CHUNK
+_DEPTH = 16
+# Small writes, such as tar headers, are gathered into items of this size
+_BATCH = 65536
+_DONE = None
+
+
+class Hasher:
+    """SHA-256 (and optionally CRC-32) of a byte stream, computed on a thread.
+
+    ``update`` queues bytes and ``update_range`` a region of a file
+    descriptor, which is read back with ``pread``; both are hashed in the
+    order they were queued. ``hashlib`` and ``zlib`` release the GIL, so the
+    producer keeps reading, copying or compressing meanwhile. The queue is
+    bounded: a producer ahead of the hashing thread blocks, which caps the
+    memory held by queued data. Streams that stay small are hashed inline.
+    """
+
+    def __init__(self, crc: bool = False):
+        self._sha = hashlib.sha256()
+        self._crc: Optional[int] = 0 if crc else None
+        self._queue: "queue.Queue" = queue.Queue(_DEPTH)
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._abort = False
+        self._batch = bytearray()
+        self.size = 0
+        self.bytes_read = 0  # read back from file ranges
+
+    def _put(self, item) -> None:
+        if self._error is not None:
+            raise SquashError(f"Hashing failed: {self._error}")
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="oci-squash-hash", daemon=True
+            )
+            self._thread.start()
+        self._queue.put(item)
+
+    def _hash(self, data) -> None:
+        self._sha.update(data)
+        if self._crc is not None:
+            self._crc = zlib.crc32(data, self._crc)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if self._abort or self._error is not None:
+                continue
+            try:
+                if isinstance(item, tuple):
+                    fd, offset, size = item
+                    while size > 0:
+                        data = os.pread(fd, min(size, _CHUNK), offset)
+                        if not data:
+                            raise SquashError("Unexpected end of data while hashing")
+                        self._hash(data)
+                        offset += len(data)
+                        size -= len(data)
+                else:
+                    self._hash(item)
+            except BaseException as e:
+                self._error = e
+
+    def _flush(self) -> None:
+        if self._batch:
+            self._put(bytes(self._batch))
+            self._batch = bytearray()
+
+    def update(self, data) -> None:
+        self.size += len(data)
+        if len(data) < _BATCH:
+            self._batch += data
+            if len(self._batch) >= _BATCH:
+                self._flush()
+            return
+        self._flush()
+        # The caller may reuse its buffer once this returns
+        self._put(data if isinstance(data, bytes) else bytes(data))
+
+    def update_range(self, fd: int, offset: int, size: int) -> None:
+        """Queue ``size`` bytes at ``offset`` of ``fd``, which must stay open
+        until the digest has been taken."""
+        self._flush()
+        self.size += size
+        self.bytes_read += size
+        while size > 0:
+            n = min(size, _PIECE)
+            self._put((fd, offset, n))
+            offset += n
+            size -= n
+
+    def _finish(self) -> None:
+        if self._thread is None:
+            self._hash(self._batch)
+        else:
+            self._flush()
+            self._queue.put(_DONE)
+            self._thread.join()
+            self._thread = None
+        self._batch = bytearray()
+        if self._error is not None:
+            raise SquashError(f"Hashing failed: {self._error}")
+
+    def hexdigest(self) -> str:
+        """Wait for the queued data to be hashed and return its SHA-256."""
+        self._finish()
+        return self._sha.hexdigest()
+
+    def crc32(self) -> int:
+        self._finish()
+        return self._crc or 0
+
+    def close(self) -> None:
+        """Stop hashing, dropping whatever is still queued."""
+        self._abort = True
+        if self._thread is not None:
+            self._queue.put(_DONE)
+            self._thread.join()
+            self._thread = None
+
+
+def read_ahead(
+    fd: int, offset: int, size: int, chunk: int = _CHUNK, depth: int = 4
+) -> Iterator[bytes]:
+    """Yield ``size`` bytes at ``offset`` of ``fd`` in chunks, read on a thread.
+
+    At most ``depth`` chunks are read ahead of the consumer.
+    """
+    if size <= chunk:
+        data = os.pread(fd, size, offset) if size else b""
+        if len(data) != size:
+            raise SquashError("Unexpected end of data while reading")
+        if data:
+            yield data
+        return
+    chunks: "queue.Queue" = queue.Queue(depth)
+    stop = threading.Event()
+
+    def run():
+        pos, remaining = offset, size
+        try:
+            while remaining > 0 and not stop.is_set():
+                data = os.pread(fd, min(remaining, chunk), pos)
+                if not data:
+                    raise SquashError("Unexpected end of data while reading")
+                chunks.put(data)
+                pos += len(data)
+                remaining -= len(data)
+            chunks.put(_DONE)
+        except BaseException as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=run, name="oci-squash-read", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Unblock the reader if it waits on a full queue
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
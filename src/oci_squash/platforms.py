@@ -0,0 +1,238 @@
+import hashlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .cache import SquashCache
+from .compress import DEFAULT_LEVEL
+from .formats import (
+    ImageMeta,
+    LayerBlob,
+    copy_preserved_layers,
+    platform_name,
+    write_oci_index,
+    write_oci_manifest,
+)
+from .layers import LayerIndex, index_layers, locate_layers
+from .metadata import (
+    config_json,
+    source_diff_ids,
+    squash_created,
+    update_config_and_history,
+)
+from .squash import squash_layers
+from .stats import Stats
+from .warmcache import WarmCache
+from .workarea import WorkArea
+
+
+class ImageSquash(NamedTuple):
+    """The layers to keep and to squash of one image, or one of its platforms."""
+
+    meta: ImageMeta
+    to_keep: List[str]
+    to_squash: List[str]
+
+
+class ImageResult(NamedTuple):
+    meta: ImageMeta
+    image_id: str
+    config_name: str
+    config_size: int
+    layers: List[LayerBlob]
+    squashed_layers: int
+    manifest: Optional[dict] = None  # descriptor of the OCI image manifest
+
+    @property
+    def diff_ids(self) -> List[str]:
+        return [layer.diff_id for layer in self.layers]
+
+
+def index_image_layers(
+    images: List[ImageSquash],
+    source,
+    work: WorkArea,
+    jobs: int,
+    stats: Stats,
+    warm: Optional[WarmCache] = None,
+    indexed: Optional[Dict[str, LayerIndex]] = None,
+) -> Dict[str, LayerIndex]:
+    """Index the layers to squash of all images in one worker pool.
+
+    Layers shared by several images are indexed once, or taken from ``warm``
+    or from ``indexed``, indexes built beforehand.
+    """
+    indexed = dict(indexed or {})
+    locations: Dict[str, tuple] = {}
+    keys: Dict[str, str] = {}
+    for image in images:
+        real = [lid for lid in image.to_squash if not lid.startswith("<missing-")]
+        for location in locate_layers(source, image.meta.oci, real):
+            if location[0] not in indexed:
+                locations.setdefault(location[0], location)
+        keys.update(source_diff_ids(image.meta.config, image.meta.real_layer_ids))
+    if warm is not None:
+        indexes = warm.index_layers(list(locations.values()), work, jobs, keys)
+    else:
+        indexes = index_layers(list(locations.values()), work, jobs)
+    with stats.phase("scan") as phase:
+        for index in indexes:
+            indexed[index.layer_id] = index
+            phase.entries += len(index.members)
+            phase.bytes_read += index.size
+            stats.add_layer(index.layer_id, len(index.members), index.size)
+    return indexed
+
+
+def squash_each(
+    images: List[ImageSquash],
+    source,
+    writer,
+    work: WorkArea,
+    jobs: int = 1,
+    cache: Optional[SquashCache] = None,
+    gzip_level: Optional[int] = None,
+    message: str = "",
+    parts: int = 1,
+    max_layer_size: Optional[int] = None,
+    reproducible: bool = False,
+    clamp_mtime: Optional[int] = None,
+    squashed_name: Optional[str] = None,
+    warm: Optional[WarmCache] = None,
+    indexed: Optional[Dict[str, LayerIndex]] = None,
+) -> Iterator[ImageResult]:
+    """Squash several images into one output image tar, sharing their layers.
+
+    The layers to squash of all images are indexed up front, in parallel
+    and once each (see ``index_image_layers``); images are then merged and
+    written in turn. Preserved layers shared by images are copied once, and
+    so is the squash of a layer chain they have in common.
+
+    Yields the result of each image once its layers and config are written;
+    writing manifests is left to the caller. ``gzip_level`` and
+    ``squashed_name`` are passed on to ``squash_layers``; ``warm`` keeps layer
+    indexes and diff_ids for later squashes, and ``indexed`` holds indexes
+    built beforehand, e.g. by ``analyze_squash``.
+    """
+    stats = writer.stats
+    indexed = index_image_layers(images, source, work, jobs, stats, warm, indexed)
+    written: Dict[str, LayerBlob] = {}
+    squashes: Dict[tuple, List[LayerBlob]] = {}
+    configs = set()
+    for image in images:
+        meta = image.meta
+        if warm is not None:
+            digests = warm.layer_digests(meta)
+        else:
+            digests = source_diff_ids(meta.config, meta.real_layer_ids)
+        layers = copy_preserved_layers(
+            source,
+            writer,
+            meta.oci,
+            image.to_keep,
+            gzip_level=gzip_level,
+            jobs=jobs,
+            diff_ids=digests,
+            written=written,
+        )
+        if warm is not None:
+            warm.remember(meta, digests, written)
+        key = (tuple(image.to_keep), tuple(image.to_squash))
+        if key not in squashes:
+            squashes[key], _ = squash_layers(
+                image.to_squash,
+                image.to_keep,
+                source,
+                writer,
+                meta.oci,
+                work,
+                jobs,
+                cache=cache,
+                digests=digests,
+                gzip_level=gzip_level,
+                parts=parts,
+                max_layer_size=max_layer_size,
+                reproducible=reproducible,
+                clamp_mtime=clamp_mtime,
+                indexed=indexed,
+                squashed_name=squashed_name,
+                warm=warm,
+            )
+        squashed = squashes[key]
+        layers.extend(squashed)
+
+        with stats.phase("config"):
+            config = update_config_and_history(
+                meta.config,
+                image.to_keep,
+                [layer.diff_id for layer in layers],
+                message,
+                len(squashed),
+                created=squash_created(meta.config, reproducible, clamp_mtime),
+            )
+            data = config_json(config)
+            config_hex = hashlib.sha256(data).hexdigest()
+            if gzip_level is not None:
+                config_name = f"blobs/sha256/{config_hex}"
+            else:
+                config_name = f"{config_hex}.json"
+            if config_name not in configs:
+                configs.add(config_name)
+                writer.add_file(config_name, data)
+        yield ImageResult(
+            meta, f"sha256:{config_hex}", config_name, len(data), layers, len(squashed)
+        )
+
+
+def squash_platforms(
+    platforms: List[ImageSquash],
+    source,
+    writer,
+    work: WorkArea,
+    jobs: int = 1,
+    cache: Optional[SquashCache] = None,
+    gzip_level: int = DEFAULT_LEVEL,
+    message: str = "",
+    repo_tags: Optional[List[str]] = None,
+    parts: int = 1,
+    max_layer_size: Optional[int] = None,
+    reproducible: bool = False,
+    clamp_mtime: Optional[int] = None,
+    warm: Optional[WarmCache] = None,
+    indexed: Optional[Dict[str, LayerIndex]] = None,
+) -> Tuple[str, List[ImageResult]]:
+    """Squash each platform of a multi-platform image into one OCI image layout.
+
+    Platforms share their layer work as described for ``squash_each``.
+
+    Returns the digest of the image index and the result of each platform.
+    """
+    stats = writer.stats
+    results = []
+    for result in squash_each(
+        platforms,
+        source,
+        writer,
+        work,
+        jobs,
+        cache,
+        gzip_level,
+        message,
+        parts,
+        max_layer_size,
+        reproducible,
+        clamp_mtime,
+        warm=warm,
+        indexed=indexed,
+    ):
+        stats.event(f"squashed {platform_name(result.meta.platform)}")
+        with stats.phase("config"):
+            descriptor = write_oci_manifest(
+                writer,
+                result.config_name,
+                result.config_size,
+                result.layers,
+                result.meta.platform,
+            )
+        results.append(result._replace(manifest=descriptor))
+    with stats.phase("config"):
+        index_digest = write_oci_index(writer, [r.manifest for r in results], repo_tags)
+    return index_digest, results
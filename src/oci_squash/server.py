@@ -0,0 +1,375 @@
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, List, Optional
+
+from .cli import build_parser, execute
+from .errors import SquashError
+from .stats import Stats
+from .utils import setup_logger
+from .warmcache import WarmCache
+
+# Relative paths of a job are taken relative to the directory of its client
+_PATH_ARGS = ("image", "output_path", "tmp_dir", "cache_dir", "stats_json")
+_LOG_LINES = 200
+
+
+def default_socket() -> Path:
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return Path(runtime) / "oci-squash.sock"
+    return Path(tempfile.gettempdir()) / f"oci-squash-{os.getuid()}.sock"
+
+
+class _JobLog(io.TextIOBase):
+    """Keeps the last lines of the progress and log output of a job."""
+
+    def __init__(self, limit: int = _LOG_LINES):
+        self.lines: Deque[str] = deque(maxlen=limit)
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            *lines, self._partial = (self._partial + text).split("\n")
+            self.lines.extend(lines)
+        return len(text)
+
+
+class _JobLogHandler(logging.Handler):
+    """Copies log records of job threads to the log of their job."""
+
+    def __init__(self):
+        super().__init__()
+        self.logs: Dict[int, _JobLog] = {}
+        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)-5s %(message)s"))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        log = self.logs.get(record.thread or 0)
+        if log is not None:
+            log.write(self.format(record) + "\n")
+
+
+@dataclass
+class Job:
+    id: str
+    argv: List[str]
+    state: str = "queued"  # queued, running, done or failed
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    log: _JobLog = field(default_factory=_JobLog)
+    stats: Optional[Stats] = None
+    result: Optional[dict] = None  # metrics, once finished
+    done: threading.Event = field(default_factory=threading.Event)
+
+    def as_dict(self, detail: bool = False) -> dict:
+        d = {
+            "id": self.id,
+            "state": self.state,
+            "argv": self.argv,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "phase": self.stats.current_phase() if self.stats else None,
+        }
+        if detail:
+            d["stats"] = self.result or (self.stats.as_dict() if self.stats else None)
+            d["log"] = list(self.log.lines)
+        return d
+
+
+def _parse_job_args(argv: List[str], cwd: Optional[str]) -> argparse.Namespace:
+    parser = build_parser()
+
+    def error(message: str):
+        raise SquashError(f"Invalid arguments: {message}")
+
+    parser.error = error  # type: ignore[assignment]
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        raise SquashError("Invalid arguments")
+    if args.image == "-" or args.output_path == "-":
+        raise SquashError("Jobs cannot read stdin or write stdout")
+    base = Path(cwd) if cwd else Path.cwd()
+    for name in _PATH_ARGS:
+        value = getattr(args, name)
+        if value:
+            setattr(args, name, str(base / value))
+    return args
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"ok": False, "error": f"Invalid request: {e}"}
+            else:
+                if isinstance(request, dict):
+                    response = self.server.squash.handle(request)  # type: ignore
+                else:
+                    response = {"ok": False, "error": "Invalid request: not an object"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            if response["ok"] and request.get("op") == "shutdown":
+                # Only once answered, as the process may exit right after
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+
+class SquashServer:
+    """Runs squash jobs submitted over a Unix socket, keeping caches warm.
+
+    Clients send requests as JSON objects, one per line, and get a JSON
+    response line for each, with ``"ok"`` and, if that is false, ``"error"``:
+
+    - ``{"op": "submit", "args": [...], "cwd": ..., "env": {...}}`` queues a
+      job with the arguments of an ``oci-squash`` command line. Relative
+      paths are taken relative to ``cwd``; ``env`` may set
+      ``SOURCE_DATE_EPOCH``.
+    - ``{"op": "status", "job": id}`` reports a job, with its metrics and the
+      last lines of its log; ``"wait"`` does so once it has finished, or
+      after ``"timeout"`` seconds.
+    - ``{"op": "jobs"}`` lists the jobs, ``{"op": "stats"}`` the state of the
+      server and its caches, and ``{"op": "shutdown"}`` stops it from taking
+      new requests; jobs already queued still run.
+
+    Up to ``workers`` jobs run at a time, each with its own ``--jobs`` worker
+    processes, and up to ``queue_size`` more wait; further submissions are
+    refused. All jobs share ``warm``. The ``keep_jobs`` most recent finished
+    jobs are kept for status requests.
+    """
+
+    def __init__(
+        self,
+        socket_path: Path,
+        workers: int = 1,
+        queue_size: int = 16,
+        warm: Optional[WarmCache] = None,
+        keep_jobs: int = 100,
+    ):
+        self.socket_path = socket_path
+        self.workers = workers
+        self.queue_size = queue_size
+        self.warm = warm if warm is not None else WarmCache()
+        self.keep_jobs = keep_jobs
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="oci-squash-job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._active = 0  # queued or running
+        self._count = 0
+        self._lock = threading.Lock()
+        self._logs = _JobLogHandler()
+        self._server: Optional[socketserver.UnixStreamServer] = None
+
+    def submit(
+        self,
+        argv: List[str],
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Job:
+        args = _parse_job_args(argv, cwd)
+        with self._lock:
+            if self._active >= self.workers + self.queue_size:
+                raise SquashError("Job queue is full")
+            self._count += 1
+            job = Job(str(self._count), list(argv))
+            self._jobs[job.id] = job
+            self._active += 1
+        self._pool.submit(self._run, job, args, dict(env or {}))
+        return job
+
+    def _run(self, job: Job, args: argparse.Namespace, env: Dict[str, str]) -> None:
+        job.state = "running"
+        job.started = time.time()
+        job.stats = Stats(progress=job.log)
+        self._logs.logs[threading.get_ident()] = job.log
+        try:
+            execute(args, job.stats, self.warm, env, job.log)
+            job.state = "done"
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e) or type(e).__name__
+        finally:
+            self._logs.logs.pop(threading.get_ident(), None)
+            job.result = job.stats.as_dict()
+            job.finished = time.time()
+            with self._lock:
+                self._active -= 1
+                self._prune()
+            job.done.set()
+
+    def _prune(self) -> None:
+        finished = [id for id, job in self._jobs.items() if job.finished is not None]
+        for id in finished[: max(0, len(finished) - self.keep_jobs)]:
+            del self._jobs[id]
+
+    def _job(self, id) -> Job:
+        job = self._jobs.get(str(id))
+        if job is None:
+            raise SquashError(f"Job not found: {id}")
+        return job
+
+    def handle(self, request: dict) -> dict:
+        """Answer one request of the protocol described above."""
+        op = request.get("op")
+        try:
+            if op == "submit":
+                args = request.get("args")
+                if not isinstance(args, list) or not all(
+                    isinstance(a, str) for a in args
+                ):
+                    raise SquashError("args must be a list of strings")
+                job = self.submit(args, request.get("cwd"), request.get("env"))
+                return {"ok": True, "job": job.as_dict()}
+            if op in ("status", "wait"):
+                job = self._job(request.get("job"))
+                if op == "wait":
+                    timeout = request.get("timeout")
+                    if isinstance(timeout, bool) or not isinstance(
+                        timeout, (int, float, type(None))
+                    ):
+                        raise SquashError("timeout must be a number of seconds")
+                    job.done.wait(timeout)
+                return {"ok": True, "job": job.as_dict(detail=True)}
+            if op == "jobs":
+                with self._lock:
+                    jobs = list(self._jobs.values())
+                return {"ok": True, "jobs": [job.as_dict() for job in jobs]}
+            if op == "stats":
+                with self._lock:
+                    states = [job.state for job in self._jobs.values()]
+                return {
+                    "ok": True,
+                    "running": states.count("running"),
+                    "queued": states.count("queued"),
+                    "warm": self.warm.as_dict(),
+                }
+            if op == "shutdown":
+                return {"ok": True}  # the handler stops the server once it replied
+            raise SquashError(f"Unknown op: {op}")
+        except SquashError as e:
+            return {"ok": False, "error": str(e)}
+
+    def serve_forever(self) -> None:
+        if self.socket_path.exists():
+            try:
+                request(self.socket_path, {"op": "stats"})
+            except OSError:
+                self.socket_path.unlink()  # left over by a server that died
+            else:
+                raise SquashError(f"Server already running on {self.socket_path}")
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(
+                str(self.socket_path), _Handler
+            )
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        self._server.squash = self  # type: ignore[attr-defined]
+        logger = logging.getLogger("oci_squash")
+        logger.addHandler(self._logs)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._pool.shutdown(wait=True)
+            logger.removeHandler(self._logs)
+            self.socket_path.unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        """Stop serving; ``serve_forever`` returns once the queued and running
+        jobs are done."""
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def request(socket_path: Path, message: dict) -> dict:
+    """Send one request to the server at ``socket_path`` and return its response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(message).encode() + b"\n")
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise SquashError("No response from server")
+    return json.loads(line)
+
+
+def serve_main(argv: Optional[List[str]] = None) -> None:
+    p = argparse.ArgumentParser(
+        prog="oci-squash serve",
+        description="Run squash jobs submitted over a Unix socket, keeping layer "
+        "indexes and diff_ids cached in memory between them",
+    )
+    p.add_argument(
+        "--socket",
+        type=Path,
+        default=default_socket(),
+        help="Path of the Unix socket. Default: %(default)s",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of jobs run at a time. Default: 1",
+    )
+    p.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="Number of jobs that may wait for a worker; more are refused. "
+        "Default: 16",
+    )
+    p.add_argument(
+        "--index-cache-entries",
+        type=int,
+        default=1000000,
+        help="Number of layer member records kept in memory for later jobs. "
+        "Default: 1000000",
+    )
+    p.add_argument(
+        "--keep-jobs",
+        type=int,
+        default=100,
+        help="Number of finished jobs kept for status requests. Default: 100",
+    )
+    p.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+    args = p.parse_args(argv)
+    if args.workers < 1:
+        raise SquashError(f"Invalid number of workers: {args.workers}")
+    log = setup_logger(args.verbose)
+    # Forking worker processes off a threaded server can inherit held locks
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("forkserver", force=True)
+        multiprocessing.set_forkserver_preload(["oci_squash.layers"])
+    server = SquashServer(
+        args.socket,
+        args.workers,
+        args.queue_size,
+        WarmCache(args.index_cache_entries),
+        args.keep_jobs,
+    )
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start(),
+    )
+    log.info(f"Serving on {args.socket}")
+    server.serve_forever()
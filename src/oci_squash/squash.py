@@ -1,63 +1,118 @@
+import contextlib
+import io
 import os
+import struct
 import tarfile
-from pathlib import Path
-from typing import Dict, List, Optional, Tuple
-import pathlib
-
-from .errors import SquashError
+from dataclasses import dataclass
+from typing import (
+    Container,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from .cache import SquashCache
+from .compress import GzipWriter
+from .errors import SquashUnnecessaryError
+from .formats import DOCKER_LAYER, OCI_LAYER_GZIP, LayerBlob
+from .layers import (
+    LayerIndex,
+    LayerMember,
+    LayerReader,
+    index_layers,
+    layer_paths,
+    layer_tar_name,
+    locate_layers,
+    map_layers,
+)
+from .pathindex import PathIndex
+from .stats import Stats
 from .utils import normalize_abs
+from .warmcache import WarmCache
+from .workarea import WorkArea
 
+ENCODING = "utf-8"
+# PAX records that tarfile derives again from the header fields when needed
+_DERIVED_PAX_KEYS = frozenset(
+    (
+        "path",
+        "linkpath",
+        "size",
+        "uid",
+        "gid",
+        "uname",
+        "gname",
+        "mtime",
+        "atime",
+        "ctime",
+    )
+)
 
-def _marker_files(tar: tarfile.TarFile, members: List[tarfile.TarInfo]):
-    markers = {}
-    for m in members:
-        if ".wh." in m.name:
-            markers[m] = tar.extractfile(m)
-    return markers
 
+def _is_marker(member: LayerMember) -> bool:
+    return ".wh." in member.name and not member.name.endswith(".wh..wh..opq")
 
-def _file_should_be_skipped(name: str, to_skip: List[List[str]]) -> int:
-    layer_nb = 1
-    for layers in to_skip:
-        for p in layers:
-            if name == p or name.startswith(p + "/"):
-                return layer_nb
-        layer_nb += 1
-    return 0
 
+def _file_should_be_skipped(name: str, to_skip: PathIndex) -> int:
+    return to_skip.covering(name)
 
-def _files_in_layers(
-    root: Path, oci: bool, layer_ids: List[str]
-) -> Dict[str, List[str]]:
-    """Build a mapping of layer_id -> normalized file paths contained in that layer tar.
 
-    Only non-empty (real) layers are considered.
+def _files_in_layers(
+    source,
+    oci: bool,
+    layer_ids: List[str],
+    jobs: int = 1,
+    cache: Optional[SquashCache] = None,
+    digests: Optional[Dict[str, str]] = None,
+) -> Optional[List[Container[str]]]:
+    """Return sets of the normalized file paths contained in the given layer tars.
+
+    Only non-empty (real) layers are considered; they are scanned in parallel.
+    With a ``cache``, the path set of each layer is stored under its content
+    digest (its diff_id from ``digests``, or its OCI blob digest) and later
+    runs memory-map it instead of scanning the layer again.
+    Returns None if none of the layer tars could be found.
     """
-    files: Dict[str, List[str]] = {}
+    sets: List[Container[str]] = []
+    tasks = []
+    keys: List[Optional[str]] = []
     for layer_id in layer_ids:
         if layer_id.startswith("<missing-"):
             continue
-        layer_tar_path = _layer_tar_path(root, oci, layer_id)
-        if not layer_tar_path.exists():
+        name = layer_tar_name(oci, layer_id)
+        if not source.exists(name):
             continue
-        with tarfile.open(layer_tar_path, "r", format=tarfile.PAX_FORMAT) as tar:
-            files[layer_id] = [normalize_abs(n) for n in tar.getnames()]
-    return files
-
-
-def _path_hierarchy(path: str) -> List[str]:
-    p = pathlib.PurePath(path)
-    if len(p.parts) == 1:
-        return list(p.parts)
-    head = []
-    acc: List[str] = []
-    for part in p.parts[:-1]:
-        head = [*head, part]
-        acc.append(str(pathlib.PurePath(*head)))
-    return acc
+        key = (digests or {}).get(layer_id) or (layer_id if oci else None)
+        if cache is not None and key is not None:
+            cached = cache.path_set(key)
+            if cached is not None:
+                sets.append(cached)
+                continue
+        tasks.append(source.locate(name))
+        keys.append(key)
+    if not sets and not tasks:
+        return None
+    files = PathIndex()
+    # The pool's results come first, so that zip runs it to its end
+    for paths, key in zip(map_layers(layer_paths, tasks, jobs), keys):
+        if cache is not None and key is not None:
+            stored = cache.store_path_set(key, paths)
+            if stored is not None:
+                sets.append(stored)
+                continue
+        for p in paths:
+            files.add(p)
+    if len(files):
+        sets.append(files)
+    return sets
 
 
-def _reduce_markers(markers: Dict[tarfile.TarInfo, tarfile.ExFileObject]) -> None:
+def _reduce_markers(markers: List[LayerMember]) -> None:
     """Reduce marker files to a minimal necessary set in-place.
 
     Removes a marker if a higher-level marker (covering its parent directory)
@@ -65,23 +120,29 @@ def _reduce_markers(markers: Dict[tarfile.TarInfo, tarfile.ExFileObject]) -> Non
     """
     if not markers:
         return
-    marked_files = [normalize_abs(m.name.replace(".wh.", "")) for m in markers.keys()]
-    to_remove: List[tarfile.TarInfo] = []
-    for marker in list(markers.keys()):
-        path = normalize_abs(marker.name.replace(".wh.", ""))
-        for directory in _path_hierarchy(path):
-            if directory in marked_files:
-                to_remove.append(marker)
-                break
-    for marker in to_remove:
-        markers.pop(marker, None)
+    marked_files = PathIndex()
+    for m in markers:
+        marked_files.add(normalize_abs(m.name.replace(".wh.", "")))
+    # The root directory is part of every path hierarchy
+    root_marked = "/" in marked_files
+    markers[:] = [
+        marker
+        for marker in markers
+        if not (
+            root_marked
+            or marked_files.covering(
+                normalize_abs(marker.name.replace(".wh.", "")), strict=True
+            )
+        )
+    ]
 
 
 def _add_markers(
-    markers: Dict[tarfile.TarInfo, tarfile.ExFileObject],
-    squashed_tar: tarfile.TarFile,
-    files_in_layers: Dict[str, List[str]],
-    added_symlinks: List[List[str]],
+    markers: List[LayerMember],
+    plan: List[Tuple[Optional[int], LayerMember]],
+    squashed_files: PathIndex,
+    files_in_layers: Optional[List[Container[str]]],
+    added_symlinks: PathIndex,
 ) -> None:
     """Add back necessary whiteout marker files to the squashed tar.
 
@@ -90,45 +151,78 @@ def _add_markers(
     """
     if not markers:
         return
-    existing_files = [normalize_abs(n) for n in squashed_tar.getnames()]
-    for marker, marker_file in markers.items():
+    for marker in markers:
         actual_file = marker.name.replace(".wh.", "")
         normalized_file = normalize_abs(actual_file)
         # Skip if on a symlink path
         if _file_should_be_skipped(normalized_file, added_symlinks):
             continue
         # Skip if it was already added for some reason
-        if normalized_file in existing_files:
+        if normalized_file in squashed_files:
             continue
         # Decide if we need to add it based on files present in preserved layers
-        should_add = False
-        if files_in_layers:
-            for files in files_in_layers.values():
-                if normalized_file in files:
-                    should_add = True
-                    break
-        else:
-            should_add = True
-        if should_add:
-            # AUFS whiteouts are usually hardlinks; recreate as a regular file entry
-            squashed_tar.addfile(tarfile.TarInfo(name=marker.name), marker_file)
-            existing_files.append(normalize_abs(marker.name))
+        if files_in_layers is None or any(
+            normalized_file in files for files in files_in_layers
+        ):
+            plan.append((None, marker))
+            squashed_files.add(normalize_abs(marker.name))
 
 
 def squash_layers(
     layer_ids_to_squash: List[str],
     layer_ids_to_keep: List[str],
-    old_root: Path,
-    new_root: Path,
+    source,
+    writer,
     oci: bool,
-) -> Tuple[Optional[Path], List[str]]:
-    squashed_dir = new_root / "squashed"
-    squashed_dir.mkdir(parents=True, exist_ok=True)
-    squashed_tar_path = squashed_dir / "layer.tar"
-
-    # Find files in kept layers to help with whiteout processing later
-    # For simplicity, we calculate on demand while iterating
-
+    work: WorkArea,
+    jobs: int = 1,
+    cache: Optional[SquashCache] = None,
+    digests: Optional[Dict[str, str]] = None,
+    gzip_level: Optional[int] = None,
+    parts: int = 1,
+    max_layer_size: Optional[int] = None,
+    reproducible: bool = False,
+    clamp_mtime: Optional[int] = None,
+    indexed: Optional[Dict[str, LayerIndex]] = None,
+    squashed_name: Optional[str] = None,
+    warm: Optional[WarmCache] = None,
+) -> Tuple[List[LayerBlob], List[str]]:
+    """Merge the layers to squash into ``squashed/layer.tar`` of the output image.
+
+    Layer headers are first indexed in parallel by ``jobs`` worker processes
+    (compressed layers are decompressed into a ``work.scope()``, released once
+    the squashed layers are written). The merge then walks the member records
+    newest to oldest as they arrive to plan the surviving entries, dropping
+    each layer's records once it has been merged, and finally copies the
+    surviving tar records into the output.
+
+    With a ``cache``, the result is looked up by the chain of layer digests
+    (``digests`` maps layer ids to content digests, e.g. diff_ids). A cached
+    squash of the oldest layers to squash is used as the bottom layer of the
+    merge if it is ``extendable`` (see ``plan_squash``), and a complete match
+    skips the merge altogether.
+
+    With ``gzip_level``, the squashed layer is written as a gzip blob of an
+    OCI layout instead, compressed on ``jobs`` threads.
+
+    The result is split into ``parts`` layers of about the same size, or
+    more to keep them under ``max_layer_size`` bytes where possible (see
+    ``split_plan``); further layers are named ``squashed-2/layer.tar``, etc.
+    ``squashed_name`` names all of them instead, e.g. ``{digest}/layer.tar``
+    for content-addressed names that several images can share.
+
+    With ``reproducible``, entries are sorted by path and their headers
+    normalized (see ``_write_plan``), so that equal content gives equal bytes
+    however it was layered.
+
+    ``indexed`` maps layer ids to indexes built beforehand, e.g. once for the
+    layers shared by several platforms; those are not indexed again, and
+    their member lists are left intact. Other layers are looked up in
+    ``warm`` first, if given, keyed by ``digests``.
+
+    Returns the squashed layers, bottom first (empty if there was nothing to
+    squash), and the real layer ids that are preserved.
+    """
     # Work through layers newest→oldest (reverse order), like original logic
     real_layers_to_squash = [
         lid for lid in layer_ids_to_squash if not lid.startswith("<missing-")
@@ -138,123 +232,736 @@ def squash_layers(
     ]
 
     if not real_layers_to_squash:
-        return None, real_layers_to_keep
-
-    with tarfile.open(
-        squashed_tar_path, "w", format=tarfile.PAX_FORMAT
-    ) as squashed_tar:
-        to_skip: List[List[str]] = []
-        skipped_markers: Dict[tarfile.TarInfo, tarfile.ExFileObject] = {}
-        skipped_sym_links: List[Dict[str, tarfile.TarInfo]] = []
-        skipped_hard_links: List[Dict[str, tarfile.TarInfo]] = []
-        skipped_files: List[Dict[str, tuple]] = []
-        squashed_files: List[str] = []
-        opaque_dirs: List[str] = []
-
-        reading_layers: List[tarfile.TarFile] = []
-
-        for layer_id in reversed(real_layers_to_squash):
-            layer_tar_path = _layer_tar_path(old_root, oci, layer_id)
-            if not layer_tar_path.exists():
-                raise SquashError(f"Layer tar not found: {layer_tar_path}")
-            layer_tar = tarfile.open(layer_tar_path, "r", format=tarfile.PAX_FORMAT)
-            reading_layers.append(layer_tar)
-            members = layer_tar.getmembers()
-            markers = _marker_files(layer_tar, members)
-
-            skipped_sym_link_files: Dict[str, tarfile.TarInfo] = {}
-            skipped_hard_link_files: Dict[str, tarfile.TarInfo] = {}
-            skipped_files_in_layer: Dict[str, tuple] = {}
-
-            files_to_skip: List[str] = []
-            layer_opaque_dirs: List[str] = []
-
-            skipped_sym_links.append(skipped_sym_link_files)
-            to_skip.append(files_to_skip)
-
-            for marker, marker_file in markers.items():
-                if marker.name.endswith(".wh..wh..opq"):
-                    opaque_dir = os.path.dirname(marker.name)
-                    layer_opaque_dirs.append(opaque_dir)
-                else:
-                    files_to_skip.append(normalize_abs(marker.name.replace(".wh.", "")))
-                    skipped_markers[marker] = marker_file
-
-            for member in members:
-                normalized_name = normalize_abs(member.name)
-                if _is_in_opaque_dir(member, opaque_dirs):
-                    continue
-                if member.issym():
-                    skipped_sym_link_files[normalized_name] = member
-                    continue
-                if member in skipped_markers.keys():
-                    continue
-                if _file_should_be_skipped(normalized_name, skipped_sym_links):
-                    f = (
-                        member,
-                        layer_tar.extractfile(member) if member.isfile() else None,
+        return [], real_layers_to_keep
+
+    stats = writer.stats
+    locations = locate_layers(source, oci, real_layers_to_squash)
+    variant = ""
+    if reproducible:
+        variant = "reproducible" if clamp_mtime is None else f"epoch:{clamp_mtime}"
+    if cache is not None:
+        digests = digests or {}
+        keep_chain = [digests.get(lid, lid) for lid in real_layers_to_keep]
+        squash_chain = [digests.get(lid, lid) for lid in real_layers_to_squash]
+        with stats.phase("cache"):
+            cached, covered = cache.lookup(
+                keep_chain,
+                squash_chain,
+                compressed=gzip_level is not None,
+                variant=variant,
+            )
+        if cached is not None:
+            stats.event(f"cache hit for {covered} of {len(squash_chain)} layers")
+            if covered == len(squash_chain) and parts == 1 and not max_layer_size:
+                with stats.phase("write") as phase:
+                    name = _squashed_name(gzip_level, 0, squashed_name)
+                    name = name.replace("{digest}", cached.digest)
+                    writer.add_range(
+                        name, str(cached.path), 0, cached.size, digest=cached.digest
                     )
-                    skipped_files_in_layer[normalized_name] = f
-                    continue
-                if _file_should_be_skipped(normalized_name, to_skip):
-                    continue
-                if normalized_name in squashed_files:
-                    continue
-                if member.islnk():
-                    skipped_hard_link_files[normalized_name] = member
-                    continue
-                content = layer_tar.extractfile(member) if member.isfile() else None
-                _add_file(member, content, squashed_tar, squashed_files, to_skip)
+                    phase.bytes_read += cached.size
+                blob = _squashed_blob(
+                    gzip_level,
+                    cached.diff_id,
+                    cached.digest,
+                    cached.size,
+                    template=squashed_name,
+                )
+                return [blob], real_layers_to_keep
+            locations[:covered] = [("<cached>", str(cached.path), 0, cached.size)]
+
+    # Layers indexed here, like a cached squash, are decompressed into a scope
+    # of their own, released once written: ``work`` may hold indexes shared
+    # with other squashes
+    with work.scope() as scratch:
+        indexes = _indexed(
+            list(reversed(locations)),
+            scratch,
+            jobs,
+            stats,
+            indexed or {},
+            warm,
+            digests,
+        )
+        plan, layers, _, extendable = plan_squash(
+            indexes,
+            stats,
+            source,
+            oci,
+            real_layers_to_keep,
+            jobs,
+            cache,
+            digests,
+            keep_members=bool(indexed),
+        )
+        if reproducible:
+            _sort_plan(plan)
+        if max_layer_size:
+            total = sum(_entry_size(member) for _, member in plan)
+            parts = max(parts, -(-total // max_layer_size))
+
+        # Phase 2: copy the surviving entries' tar records into the squashed layers
+        blobs = []
+        for part, entries in enumerate(split_plan(plan, parts)):
+            with stats.phase("write") as phase:
+                name = _squashed_name(gzip_level, part, squashed_name)
+                with writer.add_stream(name) as squashed_out:
+                    if gzip_level is None:
+                        _write_plan(
+                            entries, layers, squashed_out, reproducible, clamp_mtime
+                        )
+                        diff_id = None
+                    else:
+                        with GzipWriter(squashed_out, gzip_level, jobs) as gz:
+                            _write_plan(entries, layers, gz, reproducible, clamp_mtime)
+                        diff_id = gz.diff_id
+                phase.entries += len(entries)
+                phase.bytes_read += squashed_out.size
+            blobs.append(
+                _squashed_blob(
+                    gzip_level,
+                    diff_id or squashed_out.digest,
+                    squashed_out.digest,
+                    squashed_out.size,
+                    part,
+                    squashed_name,
+                )
+            )
 
-            skipped_hard_links.append(skipped_hard_link_files)
-            skipped_files.append(skipped_files_in_layer)
-            opaque_dirs += layer_opaque_dirs
+    # A split squash is not cached; its parts depend on the split options
+    if cache is not None and len(blobs) == 1:
+        with stats.phase("cache"):
+            cache.store(
+                keep_chain,
+                squash_chain,
+                writer,
+                squashed_out,
+                compressed=gzip_level is not None,
+                diff_id=diff_id,
+                variant=variant,
+                extendable=extendable,
+            )
+    return blobs, real_layers_to_keep
+
+
+def _squashed_name(
+    gzip_level: Optional[int], part: int = 0, template: Optional[str] = None
+) -> str:
+    if gzip_level is not None:
+        return "blobs/sha256/{digest}"
+    if template is not None:
+        return template
+    return "squashed/layer.tar" if not part else f"squashed-{part + 1}/layer.tar"
+
+
+def _squashed_blob(
+    gzip_level: Optional[int],
+    diff_id: str,
+    digest: str,
+    size: int,
+    part: int = 0,
+    template: Optional[str] = None,
+) -> LayerBlob:
+    return LayerBlob(
+        _squashed_name(gzip_level, part, template).replace("{digest}", digest),
+        f"sha256:{diff_id}",
+        f"sha256:{digest}",
+        size,
+        DOCKER_LAYER if gzip_level is None else OCI_LAYER_GZIP,
+    )
+
+
+def _sort_plan(plan: List[Tuple[Optional[int], LayerMember]]) -> None:
+    """Sort planned entries by path, placing hardlinks after their targets."""
+    links = {
+        member.path: normalize_abs(member.linkname)
+        for layer, member in plan
+        if layer is not None and member.islnk()
+    }
+
+    def depth(path: str) -> int:
+        seen = set()
+        while path in links and path not in seen:
+            seen.add(path)
+            path = links[path]
+        return len(seen)
+
+    plan.sort(key=lambda entry: (depth(entry[1].path), entry[1].path))
+
+
+def _entry_size(member: LayerMember) -> int:
+    return member.end - member.offset if member.end else tarfile.BLOCKSIZE
+
+
+def split_plan(
+    plan: List[Tuple[Optional[int], LayerMember]], parts: int
+) -> List[List[Tuple[Optional[int], LayerMember]]]:
+    """Partition planned entries into at most ``parts`` layers of similar size.
+
+    Hardlinks stay in the layer of their target, and whiteouts, including
+    opaque directory markers, go to the bottom layer so that they only hide
+    content of the preserved layers. Each layer also gets the directory
+    entries of the parents of its entries, so that they keep their metadata
+    whichever layer is unpacked first. Groups of entries are placed largest
+    first on the smallest layer; entries keep their plan order.
+    """
+    if parts <= 1 or len(plan) <= 1:
+        return [plan]
+    group = list(range(len(plan)))
+
+    def find(i: int) -> int:
+        while group[i] != i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+
+    paths = {member.path: i for i, (_, member) in enumerate(plan)}
+    dirs = {member.path: i for i, (_, member) in enumerate(plan) if member.isdir()}
+    for i, (layer, member) in enumerate(plan):
+        if layer is not None and member.islnk():
+            target = paths.get(normalize_abs(member.linkname))
+            if target is not None:
+                group[find(i)] = find(target)
+
+    sizes: Dict[int, int] = {}
+    bottom = set()
+    for i, (_, member) in enumerate(plan):
+        root = find(i)
+        sizes[root] = sizes.get(root, 0) + _entry_size(member)
+        if os.path.basename(member.path).startswith(".wh."):
+            bottom.add(root)
+
+    loads = [0] * parts
+    assigned = {}
+    for root in sorted(bottom):
+        assigned[root] = 0
+        loads[0] += sizes[root]
+    for root in sorted(sizes, key=lambda r: -sizes[r]):
+        if root not in assigned:
+            part = loads.index(min(loads))
+            assigned[root] = part
+            loads[part] += sizes[root]
+
+    members: List[set] = [set() for _ in range(parts)]
+    for i in range(len(plan)):
+        members[assigned[find(i)]].add(i)
+    for part in members:
+        walked = set()
+        for i in list(part):
+            path = os.path.dirname(plan[i][1].path)
+            while path not in walked and path != "/":
+                walked.add(path)
+                if path in dirs:
+                    part.add(dirs[path])
+                path = os.path.dirname(path)
+    return [[plan[i] for i in sorted(part)] for part in members if part]
+
+
+class SquashPlan(NamedTuple):
+    """The surviving entries of a squash, decided from member records alone."""
+
+    # (layer, member) in output order; layer is None for reinjected whiteouts
+    entries: List[Tuple[Optional[int], LayerMember]]
+    layers: List[LayerIndex]  # newest first, as indexed by ``entries``
+    paths: PathIndex  # normalized paths of the surviving entries
+    # Whether merging newer layers on top of the squashed layer gives what
+    # merging them with the layers squashed would (see ``plan_squash``)
+    extendable: bool = True
+
+
+def plan_squash(
+    indexes: Iterable[LayerIndex],
+    stats: Stats,
+    source,
+    oci: bool,
+    real_layers_to_keep: List[str],
+    jobs: int = 1,
+    cache: Optional[SquashCache] = None,
+    digests: Optional[Dict[str, str]] = None,
+    keep_members: bool = False,
+) -> SquashPlan:
+    """Merge the indexes of the layers to squash, newest first, into a plan.
+
+    Each layer's member list is dropped once it has been merged unless
+    ``keep_members`` is set. Whiteout markers are reinjected for files of the
+    preserved layers; ``cache`` and ``digests`` serve their path sets.
+
+    The plan is ``extendable`` unless one of its decisions depends on entries
+    that newer layers may add or remove, so that a cached squash is only
+    merged with newer layers when that gives what squashing all of them would.
+    """
+    plan: List[Tuple[Optional[int], LayerMember]] = []
+    to_skip = PathIndex()
+    skipped_markers: List[LayerMember] = []
+    skipped_sym_links: List[Dict[str, LayerMember]] = []
+    sym_link_paths = PathIndex()
+    skipped_hard_links: List[Dict[str, LayerMember]] = []
+    skipped_files: List[Dict[str, LayerMember]] = []
+    squashed_files = PathIndex()
+    opaque_dirs = PathIndex()
+    layers: List[LayerIndex] = []
+
+    for layer, index in enumerate(indexes):
+        layer_nb = layer + 1
+
+        skipped_sym_link_files: Dict[str, LayerMember] = {}
+        skipped_hard_link_files: Dict[str, LayerMember] = {}
+        skipped_files_in_layer: Dict[str, LayerMember] = {}
+
+        layer_opaque_dirs: List[str] = []
+
+        skipped_sym_links.append(skipped_sym_link_files)
+
+        for marker in index.members:
+            if ".wh." not in marker.name:
+                continue
+            if marker.name.endswith(".wh..wh..opq"):
+                opaque_dir = os.path.dirname(marker.name)
+                layer_opaque_dirs.append(opaque_dir)
+            else:
+                to_skip.add(normalize_abs(marker.name.replace(".wh.", "")), layer_nb)
+                skipped_markers.append(marker)
 
-        _add_hardlinks(squashed_tar, squashed_files, to_skip, skipped_hard_links)
-        added_symlinks = _add_symlinks(
-            squashed_tar, squashed_files, to_skip, skipped_sym_links
+        for member in index.members:
+            normalized_name = member.path
+            if _is_in_opaque_dir(member, opaque_dirs):
+                continue
+            if member.issym():
+                skipped_sym_link_files[normalized_name] = member
+                sym_link_paths.add(normalized_name)
+                continue
+            if _is_marker(member):
+                continue
+            if _file_should_be_skipped(normalized_name, sym_link_paths):
+                skipped_files_in_layer[normalized_name] = member
+                continue
+            if _file_should_be_skipped(normalized_name, to_skip):
+                continue
+            if normalized_name in squashed_files:
+                continue
+            if member.islnk():
+                skipped_hard_link_files[normalized_name] = member
+                continue
+            _add_file(layer, member, plan, squashed_files, to_skip)
+
+        skipped_hard_links.append(skipped_hard_link_files)
+        skipped_files.append(skipped_files_in_layer)
+        for opaque_dir in layer_opaque_dirs:
+            opaque_dirs.add(opaque_dir)
+        # Drop the layer's member list; only records that were planned or
+        # deferred stay referenced, so memory follows the surviving entries.
+        if not keep_members:
+            index.members = []
+        layers.append(index)
+
+    with stats.phase("merge"):
+        # Newer layers may add the target of a hardlink dropped here
+        extendable = all(
+            normalize_abs(member.linkname) in squashed_files
+            for links in skipped_hard_links
+            for member in links.values()
         )
-        for layer in skipped_files:
-            for member, content in layer.values():
-                _add_file(member, content, squashed_tar, squashed_files, added_symlinks)
-
-        # After assembling files, re-add necessary whiteout markers based on preserved layers
-        if real_layers_to_keep:
-            files_in_layers_to_keep = _files_in_layers(
-                old_root, oci, real_layers_to_keep
+        _add_hardlinks(plan, squashed_files, to_skip, skipped_hard_links)
+        added_symlinks = _add_symlinks(plan, squashed_files, to_skip, skipped_sym_links)
+        # or replace the symlinks that decide the entries under their paths
+        extendable = (
+            extendable
+            and not any(skipped_files)
+            and not any(
+                member.path not in squashed_files
+                and _file_should_be_skipped(member.path, added_symlinks)
+                for symlinks in skipped_sym_links
+                for member in symlinks.values()
             )
+        )
+        for layer, files in enumerate(skipped_files):
+            for member in files.values():
+                _add_file(layer, member, plan, squashed_files, added_symlinks)
+
+    # After assembling files, re-add necessary whiteout markers based on preserved layers
+    if real_layers_to_keep:
+        with stats.phase("whiteouts") as phase:
             _reduce_markers(skipped_markers)
-            _add_markers(
-                skipped_markers, squashed_tar, files_in_layers_to_keep, added_symlinks
+            if skipped_markers:
+                files_in_layers_to_keep = _files_in_layers(
+                    source, oci, real_layers_to_keep, jobs, cache, digests
+                )
+                planned = len(plan)
+                _add_markers(
+                    skipped_markers,
+                    plan,
+                    squashed_files,
+                    files_in_layers_to_keep,
+                    added_symlinks,
+                )
+                phase.entries += len(plan) - planned
+            # Newer layers may remove a file that a marker was left out for,
+            # and a reinjected marker would hide the entries below it
+            targets = [
+                normalize_abs(marker.name.replace(".wh.", ""))
+                for marker in skipped_markers
+            ]
+            hidden = PathIndex()
+            for layer, member in plan:
+                if layer is None:
+                    hidden.add(normalize_abs(member.name.replace(".wh.", "")))
+            extendable = (
+                extendable
+                and not any(
+                    target in squashed_files
+                    or _file_should_be_skipped(target, added_symlinks)
+                    for target in targets
+                )
+                and not any(
+                    layer is not None and _file_should_be_skipped(member.path, hidden)
+                    for layer, member in plan
+                )
             )
+    return SquashPlan(plan, layers, squashed_files, extendable)
+
+
+@dataclass
+class LayerAnalysis:
+    """Where the file bytes of one squashed layer end up."""
+
+    layer_id: str
+    entries: int
+    size: int  # bytes of file data in the layer
+    surviving: int  # copied into the squashed layer
+    shadowed: int  # replaced by a newer entry for the same path
+    deleted: int  # removed by a whiteout or an opaque directory
+
 
-        for tar in reading_layers:
-            tar.close()
+@dataclass
+class SquashAnalysis:
+    """Projected result of a squash, predicted from tar headers only."""
 
-    return squashed_tar_path, real_layers_to_keep
+    layers: List[LayerAnalysis]  # oldest first
+    entries: int  # entries of the squashed layer
+    squashed_size: int  # bytes of the squashed layer tar
+    whiteouts: List[str]  # reinjected whiteout markers
+    preserved_size: int  # bytes of the preserved layer tars, uncompressed
+    output_size: int  # bytes of all layers as members of the output tar
 
 
-def _is_in_opaque_dir(member: tarfile.TarInfo, dirs: List[str]) -> bool:
-    for d in dirs:
-        if member.name == d or member.name.startswith(f"{d}/"):
-            return True
-    return False
+def _member_size(size: int) -> int:
+    return tarfile.BLOCKSIZE + -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
 
 
-def _layer_tar_path(root: Path, oci: bool, layer_id: str) -> Path:
-    if oci:
-        digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
-        return root / "blobs" / "sha256" / digest
+def _tar_size(source, name: str) -> int:
+    """Return the uncompressed size of a layer tar without decompressing it.
+
+    Gzip records it (modulo 4 GiB) in the trailer of its last member.
+    """
+    size = source.size(name)
+    with source.open(name) as f:
+        if not f.peek(2).startswith(b"\x1f\x8b") or size < 18:
+            return size
+        f.seek(-4, io.SEEK_END)
+        isize = struct.unpack("<I", f.read(4))[0]
+    while isize < size:
+        isize += 1 << 32
+    return isize
+
+
+def analyze_squash(
+    layer_ids_to_squash: List[str],
+    layer_ids_to_keep: List[str],
+    source,
+    oci: bool,
+    work: WorkArea,
+    jobs: int = 1,
+    stats: Optional[Stats] = None,
+    cache: Optional[SquashCache] = None,
+    digests: Optional[Dict[str, str]] = None,
+    warm: Optional[WarmCache] = None,
+    indexed: Optional[Dict[str, LayerIndex]] = None,
+) -> SquashAnalysis:
+    """Predict the outcome of ``squash_layers`` without writing anything.
+
+    Runs the same merge decisions on the layer tar headers only; file data
+    is never read, but compressed layers still have to be decompressed
+    into ``work`` to reach their headers.
+
+    ``indexed`` maps layer ids to indexes built beforehand, as for
+    ``squash_layers``; the indexes built here are added to it, so that the
+    squash that follows does not index the layers again.
+    """
+    stats = stats if stats is not None else Stats()
+    real_layers_to_squash = [
+        lid for lid in layer_ids_to_squash if not lid.startswith("<missing-")
+    ]
+    real_layers_to_keep = [
+        lid for lid in layer_ids_to_keep if not lid.startswith("<missing-")
+    ]
+    locations = locate_layers(source, oci, real_layers_to_squash)
+    known = indexed if indexed is not None else {}
+    indexes = _indexed(
+        list(reversed(locations)), work, jobs, stats, known, warm, digests
+    )
+    plan = plan_squash(
+        indexes,
+        stats,
+        source,
+        oci,
+        real_layers_to_keep,
+        jobs,
+        cache,
+        digests,
+        keep_members=True,
+    )
+    known.update((index.layer_id, index) for index in plan.layers)
+
+    planned = {(layer, member.offset) for layer, member in plan.entries}
+    layers = []
+    for layer, index in enumerate(plan.layers):
+        result = LayerAnalysis(index.layer_id, len(index.members), 0, 0, 0, 0)
+        for member in index.members:
+            result.size += member.size
+            if (layer, member.offset) in planned:
+                result.surviving += member.size
+            elif member.path in plan.paths:
+                result.shadowed += member.size
+            else:
+                result.deleted += member.size
+        layers.append(result)
+    layers.reverse()
+
+    squashed_size = 0
+    whiteouts = []
+    for layer, member in plan.entries:
+        if layer is None:
+            info = tarfile.TarInfo(member.name)
+            squashed_size += len(
+                info.tobuf(tarfile.PAX_FORMAT, ENCODING, "surrogateescape")
+            )
+            whiteouts.append(member.name)
+        else:
+            squashed_size += member.end - member.offset
+    squashed_size += tarfile.BLOCKSIZE * 2
+    squashed_size += -squashed_size % tarfile.RECORDSIZE
+
+    preserved = [
+        _tar_size(source, layer_tar_name(oci, lid))
+        for lid in real_layers_to_keep
+        if source.exists(layer_tar_name(oci, lid))
+    ]
+    output_size = sum(_member_size(size) for size in preserved)
+    if not real_layers_to_squash:
+        squashed_size = 0
     else:
-        digest = layer_id.split(":", 1)[1] if ":" in layer_id else layer_id
-        return root / digest / "layer.tar"
+        output_size += _member_size(squashed_size)
+    return SquashAnalysis(
+        layers,
+        len(plan.entries),
+        squashed_size,
+        whiteouts,
+        sum(preserved),
+        output_size,
+    )
+
+
+@dataclass
+class SquashBoundary:
+    """Cut point picked by ``choose_boundary``, with the figures behind it."""
+
+    number: int  # layers to squash, from the top
+    reclaimed: int  # file bytes the squash drops
+    rewritten: int  # file bytes of the squashed layers copied into the new one
+    candidates: List[Tuple[int, int, int]]  # (number, reclaimed, rewritten)
+
+
+def choose_boundary(
+    layer_ids: List[str], analysis: SquashAnalysis, min_reclaim: int = 0
+) -> SquashBoundary:
+    """Pick how many of ``layer_ids`` to squash from an analysis of all of them.
+
+    Whether an entry is shadowed or deleted only depends on newer layers, so
+    one analysis of the whole image gives the bytes reclaimed by every cut.
+    Squashing a layer also rewrites its surviving bytes into a new layer that
+    no other image shares, so the cut maximizes reclaimed minus rewritten
+    bytes; ties keep more layers intact. The bottom layer is the base that
+    images share, so it is always kept. Cuts reclaiming less than
+    ``min_reclaim`` bytes (or nothing) are not considered.
+    """
+    per_layer = {layer.layer_id: layer for layer in analysis.layers}
+    real = [i for i, lid in enumerate(layer_ids) if not lid.startswith("<missing-")]
+    above_base = len(layer_ids) - real[0] - 1 if real else 0
+    candidates = []
+    reclaimed = rewritten = 0
+    for number in range(1, above_base + 1):
+        layer = per_layer.get(layer_ids[-number])
+        if layer is not None:
+            reclaimed += layer.shadowed + layer.deleted
+            rewritten += layer.surviving
+        if number > 1:
+            candidates.append((number, reclaimed, rewritten))
+    eligible = [c for c in candidates if c[1] > 0 and c[1] >= min_reclaim]
+    if not eligible:
+        best = max((c[1] for c in candidates), default=0)
+        raise SquashUnnecessaryError(
+            f"No squash reclaims at least {max(min_reclaim, 1)} bytes "
+            f"(at most {best} bytes)"
+        )
+    number, reclaimed, rewritten = max(eligible, key=lambda c: (c[1] - c[2], -c[0]))
+    return SquashBoundary(number, reclaimed, rewritten, candidates)
+
+
+def _indexed(
+    locations: List[tuple],
+    work: WorkArea,
+    jobs: int,
+    stats: Stats,
+    known: Dict[str, LayerIndex],
+    warm: Optional[WarmCache] = None,
+    keys: Optional[Dict[str, str]] = None,
+) -> Iterator[LayerIndex]:
+    """Yield the index of each location, indexing those not in ``known``."""
+    missing = [location for location in locations if location[0] not in known]
+    if warm is not None:
+        fresh = _scanned(warm.index_layers(missing, work, jobs, keys), stats)
+    else:
+        fresh = _scanned(index_layers(missing, work, jobs), stats)
+    try:
+        for location in locations:
+            index = known.get(location[0])
+            yield index if index is not None else next(fresh)
+        # Run out the indexing so its worker pool shuts down now, rather than
+        # whenever the generator is collected
+        for _ in fresh:
+            pass
+    finally:
+        fresh.close()
+
+
+def _scanned(
+    indexes: Generator[LayerIndex, None, None], stats: Stats
+) -> Iterator[LayerIndex]:
+    """Pass layer indexes through, timing the wait for each as "scan".
+
+    The consumer's loop body runs while this generator is suspended at
+    ``yield``, so it is timed as the "merge" phase.
+    """
+    with contextlib.closing(indexes):
+        while True:
+            with stats.phase("scan", report=False) as phase:
+                index = next(indexes, None)
+                if index is None:
+                    return
+                phase.entries += len(index.members)
+                phase.bytes_read += index.size
+            stats.add_layer(index.layer_id, len(index.members), index.size)
+            with stats.phase("merge", report=False) as phase:
+                phase.entries += len(index.members)
+                yield index
+
+
+def _normalize_tarinfo(info: tarfile.TarInfo, clamp_mtime: Optional[int]) -> None:
+    """Reduce ``info`` to what describes the file, so equal files encode equally."""
+    info.pax_headers = {
+        key: value
+        for key, value in info.pax_headers.items()
+        if key not in _DERIVED_PAX_KEYS and not key.startswith("GNU.sparse.")
+    }
+    info.mtime = int(info.mtime)
+    if clamp_mtime is not None and info.mtime > clamp_mtime:
+        info.mtime = clamp_mtime
+    if info.sparse is not None:
+        info.type = tarfile.REGTYPE
+        info.sparse = None
+
+
+def _write_plan(
+    plan: List[Tuple[Optional[int], LayerMember]],
+    layers: List[LayerIndex],
+    out,
+    normalize: bool = False,
+    clamp_mtime: Optional[int] = None,
+) -> None:
+    """Write the planned entries as a tar stream to ``out``.
 
+    Entries are copied as the raw header and data records of their source
+    layer tar, in-kernel, with runs of adjacent records merged into one copy.
+    Layers with global PAX headers are re-encoded through tarfile instead, as
+    their records do not carry those headers themselves. Reinjected whiteout
+    markers get a fresh header.
 
-def _add_hardlinks(squashed_tar, squashed_files, to_skip, skipped_hard_links):
+    With ``normalize``, every header is re-encoded without access and change
+    times or redundant PAX records, and with mtimes clamped to ``clamp_mtime``.
+    """
+    fds: Dict[int, int] = {}
+    readers: Dict[int, LayerReader] = {}
+    run: Optional[List[int]] = None  # [layer, start, end]
+
+    def open_fd(layer: int) -> int:
+        if layer not in fds:
+            fds[layer] = os.open(layers[layer].path, os.O_RDONLY)
+        return fds[layer]
+
+    def flush_run():
+        if run is not None:
+            layer, start, end = run
+            index = layers[layer]
+            out.copy_range(fds[layer], index.offset + start, end - start)
+
+    try:
+        for layer, member in plan:
+            if layer is not None and not layers[layer].pax_headers and not normalize:
+                if run is not None and run[0] == layer and run[2] == member.offset:
+                    run[2] = member.end
+                    continue
+                flush_run()
+                open_fd(layer)
+                run = [layer, member.offset, member.end]
+                continue
+            flush_run()
+            run = None
+            if layer is None:
+                # AUFS whiteouts are usually hardlinks; recreate as a regular file entry
+                info = tarfile.TarInfo(name=member.name)
+                out.write(info.tobuf(tarfile.PAX_FORMAT, ENCODING, "surrogateescape"))
+                continue
+            if layer not in readers:
+                readers[layer] = LayerReader(layers[layer])
+            info = readers[layer].tarinfo(member)
+            # Sparse data has to be expanded; the rest is copied in-kernel
+            data = None
+            if member.isfile() and info.sparse is not None:
+                data = readers[layer].extractfile(info)
+            if normalize:
+                _normalize_tarinfo(info, clamp_mtime)
+            out.write(info.tobuf(tarfile.PAX_FORMAT, ENCODING, "surrogateescape"))
+            if member.isfile():
+                if data is not None:
+                    tarfile.copyfileobj(data, out, info.size)
+                else:
+                    offset = layers[layer].offset + info.offset_data
+                    out.copy_range(open_fd(layer), offset, info.size)
+                remainder = info.size % tarfile.BLOCKSIZE
+                if remainder:
+                    out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        flush_run()
+        # End-of-archive marker, padded to a full record like tarfile does
+        out.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = out.tell() % tarfile.RECORDSIZE
+        if remainder:
+            out.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+    finally:
+        for fd in fds.values():
+            os.close(fd)
+        for reader in readers.values():
+            reader.close()
+
+
+def _is_in_opaque_dir(member: LayerMember, dirs: PathIndex) -> bool:
+    return bool(dirs.covering(member.name))
+
+
+def _add_hardlinks(plan, squashed_files, to_skip, skipped_hard_links):
     for layer, hardlinks_in_layer in enumerate(skipped_hard_links):
         current_layer = layer + 1
         for member in hardlinks_in_layer.values():
-            normalized_name = normalize_abs(member.name)
+            normalized_name = member.path
             normalized_linkname = normalize_abs(member.linkname)
             layer_skip_name = _file_should_be_skipped(normalized_name, to_skip)
             layer_skip_linkname = _file_should_be_skipped(normalized_linkname, to_skip)
@@ -268,29 +975,26 @@ def _add_hardlinks(squashed_tar, squashed_files, to_skip, skipped_hard_links):
             ):
                 pass
             else:
-                squashed_files.append(normalized_name)
-                squashed_tar.addfile(member)
+                squashed_files.add(normalized_name)
+                plan.append((layer, member))
 
 
-def _add_file(member, content, squashed_tar, squashed_files, to_skip):
-    normalized_name = normalize_abs(member.name)
+def _add_file(layer, member, plan, squashed_files, to_skip):
+    normalized_name = member.path
     if normalized_name in squashed_files:
         return
     if _file_should_be_skipped(normalized_name, to_skip):
         return
-    if content:
-        squashed_tar.addfile(member, content)
-    else:
-        squashed_tar.addfile(member)
-    squashed_files.append(normalized_name)
+    plan.append((layer, member))
+    squashed_files.add(normalized_name)
 
 
-def _add_symlinks(squashed_tar, squashed_files, to_skip, skipped_sym_links):
-    added_symlinks = []
+def _add_symlinks(plan, squashed_files, to_skip, skipped_sym_links):
+    added_symlinks = PathIndex()
     for layer, symlinks_in_layer in enumerate(skipped_sym_links):
         current_layer = layer + 1
         for member in symlinks_in_layer.values():
-            normalized_name = normalize_abs(member.name)
+            normalized_name = member.path
             normalized_linkname = normalize_abs(member.linkname)
             if normalized_name in squashed_files:
                 continue
@@ -303,7 +1007,7 @@ def _add_symlinks(squashed_tar, squashed_files, to_skip, skipped_sym_links):
             ):
                 pass
             else:
-                added_symlinks.append([normalized_name])
-                squashed_files.append(normalized_name)
-                squashed_tar.addfile(member)
+                added_symlinks.add(normalized_name)
+                squashed_files.add(normalized_name)
+                plan.append((layer, member))
     return added_symlinks
@@ -0,0 +1,219 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, astuple, dataclass, replace
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore[assignment]
+
+
+@dataclass
+class PhaseStats:
+    """Metrics of one phase; times and written bytes exclude nested phases."""
+
+    wall: float = 0.0
+    cpu: float = 0.0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    entries: int = 0
+    calls: int = 0
+
+
+def _cpu_time() -> float:
+    # Includes worker processes once they have been joined
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _max_rss(who) -> Optional[int]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _human(size: int) -> str:
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += _dir_size(Path(entry.path))
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_blocks * 512
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return total
+
+
+class Stats:
+    """Collects per-phase wall/CPU time, byte and entry counts of a squash run.
+
+    Phases may nest; time and output bytes are attributed to the innermost
+    running phase only, so the phases add up to the whole run. With
+    ``progress``, phase completions are reported on that stream as they
+    happen; ``on_phase`` is called with the name and metrics of each and
+    ``on_event`` with every progress message. A disabled instance (the
+    default) only does the bookkeeping.
+    """
+
+    def __init__(
+        self,
+        progress: Optional[TextIO] = None,
+        on_phase: Optional[Callable[[str, PhaseStats], None]] = None,
+        on_event: Optional[Callable[[str], None]] = None,
+    ):
+        self.phases: Dict[str, PhaseStats] = {}
+        self.layers: List[dict] = []
+        self.info: Dict[str, object] = {}
+        self.progress = progress
+        self.on_phase = on_phase
+        self.on_event = on_event
+        self._stack: List[Tuple[PhaseStats, float, float, int]] = []
+        self._output_pos: Callable[[], int] = lambda: 0
+        self._start = time.perf_counter()
+        self._cpu_start = _cpu_time()
+        self._work_dir: Optional[Path] = None
+        self._peak_disk = 0
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def track_output(self, tell: Callable[[], int]) -> None:
+        """Attribute output bytes to phases by sampling ``tell()`` at boundaries."""
+        self._output_pos = tell
+
+    def watch_work_dir(self, path: Path, interval: float = 0.25) -> None:
+        """Sample the disk usage of ``path`` in the background to find its peak."""
+        self._work_dir = path
+        self._sampler = threading.Thread(
+            target=self._sample_loop, args=(interval,), daemon=True
+        )
+        self._sampler.start()
+
+    def _sample_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self._sample_disk()
+
+    def _sample_disk(self) -> None:
+        if self._work_dir is not None:
+            self._peak_disk = max(self._peak_disk, _dir_size(self._work_dir))
+
+    def _pause_top(self, now: float, cpu: float, pos: int) -> None:
+        if self._stack:
+            phase, start, cpu_start, pos_start = self._stack[-1]
+            phase.wall += now - start
+            phase.cpu += cpu - cpu_start
+            phase.bytes_written += pos - pos_start
+
+    def _resume_top(self, now: float, cpu: float, pos: int) -> None:
+        if self._stack:
+            phase = self._stack[-1][0]
+            self._stack[-1] = (phase, now, cpu, pos)
+
+    @contextlib.contextmanager
+    def phase(self, name: str, report: bool = True) -> Iterator[PhaseStats]:
+        """Time a phase; phases entered repeatedly under one name accumulate.
+
+        Unless ``report`` is false, the metrics of this run of a top-level
+        phase are written to the progress stream when it ends.
+        """
+        phase = self.phases.setdefault(name, PhaseStats())
+        before = replace(phase)
+        phase.calls += 1
+        now, cpu, pos = time.perf_counter(), _cpu_time(), self._output_pos()
+        self._pause_top(now, cpu, pos)
+        self._stack.append((phase, now, cpu, pos))
+        try:
+            yield phase
+        finally:
+            now, cpu, pos = time.perf_counter(), _cpu_time(), self._output_pos()
+            self._pause_top(now, cpu, pos)
+            self._stack.pop()
+            self._resume_top(now, cpu, pos)
+            self._sample_disk()
+            if report and not self._stack and self._reporting:
+                delta = PhaseStats(
+                    *(a - b for a, b in zip(astuple(phase), astuple(before)))
+                )
+                self.report(name, delta)
+                if self.on_phase is not None:
+                    self.on_phase(name, delta)
+
+    @property
+    def _reporting(self) -> bool:
+        return any(x is not None for x in (self.progress, self.on_phase, self.on_event))
+
+    def report(self, name: str, phase: PhaseStats) -> None:
+        parts = [f"{phase.wall:.2f}s", f"cpu {phase.cpu:.2f}s"]
+        if phase.entries:
+            parts.append(f"{phase.entries} entries")
+        if phase.bytes_read:
+            parts.append(f"{_human(phase.bytes_read)} read")
+        if phase.bytes_written:
+            parts.append(f"{_human(phase.bytes_written)} written")
+        self.event(f"{name}: " + ", ".join(parts))
+
+    def event(self, message: str) -> None:
+        if self.progress is not None:
+            print(f"[oci-squash] {message}", file=self.progress, flush=True)
+        if self.on_event is not None:
+            self.on_event(message)
+
+    def add_layer(self, layer_id: str, entries: int, size: int) -> None:
+        self.layers.append({"layer_id": layer_id, "entries": entries, "bytes": size})
+        self.event(
+            f"scanned layer {len(self.layers)} {layer_id[:19]}: "
+            f"{entries} entries, {_human(size)}"
+        )
+
+    def current_phase(self) -> Optional[str]:
+        """Name of the innermost running phase; safe to call from other threads."""
+        top = self._stack[-1:]
+        if not top:
+            return None
+        return next((n for n, p in list(self.phases.items()) if p is top[0][0]), None)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        self._sample_disk()
+
+    def as_dict(self) -> dict:
+        return {
+            **self.info,
+            "wall_time": time.perf_counter() - self._start,
+            "cpu_time": _cpu_time() - self._cpu_start,
+            "peak_rss_bytes": _max_rss(resource.RUSAGE_SELF) if resource else None,
+            "peak_workers_rss_bytes": (
+                _max_rss(resource.RUSAGE_CHILDREN) if resource else None
+            ),
+            "peak_work_dir_bytes": self._peak_disk,
+            "phases": {
+                name: asdict(phase) for name, phase in list(self.phases.items())
+            },
+            "layers": list(self.layers),
+        }
+
+    def write_json(self, path: Path) -> None:
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+            f.write("\n")
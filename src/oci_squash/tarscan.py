@@ -0,0 +1,174 @@
+import tarfile
+from typing import List, Optional, Tuple
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+ENCODING = "utf-8"
+
+# (name, type, linkname, offset, end, size, mode)
+Header = Tuple[str, bytes, str, int, int, int, int]
+
+_NUL_BLOCK = bytes(BLOCKSIZE)
+_DATA_TYPES = frozenset(tarfile.REGULAR_TYPES) - {tarfile.GNUTYPE_SPARSE}
+_EXTENDED_TYPES = frozenset(
+    (
+        tarfile.GNUTYPE_SPARSE,
+        tarfile.GNUTYPE_LONGNAME,
+        tarfile.GNUTYPE_LONGLINK,
+        tarfile.XHDTYPE,
+        tarfile.XGLTYPE,
+        tarfile.SOLARIS_XHDTYPE,
+    )
+)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _nts(b: bytes) -> str:
+    p = b.find(b"\0")
+    if p != -1:
+        b = b[:p]
+    return b.decode(ENCODING, "surrogateescape")
+
+
+def _nti(b: bytes) -> int:
+    if b[0] in (0o200, 0o377):
+        # GNU base-256 encoding, as in tarfile.nti
+        n = 0
+        for i in range(len(b) - 1):
+            n <<= 8
+            n += b[i + 1]
+        if b[0] == 0o377:
+            n = -(256 ** (len(b) - 1) - n)
+        return n
+    p = b.find(b"\0")
+    if p != -1:
+        b = b[:p]
+    b = b.strip()
+    if not b:
+        return 0
+    try:
+        return int(b, 8)
+    except ValueError:
+        raise _Unsupported() from None
+
+
+def _pax_records(data: bytes) -> dict:
+    records = {}
+    pos = 0
+    while pos < len(data) and data[pos] != 0:
+        sp = data.find(b" ", pos)
+        if sp == -1:
+            raise _Unsupported()
+        try:
+            length = int(data[pos:sp])
+        except ValueError:
+            raise _Unsupported() from None
+        record = data[sp + 1 : pos + length]
+        eq = record.find(b"=")
+        if length < 5 or eq < 1 or data[pos + length - 1 : pos + length] != b"\n":
+            raise _Unsupported()
+        try:
+            key = record[:eq].decode(ENCODING)
+        except UnicodeDecodeError:
+            raise _Unsupported() from None
+        records[key] = record[eq + 1 : -1].decode(ENCODING, "surrogateescape")
+        pos += length
+    return records
+
+
+def scan(buf, base: int = 0, size: Optional[int] = None) -> Optional[List[Header]]:
+    """Return the header records of the tar at ``buf[base:base + size]``.
+
+    Returns ``None`` if the tar uses headers this scanner does not support.
+    Parses ustar, GNU long name/link and PAX extended headers without building
+    ``TarInfo`` objects. Global PAX headers, sparse files, bad checksums and
+    unusual header chains are left to ``tarfile``. ``offset`` is where the
+    member's first header block starts (including any extended headers) and
+    ``end`` is where its padded data ends, both relative to ``base``.
+    """
+    if size is None:
+        size = len(buf) - base
+    try:
+        return _scan(buf, base, base + size)
+    except _Unsupported:
+        return None
+
+
+def _scan(buf, base: int, total: int) -> List[Header]:
+    headers: List[Header] = []
+    pos = base
+    while pos + BLOCKSIZE <= total:
+        start = pos
+        long_name = long_link = pax = None
+        while True:
+            block = buf[pos : pos + BLOCKSIZE]
+            if block == _NUL_BLOCK:
+                if pos != start:
+                    raise _Unsupported()
+                return headers
+            chksum = _nti(block[148:156])
+            unsigned = sum(block) - sum(block[148:156]) + 256
+            if chksum != unsigned:
+                raise _Unsupported()
+            type_ = block[156:157]
+            size = _nti(block[124:136])
+            data_pos = pos + BLOCKSIZE
+            if type_ not in _EXTENDED_TYPES:
+                break
+            if size < 0 or data_pos + size > total:
+                raise _Unsupported()
+            data = buf[data_pos : data_pos + size]
+            pos = data_pos + -(-size // BLOCKSIZE) * BLOCKSIZE
+            if type_ == tarfile.GNUTYPE_LONGNAME and long_name is None:
+                long_name = _nts(data)
+            elif type_ == tarfile.GNUTYPE_LONGLINK and long_link is None:
+                long_link = _nts(data)
+            elif type_ == tarfile.XHDTYPE and pax is None:
+                pax = _pax_records(data)
+            else:
+                raise _Unsupported()
+        if pax is not None and (long_name is not None or long_link is not None):
+            raise _Unsupported()
+
+        name = _nts(block[0:100])
+        linkname = _nts(block[157:257])
+        mode = _nti(block[100:108])
+        prefix = _nts(block[345:500])
+        if type_ == tarfile.AREGTYPE and name.endswith("/"):
+            type_ = tarfile.DIRTYPE
+        if type_ == tarfile.DIRTYPE:
+            name = name.rstrip("/")
+        if prefix:
+            name = prefix + "/" + name
+        if long_name is not None:
+            name = long_name
+            if type_ == tarfile.DIRTYPE:
+                name = name.rstrip("/")
+        if long_link is not None:
+            linkname = long_link
+        if pax:
+            for key in pax:
+                if key == "hdrcharset" or key.startswith("GNU.sparse."):
+                    raise _Unsupported()
+            if "path" in pax:
+                name = pax["path"].rstrip("/")
+            if "linkpath" in pax:
+                linkname = pax["linkpath"]
+            if "size" in pax:
+                try:
+                    size = int(pax["size"])
+                except ValueError:
+                    raise _Unsupported() from None
+
+        end = data_pos
+        if type_ in _DATA_TYPES or type_ not in tarfile.SUPPORTED_TYPES:
+            end += -(-size // BLOCKSIZE) * BLOCKSIZE
+        if size < 0 or end > total:
+            raise _Unsupported()
+        headers.append((name, type_, linkname, start - base, end - base, size, mode))
+        pos = end
+    if pos != total:
+        raise _Unsupported()
+    return headers
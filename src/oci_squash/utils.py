@@ -14,6 +14,11 @@ def utc_now_rfc3339_trimmed() -> str:
     return re.sub(r"0*Z$", "Z", date)
 
 
+def rfc3339_from_epoch(epoch: int) -> str:
+    date = datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc)
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 class Chdir(object):
     def __init__(self, new_path: Union[str, os.PathLike[str]]):
         self.newPath = os.path.expanduser(str(new_path))
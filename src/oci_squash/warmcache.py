@@ -0,0 +1,140 @@
+import contextlib
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Dict, Iterator, List, Optional
+
+from .formats import ImageMeta, LayerBlob
+from .layers import LayerIndex, index_layers
+from .metadata import source_diff_ids
+from .workarea import WorkArea
+
+
+class WarmCache:
+    """In-memory LRU caches of layer indexes and diff_ids, kept across the
+    squashes of a long-running process (see ``server``).
+
+    Indexes are keyed by the content digest of the layer tar (its diff_id, or
+    the blob digest of an OCI layer) and bounded by their total number of
+    member records. Only indexes of layers read in place, uncompressed, are
+    kept: their records hold offsets into the layer tar, so they apply to
+    the same layer wherever it is found later. Compressed layers are indexed
+    from a decompressed copy that only lives as long as one squash.
+
+    diff_ids are keyed by the blob digest of compressed OCI layers, for
+    images whose config does not list them.
+    """
+
+    def __init__(self, max_members: int = 1000000, max_diff_ids: int = 100000):
+        self.max_members = max_members
+        self.max_diff_ids = max_diff_ids
+        self.members = 0
+        self.hits = 0
+        self.misses = 0
+        self._indexes: "OrderedDict[str, LayerIndex]" = OrderedDict()
+        self._diff_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index_layers(
+        self,
+        locations: List[tuple],
+        work: WorkArea,
+        jobs: int = 1,
+        keys: Optional[Dict[str, str]] = None,
+    ) -> Iterator[LayerIndex]:
+        """Like ``layers.index_layers``, taking indexes from the cache where it can.
+
+        ``keys`` maps layer ids to content digests, e.g. diff_ids; other
+        layer ids are their own key.
+        """
+        keys = keys or {}
+        cached = {}
+        for location in locations:
+            index = self._lookup(keys.get(location[0], location[0]), location)
+            if index is not None:
+                cached[location[0]] = index
+        missing = [location for location in locations if location[0] not in cached]
+        with contextlib.closing(index_layers(missing, work, jobs)) as fresh:
+            for location in locations:
+                index = cached.get(location[0])
+                if index is None:
+                    index = next(fresh)
+                    self._store(keys.get(location[0], location[0]), location, index)
+                yield index
+            # Run out the indexing so its worker pool shuts down with the job
+            for _ in fresh:
+                pass
+
+    def _lookup(self, key: str, location: tuple) -> Optional[LayerIndex]:
+        layer_id, path, offset, size = location
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None or index.size != size:
+                self.misses += 1
+                return None
+            self._indexes.move_to_end(key)
+            self.hits += 1
+        # Squashes drop the member list of an index once merged by replacing
+        # it rather than clearing it, so the cached list can be shared
+        return replace(index, layer_id=layer_id, path=path, offset=offset)
+
+    def _store(self, key: str, location: tuple, index: LayerIndex) -> None:
+        if key.startswith("<") or (index.path, index.offset) != location[1:3]:
+            return
+        if len(index.members) > self.max_members:
+            return
+        with self._lock:
+            old = self._indexes.pop(key, None)
+            if old is not None:
+                self.members -= len(old.members)
+            # A copy, as the squash goes on to replace the member list of index
+            self._indexes[key] = replace(index)
+            self.members += len(index.members)
+            while self.members > self.max_members:
+                _, evicted = self._indexes.popitem(last=False)
+                self.members -= len(evicted.members)
+
+    def layer_digests(self, meta: ImageMeta) -> Dict[str, str]:
+        """Return the diff_ids of the layers of ``meta`` known without hashing
+        them: from its config, else from the cache."""
+        digests = source_diff_ids(meta.config, meta.real_layer_ids)
+        if digests or not meta.oci:
+            return digests
+        with self._lock:
+            found = {
+                lid: self._diff_ids[lid]
+                for lid in meta.real_layer_ids
+                if lid in self._diff_ids
+            }
+            for lid in found:
+                self._diff_ids.move_to_end(lid)
+        return found
+
+    def remember(
+        self, meta: ImageMeta, digests: Dict[str, str], written: Dict[str, LayerBlob]
+    ) -> None:
+        """Cache the diff_ids of the OCI layer blobs of ``meta`` that were hashed
+        while being copied to ``written``, i.e. that ``digests`` lacked."""
+        if not meta.oci:
+            return
+        diff_ids = {
+            lid: blob.diff_id
+            for lid, blob in written.items()
+            if lid in meta.real_layer_ids and lid not in digests
+        }
+        with self._lock:
+            self._diff_ids.update(diff_ids)
+            for digest in diff_ids:
+                self._diff_ids.move_to_end(digest)
+            while len(self._diff_ids) > self.max_diff_ids:
+                self._diff_ids.popitem(last=False)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "indexes": len(self._indexes),
+                "index_members": self.members,
+                "index_hits": self.hits,
+                "index_misses": self.misses,
+                "diff_ids": len(self._diff_ids),
+            }
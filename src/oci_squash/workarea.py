@@ -0,0 +1,255 @@
+import io
+import os
+import secrets
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+_CHUNK = 1048576
+DEFAULT_BUDGET = 256 * _CHUNK
+# Memory files are anonymous; other processes reach them through /proc
+_MEMFD = hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd")
+
+
+class Spool(NamedTuple):
+    """Destination for a scratch file written by a worker process.
+
+    Up to ``limit`` bytes are written to ``path``, a memory file of the
+    parent process; beyond that the data moves to ``spill_path`` on disk.
+    """
+
+    path: str
+    limit: int
+    spill_path: str
+
+
+class WorkFile(io.FileIO):
+    """Scratch file of a ``WorkArea``, kept in memory while the budget allows.
+
+    In memory the file is a ``memfd``. When it would outgrow the area's
+    budget its content moves to a file under the area's root, behind the same
+    descriptor, so ``fileno()`` and ``path`` stay valid throughout.
+    """
+
+    def __init__(self, area: "WorkArea", name: str):
+        self._area = area
+        self._name = name
+        self._held = 0  # bytes of the budget held while in memory
+        self._disk: Optional[Path] = None
+        self.in_memory = area.budget > 0
+        if self.in_memory:
+            fd = os.memfd_create(name, os.MFD_CLOEXEC)
+            self.path = f"/proc/{os.getpid()}/fd/{fd}"
+        else:
+            fd, path = tempfile.mkstemp(
+                prefix=f"{os.path.basename(name)}-", dir=area.directory()
+            )
+            self._disk = Path(path)
+            self.path = path
+        super().__init__(fd, "r+b")
+
+    def reserve(self, end: int) -> None:
+        """Make room for the file to grow to ``end`` bytes.
+
+        Call this before writing to ``fileno()`` directly; ``write`` does so
+        itself.
+        """
+        if self.in_memory and end > self._held:
+            if self._area._take(end - self._held):
+                self._held = end
+            else:
+                self._spill()
+
+    def write(self, data) -> int:
+        self.reserve(self.tell() + len(data))
+        return super().write(data)
+
+    def _spill(self) -> None:
+        fd, path = tempfile.mkstemp(
+            prefix=f"{os.path.basename(self._name)}-", dir=self._area.directory()
+        )
+        try:
+            pos = self.tell()
+            offset, size = 0, os.fstat(self.fileno()).st_size
+            while offset < size:
+                n = os.sendfile(fd, self.fileno(), offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            # The memory file is freed once nothing refers to it any more
+            os.dup2(fd, self.fileno(), inheritable=False)
+            os.lseek(self.fileno(), pos, os.SEEK_SET)
+        finally:
+            os.close(fd)
+        self._area._release(self._held)
+        self._held = 0
+        self._disk = Path(path)
+        self.in_memory = False
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        self._area._release(self._held)
+        self._held = 0
+        if self._disk is not None:
+            self._disk.unlink(missing_ok=True)
+
+
+def write_spool(spool: Spool, chunks: Iterable[bytes]) -> str:
+    """Write ``chunks`` to ``spool`` and return the path that holds them.
+
+    Runs in worker processes; see ``WorkArea.spool``.
+    """
+    path = spool.path
+    if path == spool.spill_path:
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+    out = open(path, "wb")
+    try:
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            if size > spool.limit and path != spool.spill_path:
+                os.makedirs(os.path.dirname(spool.spill_path), 0o700, exist_ok=True)
+                spilled = open(spool.spill_path, "wb")
+                out.flush()
+                with open(path, "rb") as held:
+                    shutil.copyfileobj(held, spilled, _CHUNK)
+                out.truncate(0)
+                out.close()
+                out, path = spilled, spool.spill_path
+            out.write(chunk)
+    finally:
+        out.close()
+    return path
+
+
+class WorkArea:
+    """Scratch space of one run, held in memory up to ``budget`` bytes.
+
+    Files created here live in memory while they fit the budget, which all
+    of them share, and spill to files under ``root`` beyond it. The root
+    directory is only created once something needs the disk, so small images
+    are squashed without touching it. Without ``memfd`` support (outside
+    Linux), everything goes to disk.
+    """
+
+    def __init__(self, root: Optional[Path] = None, budget: int = DEFAULT_BUDGET):
+        if root is None:
+            root = Path(tempfile.gettempdir()) / f"oci-squash-{secrets.token_hex(6)}"
+        self.root = root
+        self.budget = budget if _MEMFD else 0
+        self.used = 0
+        self.peak = 0  # bytes held in memory at most, not counting reservations
+        self._reserved = 0  # held for spools that workers have yet to write
+        self._files: List[WorkFile] = []
+        self._spools: Dict[str, WorkFile] = {}
+        self._spooled = 0  # spools handed out, numbering their spill paths
+        self._scopes = 0
+        self._parent: Optional[WorkArea] = None
+
+    def _take(self, size: int) -> bool:
+        if self._parent is not None:
+            if not self._parent._take(size):
+                return False
+        elif self.used + size > self.budget:
+            return False
+        self.used += size
+        self._update_peak()
+        return True
+
+    def _release(self, size: int) -> None:
+        self.used -= size
+        if self._parent is not None:
+            self._parent._release(size)
+
+    def _reserve(self, size: int) -> None:
+        self._reserved += size
+        if self._parent is not None:
+            self._parent._reserve(size)
+
+    def _update_peak(self) -> None:
+        self.peak = max(self.peak, self.used - self._reserved)
+        if self._parent is not None:
+            self._parent._update_peak()
+
+    def directory(self, name: str = "") -> Path:
+        """Return ``root`` or a directory under it, creating it if needed."""
+        os.makedirs(self.root, 0o700, exist_ok=True)
+        path = self.root / name if name else self.root
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def create(self, name: str) -> WorkFile:
+        """Create an empty scratch file, closed with the area."""
+        f = WorkFile(self, name)
+        self._files.append(f)
+        return f
+
+    def spool(self, name: str, limit: int) -> Spool:
+        """Reserve up to ``limit`` bytes of memory for a worker to write ``name``.
+
+        Pass the result to ``write_spool`` in the worker, then the path it
+        returns to ``settle``. Each spool spills to a path of its own, as the
+        data of an earlier one may still be in use.
+        """
+        self._spooled += 1
+        head, tail = os.path.split(name)
+        spill_path = str(self.root / head / f"{self._spooled}-{tail}")
+        limit = min(limit, self.available())
+        if limit <= 0:
+            return Spool(spill_path, 0, spill_path)
+        f = WorkFile(self, name)
+        f._held = limit
+        self._reserve(limit)
+        self._take(limit)
+        self._spools[f.path] = f
+        return Spool(f.path, limit, spill_path)
+
+    def settle(self, spool: Spool, path: str) -> None:
+        """Account for the spool a worker wrote to ``path``."""
+        f = self._spools.pop(spool.path, None)
+        if f is None:
+            return
+        self._reserve(-f._held)
+        if path != spool.path:
+            f.close()
+            return
+        size = os.fstat(f.fileno()).st_size
+        self._release(f._held - size)
+        f._held = size
+        self._update_peak()
+        self._files.append(f)
+
+    def available(self) -> int:
+        if self._parent is not None:
+            return self._parent.available()
+        return self.budget - self.used
+
+    def scope(self) -> "WorkArea":
+        """Return an area for files that are only needed for a while.
+
+        It shares the budget of this area, and its files are released when
+        it is closed, without waiting for this area to close.
+        """
+        self._scopes += 1
+        area = WorkArea(self.root / f"scope-{self._scopes}", self.budget)
+        area._parent = self
+        return area
+
+    def close(self, remove: bool = True) -> None:
+        """Close all scratch files, and remove ``root`` with ``remove``."""
+        for f in self._files + list(self._spools.values()):
+            f.close()
+        self._reserve(-self._reserved)
+        self._files.clear()
+        self._spools.clear()
+        if remove:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
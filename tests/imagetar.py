@@ -0,0 +1,185 @@
+"""Build small image tars for the tests."""
+
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+MTIME = 1577836800  # 2020-01-01
+
+Entry = Tuple[tarfile.TarInfo, Optional[bytes]]
+
+
+def _info(name: str, type_: bytes, mode: int = 0o644) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.type = type_
+    info.mode = mode
+    info.mtime = MTIME
+    return info
+
+
+def file(name: str, data: bytes = b"") -> Entry:
+    info = _info(name, tarfile.REGTYPE)
+    info.size = len(data)
+    return info, data
+
+
+def directory(name: str) -> Entry:
+    return _info(name, tarfile.DIRTYPE, 0o755), None
+
+
+def symlink(name: str, target: str) -> Entry:
+    info = _info(name, tarfile.SYMTYPE, 0o777)
+    info.linkname = target
+    return info, None
+
+
+def hardlink(name: str, target: str) -> Entry:
+    info = _info(name, tarfile.LNKTYPE)
+    info.linkname = target
+    return info, None
+
+
+def whiteout(path: str) -> Entry:
+    head, tail = path.rsplit("/", 1) if "/" in path else ("", path)
+    return file(f"{head}/.wh.{tail}" if head else f".wh.{tail}")
+
+
+def layer(*entries: Entry) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for info, data in entries:
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+    return buf.getvalue()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _add(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = MTIME
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _config(layers: List[bytes]) -> bytes:
+    config = {
+        "architecture": "amd64",
+        "os": "linux",
+        "config": {},
+        "created": "2020-01-01T00:00:00Z",
+        "rootfs": {
+            "type": "layers",
+            "diff_ids": [f"sha256:{_sha256(data)}" for data in layers],
+        },
+        "history": [
+            {"created": "2020-01-01T00:00:00Z", "created_by": f"layer {i}"}
+            for i in range(len(layers))
+        ],
+    }
+    return json.dumps(config).encode()
+
+
+def write_oci(
+    path: Path, images: Dict[str, List[bytes]], compress: bool = True
+) -> Path:
+    """Write an OCI image layout tar of ``images``, mapping names to layers."""
+    blobs: Dict[str, bytes] = {}
+    descriptors = []
+
+    def blob(data: bytes) -> str:
+        digest = _sha256(data)
+        blobs[digest] = data
+        return f"sha256:{digest}"
+
+    media_type = "application/vnd.oci.image.layer.v1.tar"
+    for name, layers in images.items():
+        config = _config(layers)
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {
+                "mediaType": "application/vnd.oci.image.config.v1+json",
+                "digest": blob(config),
+                "size": len(config),
+            },
+            "layers": [],
+        }
+        for data in layers:
+            if compress:
+                data = gzip.compress(data, mtime=0)
+            manifest["layers"].append(
+                {
+                    "mediaType": media_type + ("+gzip" if compress else ""),
+                    "digest": blob(data),
+                    "size": len(data),
+                }
+            )
+        data = json.dumps(manifest).encode()
+        descriptors.append(
+            {
+                "mediaType": manifest["mediaType"],
+                "digest": blob(data),
+                "size": len(data),
+                "annotations": {"io.containerd.image.name": name},
+            }
+        )
+    with tarfile.open(path, "w") as tar:
+        _add(tar, "oci-layout", b'{"imageLayoutVersion": "1.0.0"}')
+        _add(
+            tar,
+            "index.json",
+            json.dumps({"schemaVersion": 2, "manifests": descriptors}).encode(),
+        )
+        for digest, data in blobs.items():
+            _add(tar, f"blobs/sha256/{digest}", data)
+    return path
+
+
+def write_docker(path: Path, layers: List[bytes], tag: str = "test:latest") -> Path:
+    """Write a ``docker save`` tar of one image."""
+    config = _config(layers)
+    config_name = f"{_sha256(config)}.json"
+    names = []
+    with tarfile.open(path, "w") as tar:
+        for i, data in enumerate(layers):
+            layer_id = _sha256(f"{i}:{_sha256(data)}".encode())
+            _add(tar, f"{layer_id}/VERSION", b"1.0")
+            _add(tar, f"{layer_id}/json", json.dumps({"id": layer_id}).encode())
+            _add(tar, f"{layer_id}/layer.tar", data)
+            names.append(f"{layer_id}/layer.tar")
+        _add(tar, config_name, config)
+        manifest = [{"Config": config_name, "RepoTags": [tag], "Layers": names}]
+        _add(tar, "manifest.json", json.dumps(manifest).encode())
+    return path
+
+
+def _members(data: bytes) -> Dict[str, tuple]:
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    members = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+        for info in tar:
+            content = tar.extractfile(info).read() if info.isfile() else None
+            members[info.name] = (info.type, info.linkname, content)
+    return members
+
+
+def read_layers(path: Path) -> Dict[str, List[Dict[str, tuple]]]:
+    """Return the layers of each image of an output tar, bottom first, by tag
+    or, for untagged images, by config name.
+
+    Each layer maps member names to their type, link target and content.
+    """
+    with tarfile.open(path, "r:") as tar:
+        manifests = json.load(tar.extractfile("manifest.json"))
+        return {
+            tag: [_members(tar.extractfile(name).read()) for name in m["Layers"]]
+            for m in manifests
+            for tag in m["RepoTags"] or [m["Config"]]
+        }
@@ -0,0 +1,44 @@
+import gzip
+import hashlib
+
+import pytest
+
+from oci_squash import squash_image
+
+from imagetar import directory, file, layer, read_layers, write_oci
+
+BASE = layer(directory("etc"), file("etc/base", b"base"))
+ONE = layer(file("etc/one", b"one" * 100))
+TWO = layer(file("etc/aaa-two", b"two" * 100))
+THREE = layer(file("etc/three", b"three"))
+OTHER = layer(file("etc/zzz-one", b"x" * 300))
+
+
+@pytest.mark.parametrize("output_format", ["oci", "docker"])
+@pytest.mark.parametrize("budget", [0, 1 << 20])
+def test_cached_batch_matches_uncached(tmp_path, output_format, budget):
+    # b reuses the cached squash of a, then c must not read its spilled layers
+    source = write_oci(
+        tmp_path / "in.tar",
+        {
+            "a:1": [BASE, ONE, TWO],
+            "b:1": [BASE, ONE, TWO, THREE],
+            "c:1": [BASE, ONE, OTHER],
+        },
+    )
+    base = f"sha256:{hashlib.sha256(gzip.compress(BASE, mtime=0)).hexdigest()}"
+    options = dict(
+        from_layer=base,
+        all_images=True,
+        output_format=output_format,
+        memory_budget=budget,
+    )
+    squash_image(str(source), str(tmp_path / "ref.tar"), **options)
+    expected = read_layers(tmp_path / "ref.tar")
+    assert sorted(expected["c:1"][-1]) == ["etc/one", "etc/zzz-one"]
+    for run in range(2):
+        output = tmp_path / f"cached-{run}.tar"
+        squash_image(
+            str(source), str(output), cache_dir=str(tmp_path / "cache"), **options
+        )
+        assert read_layers(output) == expected
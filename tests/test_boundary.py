@@ -0,0 +1,54 @@
+import pytest
+
+from oci_squash import squash_image
+from oci_squash.errors import SquashUnnecessaryError
+from oci_squash.squash import LayerAnalysis, SquashAnalysis, choose_boundary
+
+from imagetar import directory, file, layer, read_layers, write_oci
+
+
+def _analysis(*layers):
+    layers = [LayerAnalysis(lid, 1, s + d, s, d, 0) for lid, s, d in layers]
+    return SquashAnalysis(layers, 0, 0, [], 0, 0)
+
+
+def test_base_layer_is_kept():
+    # Squashing everything would reclaim the most, from the base layer itself
+    analysis = _analysis(("base", 100, 5000), ("mid", 10, 200), ("top", 10, 0))
+    boundary = choose_boundary(["base", "mid", "top"], analysis)
+    assert boundary.number == 2
+    assert [c[0] for c in boundary.candidates] == [2]
+
+
+def test_base_layer_below_empty_layers_is_kept():
+    analysis = _analysis(("base", 100, 5000), ("mid", 10, 200), ("top", 10, 0))
+    layer_ids = ["<missing-0>", "base", "<missing-1>", "mid", "top"]
+    boundary = choose_boundary(layer_ids, analysis)
+    assert [c[0] for c in boundary.candidates] == [2, 3]
+
+
+def test_nothing_to_reclaim_above_the_base():
+    analysis = _analysis(("base", 100, 5000), ("top", 10, 0))
+    with pytest.raises(SquashUnnecessaryError):
+        choose_boundary(["base", "top"], analysis)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_auto_scans_each_layer_once(tmp_path, compress):
+    layers = [
+        layer(directory("etc"), file("etc/base", b"base")),
+        layer(directory("opt"), file("opt/a", b"a" * 4096)),
+        layer(file("opt/a", b"newer a")),
+    ]
+    image = write_oci(tmp_path / "in.tar", {"x:1": layers}, compress=compress)
+    events = []
+    squash_image(
+        str(image),
+        str(tmp_path / "auto.tar"),
+        from_layer="auto",
+        tag="x:1",
+        on_event=events.append,
+    )
+    squash_image(str(image), str(tmp_path / "ref.tar"), from_layer="2", tag="x:1")
+    assert len([e for e in events if e.startswith("scanned layer")]) == 3
+    assert read_layers(tmp_path / "auto.tar") == read_layers(tmp_path / "ref.tar")
@@ -0,0 +1,72 @@
+import pytest
+
+from oci_squash import squash_image
+
+from imagetar import (
+    directory,
+    file,
+    hardlink,
+    layer,
+    read_layers,
+    symlink,
+    whiteout,
+    write_docker,
+)
+
+BASE = layer(directory("etc"), file("etc/base", b"base"), file("etc/gone", b"gone"))
+
+
+# Layers above BASE; the first two are squashed and cached on their own first
+CASES = {
+    "plain": [
+        layer(directory("opt"), file("opt/a", b"a")),
+        layer(file("opt/b", b"b"), whiteout("etc/gone")),
+        layer(file("opt/a", b"newer a")),
+    ],
+    "symlink-replaced": [
+        layer(directory("opt"), directory("opt/app"), file("opt/app/old", b"old")),
+        layer(symlink("opt/app", "/etc")),
+        layer(directory("opt/app"), file("opt/app/new", b"new")),
+    ],
+    "hardlink-target-added": [
+        layer(directory("opt"), hardlink("opt/link", "opt/target")),
+        layer(file("opt/other", b"other")),
+        layer(file("opt/target", b"target")),
+    ],
+    "readded-then-opaque": [
+        layer(whiteout("etc/gone")),
+        layer(file("etc/gone", b"back")),
+        layer(directory("etc"), file("etc/.wh..wh..opq")),
+    ],
+    "whiteout-over-readded": [
+        layer(whiteout("etc")),
+        layer(file("etc/new", b"new")),
+        layer(file("etc/newer", b"newer")),
+    ],
+}
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_prefix_hit_matches_uncached(tmp_path, case):
+    layers = [BASE, *CASES[case]]
+    prefix = write_docker(tmp_path / "prefix.tar", layers[:3], "x:1")
+    full = write_docker(tmp_path / "full.tar", layers, "x:1")
+    cache = str(tmp_path / "cache")
+    squash_image(str(full), str(tmp_path / "ref.tar"), from_layer="3", tag="x:1")
+    squash_image(
+        str(prefix), str(tmp_path / "prefix-out.tar"), from_layer="2", cache_dir=cache
+    )
+    events = []
+    squash_image(
+        str(full),
+        str(tmp_path / "out.tar"),
+        from_layer="3",
+        tag="x:1",
+        cache_dir=cache,
+        on_event=events.append,
+    )
+    expected = read_layers(tmp_path / "ref.tar")
+    assert len(expected["x:1"]) == 2
+    assert read_layers(tmp_path / "out.tar") == expected
+    if case == "plain":
+        assert "cache hit for 2 of 3 layers" in events
@@ -0,0 +1,58 @@
+import gzip
+import os
+
+import pytest
+
+from oci_squash.layers import LayerReader, index_layers
+from oci_squash.workarea import WorkArea
+
+from imagetar import file, layer
+
+
+def _blob(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(gzip.compress(data, mtime=0))
+    return (name, str(path), 0, path.stat().st_size)
+
+
+def _read(index):
+    reader = LayerReader(index)
+    try:
+        member = index.members[0]
+        return reader.extractfile(reader.tarinfo(member)).read()
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize("budget", [0, 4096, 1 << 20])
+def test_spools_of_separate_index_calls_stay_apart(tmp_path, budget):
+    first = _blob(tmp_path, "one", layer(file("etc/one", b"1" * 3000)))
+    second = _blob(tmp_path, "two", layer(file("etc/two", b"2" * 3000)))
+    with WorkArea(tmp_path / "work", budget) as work:
+        [one] = index_layers([first], work)
+        [two] = index_layers([second], work)
+        assert one.path != two.path
+        assert _read(one) == b"1" * 3000
+        assert _read(two) == b"2" * 3000
+
+
+def test_spill_paths_are_unique(tmp_path):
+    with WorkArea(tmp_path / "work", 0) as work:
+        paths = {work.spool("layers/0.tar", 0).spill_path for _ in range(3)}
+    assert len(paths) == 3
+    assert {os.path.dirname(p) for p in paths} == {str(tmp_path / "work" / "layers")}
+
+
+def test_scope_shares_the_budget(tmp_path):
+    with WorkArea(tmp_path / "work", 1 << 20) as work:
+        if not work.budget:
+            pytest.skip("no memory files")
+        held = work.create("held")
+        held.write(b"x" * 1000)
+        with work.scope() as scope:
+            f = scope.create("scoped")
+            f.write(b"y" * 5000)
+            assert work.used == 6000
+            assert scope.available() == work.available()
+        assert work.used == 1000
+        assert work.peak == 6000